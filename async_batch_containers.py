@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+"""asyncio counterpart of AzureBatchContainers.
+
+The Azure Batch SDK only ships a blocking client, so every service call is
+run on a bounded thread pool, sharing its logic with AzureBatchContainers,
+while waiting for tasks to complete is done with ``asyncio.sleep`` calls.
+Many pools, jobs and brains can be orchestrated from a single event loop:
+
+    async def main():
+        first = AsyncAzureBatchContainers("configs/first.ini")
+        second = AsyncAzureBatchContainers("configs/second.ini")
+        await asyncio.gather(
+            first.batch_main(command="python main.py", wait_for_tasks=True),
+            second.batch_main(command="python main.py", wait_for_tasks=True),
+        )
+"""
+
+import asyncio
+import datetime
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Union
+
+import azure.batch.models as batchmodels
+
+from batch_containers import AzureBatchContainers, logger
+from batch_creation import user_config
+
+
+class AsyncAzureBatchContainers(object):
+    def __init__(
+        self,
+        config_file: str = user_config,
+        service_principal: bool = False,
+        workspace: str = None,
+        access_key: str = None,
+        max_workers: int = 8,
+    ):
+        """Awaitable version of AzureBatchContainers.
+
+        Parameters
+        ----------
+        config_file : str, optional
+            Location of your configuration settings, see AzureBatchContainers
+        max_workers : int, optional
+            Number of Batch service calls this instance runs concurrently, by default 8
+        """
+
+        self.batch = AzureBatchContainers(
+            config_file=config_file,
+            service_principal=service_principal,
+            workspace=workspace,
+            access_key=access_key,
+        )
+        self.config = self.batch.config
+        self.batch_client = self.batch.batch_client
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def _run(self, func, *args, **kwargs):
+        """Run a blocking call on this instance's thread pool."""
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    @property
+    def pool_id(self) -> str:
+        return self.batch.pool_id
+
+    @property
+    def job_id(self) -> str:
+        return self.batch.job_id
+
+    async def create_pool(self, skip_if_exists=True, **kwargs):
+        """Create or re-use a pool, see AzureBatchContainers.create_pool for the arguments."""
+
+        return await self._run(
+            self.batch.create_pool, skip_if_exists=skip_if_exists, **kwargs
+        )
+
+    async def add_job(self, job_name: str = None):
+        return await self._run(self.batch.add_job, job_name=job_name)
+
+    async def add_task(
+        self,
+        task_command: str,
+        task_name: str,
+        start_dir: str = None,
+        environment: dict = None,
+        image: str = None,
+    ):
+        return await self._run(
+            self.batch.add_task,
+            task_command,
+            task_name,
+            start_dir=start_dir,
+            environment=environment,
+            image=image,
+        )
+
+    async def add_tasks(self, tasks: Iterable[batchmodels.TaskAddParameter]) -> dict:
+        return await self._run(self.batch.add_tasks, tasks)
+
+    async def resize_pool(
+        self, pool_id: str = None, dedicated_nodes: int = 0, low_pri_nodes: int = 9
+    ):
+        return await self._run(
+            self.batch.resize_pool,
+            pool_id=pool_id,
+            dedicated_nodes=dedicated_nodes,
+            low_pri_nodes=low_pri_nodes,
+        )
+
+    async def delete_pool(self, pool_name=None, delete_all=False, wait: bool = False):
+        return await self._run(
+            self.batch.delete_pool,
+            pool_name=pool_name,
+            delete_all=delete_all,
+            wait=wait,
+        )
+
+    async def get_task_counts(self, job_id: str = None) -> batchmodels.TaskCounts:
+        return await self._run(self.batch.get_task_counts, job_id)
+
+    async def copy_logfiles(self, **kwargs) -> dict:
+        return await self._run(self.batch.copy_logfiles, **kwargs)
+
+    async def wait_for_tasks_to_complete(
+        self,
+        timeout: datetime.timedelta,
+        per_task_detail: bool = False,
+        min_interval: float = 1.0,
+        max_interval: float = 30.0,
+    ):
+        """Awaitable version of AzureBatchContainers.wait_for_tasks_to_complete.
+
+        Each poll of AzureBatchContainers.poll_task_completion runs on the
+        thread pool, the waits between polls are on the event loop.
+        """
+
+        deadline = time.monotonic() + timeout.total_seconds()
+        logger.info(
+            "Monitoring all tasks of {0} for 'Completed' state, timeout in {1}...".format(
+                self.job_id, timeout
+            )
+        )
+
+        polls = self.batch.poll_task_completion(
+            per_task_detail, min_interval, max_interval
+        )
+        while True:
+            interval = await self._run(next, polls, None)
+            if interval is None:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(interval, remaining))
+
+        raise RuntimeError(
+            "ERROR: Tasks did not reach 'Completed' state within "
+            "timeout period of " + str(timeout)
+        )
+
+    async def batch_main(
+        self,
+        command: Union[str, Iterable, None] = None,
+        wait_for_tasks: bool = False,
+        task_detail: bool = False,
+        **kwargs,
+    ):
+        """Awaitable version of AzureBatchContainers.batch_main.
+
+        Everything up to submitting the tasks, including resuming, metrics,
+        paced submission and the preemption watcher, is AzureBatchContainers.batch_main
+        run on the thread pool, which also reads command. Only waiting for the
+        tasks is done on the event loop.
+
+        Parameters
+        ----------
+        command : Union[str, Iterable, None], optional
+            Task commands, see AzureBatchContainers.batch_main
+        wait_for_tasks : bool, optional
+            Wait until every task completed, by default False
+        task_detail : bool, optional
+            Log the ids of incomplete tasks while waiting, by default False
+        kwargs
+            Any other argument of AzureBatchContainers.batch_main
+        """
+
+        await self._run(self.batch.batch_main, command, wait_for_tasks=False, **kwargs)
+        if not wait_for_tasks:
+            return
+
+        await self._run(self.batch.wait_for_submission)
+        with self.batch.metrics.span("wait_for_tasks"):
+            await self.wait_for_tasks_to_complete(
+                datetime.timedelta(hours=2), per_task_detail=task_detail
+            )
+        await self._run(
+            self.batch.tasks_completed,
+            profile_readiness=kwargs.get("profile_readiness", False),
+            app_insights=kwargs.get("app_insights", True),
+        )
+        self.batch.metrics.flush()
+        self.batch.metrics.log_summary("Orchestration: ")
+
+    def close(self):
+        """Release the thread pool used for Batch service calls."""
+
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,319 @@
+#! /usr/bin/env python
+"""Autoscale formulas for Batch pools and a local simulator to try them out.
+
+The formula sizes the pool from the job's pending tasks ($PendingTasks counts
+active and running tasks): enough nodes to give every pending task a slot,
+low priority nodes first, dedicated nodes only up to their bounds. It scales
+up on the latest sample and down on the average over a window, so a short
+dip in pending tasks does not release nodes which are about to be needed.
+
+Replay a timeline of pending task counts to see the node curve and cost
+before attaching a formula to a pool:
+
+    python autoscale.py formula --max_low_pri 20 --max_dedicated 1 --tasks_per_node 4
+    python autoscale.py simulate --timeline timeline.csv --max_low_pri 20 --tasks_per_node 4
+"""
+
+import csv
+import datetime
+import logging
+from math import ceil
+from typing import List, Tuple, Union
+
+import fire
+
+logger = logging.getLogger("autoscale")
+
+# the Batch service evaluates formulas at most every 5 minutes
+MIN_EVALUATION_INTERVAL = 5
+
+
+class AutoscaleFormula(object):
+    def __init__(
+        self,
+        max_low_pri: int,
+        max_dedicated: int = 0,
+        min_low_pri: int = 0,
+        min_dedicated: int = 0,
+        tasks_per_node: int = 1,
+        sample_minutes: int = 5,
+        node_deallocation: str = "taskcompletion",
+    ):
+        """Autoscale formula driven by pending (active and running) task counts.
+
+        Parameters
+        ----------
+        max_low_pri : int
+            Upper bound on low priority nodes
+        max_dedicated : int, optional
+            Upper bound on dedicated nodes, by default 0
+        min_low_pri : int, optional
+            Low priority nodes kept while the pool is idle, by default 0
+        min_dedicated : int, optional
+            Dedicated nodes kept while the pool is idle, by default 0
+        tasks_per_node : int, optional
+            Task slots per node, by default 1
+        sample_minutes : int, optional
+            Window of $PendingTasks samples averaged when scaling down, by default 5
+        node_deallocation : str, optional
+            What happens to tasks on removed nodes: taskcompletion lets them
+            finish, requeue restarts them elsewhere, by default "taskcompletion"
+        """
+
+        if min_low_pri > max_low_pri or min_dedicated > max_dedicated:
+            raise ValueError("minimum node counts must not exceed the maximums")
+        self.max_low_pri = int(max_low_pri)
+        self.max_dedicated = int(max_dedicated)
+        self.min_low_pri = int(min_low_pri)
+        self.min_dedicated = int(min_dedicated)
+        self.tasks_per_node = max(int(tasks_per_node), 1)
+        self.sample_minutes = int(sample_minutes)
+        self.node_deallocation = node_deallocation
+
+    def formula(self) -> str:
+        """Formula text for PoolAddParameter.auto_scale_formula."""
+
+        return "\n".join(
+            [
+                f"$window = TimeInterval_Minute * {self.sample_minutes};",
+                "$latest = max(0, $PendingTasks.GetSample(1));",
+                "$tasks = $PendingTasks.GetSamplePercent($window) < 70 ? $latest : max($latest, avg($PendingTasks.GetSample($window)));",
+                f"$nodes = ceil($tasks / {self.tasks_per_node});",
+                f"$lowpri = min({self.max_low_pri}, max({self.min_low_pri}, $nodes - {self.min_dedicated}));",
+                "$TargetLowPriorityNodes = $lowpri;",
+                f"$TargetDedicatedNodes = min({self.max_dedicated}, max({self.min_dedicated}, $nodes - $lowpri));",
+                f"$NodeDeallocationOption = {self.node_deallocation};",
+            ]
+        )
+
+    def targets(self, samples: List[float]) -> Tuple[int, int]:
+        """Evaluate the formula locally on per-minute pending task samples, newest last.
+
+        Returns
+        -------
+        Tuple[int, int]
+            Target (low priority, dedicated) nodes.
+        """
+
+        latest = max(samples[-1], 0) if samples else 0
+        window = samples[-self.sample_minutes :]
+        # like GetSamplePercent, fall back to the latest sample until the window is 70% full
+        if len(window) < 0.7 * self.sample_minutes:
+            tasks = latest
+        else:
+            tasks = max(latest, sum(window) / len(window))
+        nodes = ceil(tasks / self.tasks_per_node)
+        low_pri = min(
+            self.max_low_pri, max(self.min_low_pri, nodes - self.min_dedicated)
+        )
+        dedicated = min(self.max_dedicated, max(self.min_dedicated, nodes - low_pri))
+        return low_pri, dedicated
+
+
+def evaluation_interval(minutes: int = MIN_EVALUATION_INTERVAL) -> datetime.timedelta:
+    """Evaluation interval for a pool, at least the service minimum of 5 minutes."""
+
+    if minutes < MIN_EVALUATION_INTERVAL:
+        raise ValueError(
+            f"autoscale evaluation interval must be at least {MIN_EVALUATION_INTERVAL} minutes"
+        )
+    return datetime.timedelta(minutes=int(minutes))
+
+
+def read_timeline(timeline: Union[str, list]) -> List[Tuple[float, int]]:
+    """(minute, pending tasks) pairs from a list or a CSV file with minute and pending columns."""
+
+    if isinstance(timeline, str):
+        with open(timeline, newline="") as rows:
+            timeline = [(row["minute"], row["pending"]) for row in csv.DictReader(rows)]
+    return sorted((float(minute), int(pending)) for minute, pending in timeline)
+
+
+def simulate(
+    timeline: Union[str, list],
+    max_low_pri: int,
+    max_dedicated: int = 0,
+    min_low_pri: int = 0,
+    min_dedicated: int = 0,
+    tasks_per_node: int = 1,
+    sample_minutes: int = 5,
+    interval: int = MIN_EVALUATION_INTERVAL,
+    low_pri_price: float = None,
+    dedicated_price: float = None,
+    region: str = "westus",
+    vm_sku: str = None,
+    host_os: str = "linux",
+    plot: bool = False,
+):
+    """Replay a pending task timeline through the formula and report the node curve and cost.
+
+    The pending count holds from each timeline point to the next. The formula
+    is evaluated every interval minutes on the per-minute samples so far, and
+    nodes are billed for the whole interval at the target it sets.
+
+    Parameters
+    ----------
+    timeline : Union[str, list]
+        (minute, pending tasks) pairs, or a CSV file with minute and pending columns
+    interval : int, optional
+        Minutes between evaluations, by default 5
+    low_pri_price : float, optional
+        Hourly price of a low priority node, looked up for vm_sku when not given
+    dedicated_price : float, optional
+        Hourly price of a dedicated node, looked up for vm_sku when not given
+    region : str, optional
+        Region to look prices up in, by default "westus"
+    vm_sku : str, optional
+        VM size to look prices up for, by default None (no cost reported)
+    plot : bool, optional
+        Plot pending tasks and nodes over time with matplotlib, by default False
+
+    Returns
+    -------
+    dict
+        Per evaluation rows (minute, pending, low_pri_nodes, dedicated_nodes),
+        peak node counts, node hours and the total cost when prices are known.
+
+    Raises
+    ------
+    ValueError
+        If interval is under a minute or the timeline is empty
+    """
+
+    if interval < 1:
+        raise ValueError(
+            f"interval must be at least 1 minute, got {interval}: "
+            "the formula is evaluated on per-minute samples"
+        )
+    policy = AutoscaleFormula(
+        max_low_pri,
+        max_dedicated=max_dedicated,
+        min_low_pri=min_low_pri,
+        min_dedicated=min_dedicated,
+        tasks_per_node=tasks_per_node,
+        sample_minutes=sample_minutes,
+    )
+    points = read_timeline(timeline)
+    if not points:
+        raise ValueError("timeline is empty")
+
+    if vm_sku and (low_pri_price is None or dedicated_price is None):
+        from get_azure_data import get_sku_prices, price_column
+
+        for low_pri in (True, False):
+            prices = get_sku_prices(region, [vm_sku], low_pri=low_pri, host_os=host_os)
+            price = float(prices[price_column(prices)].iloc[0])
+            if low_pri and low_pri_price is None:
+                low_pri_price = price
+            elif not low_pri and dedicated_price is None:
+                dedicated_price = price
+
+    end = int(ceil(points[-1][0])) + 1
+    samples, rows = [], []
+    point = 0
+    for minute in range(end):
+        while point + 1 < len(points) and points[point + 1][0] <= minute:
+            point += 1
+        samples.append(points[point][1] if points[point][0] <= minute else 0)
+        if minute % interval == 0:
+            low_pri, dedicated = policy.targets(samples)
+            rows.append(
+                {
+                    "minute": minute,
+                    "pending": samples[-1],
+                    "low_pri_nodes": low_pri,
+                    "dedicated_nodes": dedicated,
+                }
+            )
+
+    hours = interval / 60.0
+    report = {
+        "formula": policy.formula(),
+        "timeline": rows,
+        "peak_low_pri_nodes": max(row["low_pri_nodes"] for row in rows),
+        "peak_dedicated_nodes": max(row["dedicated_nodes"] for row in rows),
+        "low_pri_node_hours": sum(row["low_pri_nodes"] for row in rows) * hours,
+        "dedicated_node_hours": sum(row["dedicated_nodes"] for row in rows) * hours,
+    }
+    if low_pri_price is not None and dedicated_price is not None:
+        report["cost"] = round(
+            report["low_pri_node_hours"] * low_pri_price
+            + report["dedicated_node_hours"] * dedicated_price,
+            2,
+        )
+        # the same pool held at its maximum size for the whole timeline
+        report["fixed_size_cost"] = round(
+            len(rows)
+            * hours
+            * (max_low_pri * low_pri_price + max_dedicated * dedicated_price),
+            2,
+        )
+
+    logger.info(
+        "Peak nodes: {0} low priority, {1} dedicated; node hours: {2:.1f} low priority, {3:.1f} dedicated{4}".format(
+            report["peak_low_pri_nodes"],
+            report["peak_dedicated_nodes"],
+            report["low_pri_node_hours"],
+            report["dedicated_node_hours"],
+            ", cost ${0} vs ${1} at fixed size".format(
+                report["cost"], report["fixed_size_cost"]
+            )
+            if "cost" in report
+            else "",
+        )
+    )
+
+    if plot:
+        import matplotlib.pyplot as plt
+
+        minutes = [row["minute"] for row in rows]
+        fig, ax = plt.subplots()
+        ax.step(
+            minutes,
+            [row["pending"] / policy.tasks_per_node for row in rows],
+            where="post",
+            label="pending tasks / tasks per node",
+        )
+        ax.step(
+            minutes,
+            [row["low_pri_nodes"] for row in rows],
+            where="post",
+            label="low priority nodes",
+        )
+        ax.step(
+            minutes,
+            [row["dedicated_nodes"] for row in rows],
+            where="post",
+            label="dedicated nodes",
+        )
+        ax.set_xlabel("minute")
+        ax.set_ylabel("nodes")
+        ax.legend()
+        plt.show()
+
+    return report
+
+
+def formula(
+    max_low_pri: int,
+    max_dedicated: int = 0,
+    min_low_pri: int = 0,
+    min_dedicated: int = 0,
+    tasks_per_node: int = 1,
+    sample_minutes: int = 5,
+):
+    """Autoscale formula for the given bounds."""
+
+    return AutoscaleFormula(
+        max_low_pri,
+        max_dedicated=max_dedicated,
+        min_low_pri=min_low_pri,
+        min_dedicated=min_dedicated,
+        tasks_per_node=tasks_per_node,
+        sample_minutes=sample_minutes,
+    ).formula()
+
+
+if __name__ == "__main__":
+
+    fire.Fire({"formula": formula, "simulate": simulate})
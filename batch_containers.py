@@ -4,27 +4,54 @@
 # TODO: 1. Add monitoring tasks
 # TODO: 2. Use [batch-insights](https://github.com/Azure/batch-insights) for monitoring
 
+# Keep module level imports light: every fire command pays for them before it
+# runs. Pricing (pandas, BeautifulSoup), service principal auth, blob transfer
+# and bonsai helpers are imported inside the functions that use them, and
+# benchmarks/startup_time.py tracks the cold import time of each entry point.
+
 import configparser
 import datetime
-from distutils.command.config import config
+import email.utils
+import functools
+import hashlib
+import inspect
+import io
+import json
 import os
 import pathlib
 import sys
 import subprocess
+import threading
 import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait as wait_for_futures,
+)
+from itertools import islice
 from math import ceil
-from typing import Union, List
-from distutils.util import strtobool
+from typing import Iterable, Iterator, Optional, Union, List
 
 import azure.batch._batch_service_client as batch
 import azure.batch.batch_auth as batch_auth
 import azure.batch.models as batchmodels
-import pandas as pd
 import fire
-from azure.common.credentials import ServicePrincipalCredentials
 from dotenv import load_dotenv, set_key
+import batch_daemon
+from autoscale import AutoscaleFormula, evaluation_interval
 from batch_creation import user_config, windows_config
-from get_azure_data import *
+from command_source import command_source, count_commands, is_command_file
+from metrics import Metrics, instrument, make_sinks, percentile
+from preemption import PreemptionWatcher, preemption_rate as observed_preemption_rate
+from readiness import ReadinessProfiler, node_phases, node_sample
+from scheduling import SlotAwareScheduler, SubmissionScheduler
+from state_store import (
+    ABANDONED,
+    RESUME_MAX_AGE_HOURS,
+    StateStore,
+    run_key as state_run_key,
+)
 
 import logging
 import logging.handlers
@@ -37,6 +64,19 @@ logging.basicConfig(
 
 logger = logging.getLogger("batch_containers")
 
+# maximum number of tasks accepted by a single task.add_collection request
+TASK_COLLECTION_LIMIT = 100
+# pool metadata entry holding the fingerprint of the pool's configuration
+POOL_FINGERPRINT_KEY = "bonsai-batch-fingerprint"
+# blob container in the Batch account's linked storage holding the start task
+# assets, see mirror_start_task_assets
+START_TASK_ASSETS_CONTAINER = "batch-insights"
+# xfer_utils only uploads names matching *.*, hence the suffix on linux
+BATCH_INSIGHTS_BINARIES = {
+    "linux": "batch-insights.linux",
+    "windows": "batch-insights.exe",
+}
+
 
 class AzureBatchContainers(object):
     def __init__(
@@ -90,6 +130,18 @@ class AzureBatchContainers(object):
             self.access_key = access_key
             # pool needs to be created before fileshare can be activated
             self.use_fileshare = False
+            # background task submission started by batch_main, if any
+            self.scheduler = None
+            self.preemption_watcher = None
+            # tasks in self.job_id known to be submitted, see tasks_complete
+            self.submitted_tasks = 0
+            self.readiness_profiler = None
+            self.state_store = None
+            # timing spans of the latest batch_main, see metrics.Metrics
+            self.metrics = None
+            # images pulled onto the pool's nodes, set by create_pool
+            self.pulled_images = None
+            self._unpulled_images = set()
 
     def get_container_registry(self):
         """Creates an attribute called registry which attaches to your ACR account provided in config.
@@ -107,6 +159,10 @@ class AzureBatchContainers(object):
             ]
         )
         self.image_version = self.config["ACR"]["IMAGE_VERSION"].strip("'")
+        prepull = self.config["ACR"].get("PREPULL_IMAGES", "").strip("'")
+        self.prepull_images = [
+            self.image_ref(image) for image in prepull.split(",") if image.strip()
+        ]
 
         self.registry = batch.models.ContainerRegistry(
             registry_server=self.config["ACR"]["SERVER"].strip("'"),
@@ -116,6 +172,31 @@ class AzureBatchContainers(object):
 
         return self.registry
 
+    def image_ref(self, image: str = None) -> str:
+        """Full reference of a container image in the registry, by default the configured image.
+
+        image can be "name", "name:version" or a full reference including the
+        registry server; a missing version defaults to IMAGE_VERSION.
+        """
+
+        if not image:
+            return self.image_name + ":" + self.image_version
+        image = image.strip()
+        server = self.config["ACR"]["SERVER"].strip("'")
+        if not image.startswith(server + "/") and "/" not in image.split(":")[0]:
+            image = server + "/" + image
+        if ":" not in image.rsplit("/", 1)[-1]:
+            image += ":" + self.image_version
+        return image
+
+    def pool_images(self, images: List[str] = None) -> List[str]:
+        """Images pulled onto every node when the pool is created: the configured image, ACR PREPULL_IMAGES and images."""
+
+        pulled = [self.image_ref()] + self.prepull_images
+        pulled += [self.image_ref(image) for image in images or []]
+        # keep the order, the configured image first
+        return list(dict.fromkeys(pulled))
+
     def get_image_ref(self):
         """Get reference image for the Batch pool. All parameters are pooled from config['POOL'], which should include keys for PUBLISHER, OFFER, SKU and VERSION. Image reference is stored in self.image_ref_to_use
 
@@ -153,6 +234,8 @@ class AzureBatchContainers(object):
         location = self.config["BATCH"]["LOCATION"].strip("'")
 
         if service_principal:
+            from azure.common.credentials import ServicePrincipalCredentials
+
             RESOURCE = "https://batch.core.windows.net/"
             BATCH_ACCOUNT_URL = "https://{0}.{1}.batch.azure.com".format(
                 batch_account_name, location
@@ -175,14 +258,52 @@ class AzureBatchContainers(object):
         return self.batch_client
 
     def create_pool(
-        self, skip_if_exists=True, use_fileshare: bool = True, app_insights: bool = True
+        self,
+        skip_if_exists=True,
+        use_fileshare: bool = True,
+        app_insights: bool = True,
+        auto_scale: bool = False,
+        auto_scale_formula: str = None,
+        auto_scale_interval: int = 5,
+        on_mismatch: str = "refuse",
+        reuse_warm: bool = True,
+        images: List[str] = None,
+        profile_readiness: bool = False,
     ):
         """Create an Azure Batch Pool. All necessary parameters should be listed in config['POOL'], and saves pool to self.pool_id.
 
+        Pools are tagged with a fingerprint of their configuration (see
+        pool_fingerprint) and registered in the StateStore. An existing pool is
+        only re-used when its fingerprint matches, and it is resized to the
+        configured node counts. When no pool named POOL_ID exists, an idle
+        registered pool with the same fingerprint is re-used instead, so back
+        to back experiments skip node allocation and image pulls.
+
         Parameters
         ----------
         skip_if_exists : bool, optional
             Skip creation of pool if it already exists (the default is True, which means pool will be re-used)
+        auto_scale : bool, optional
+            Size the pool with an autoscale formula instead of fixed node counts,
+            by default False. LOW_PRI_NODES and DEDICATED_NODES become the upper
+            bounds and the pool shrinks to zero nodes once no tasks are pending.
+        auto_scale_formula : str, optional
+            Formula to use instead of autoscale.AutoscaleFormula built from the config, by default None
+        auto_scale_interval : int, optional
+            Minutes between formula evaluations, at least 5, by default 5
+        on_mismatch : str, optional
+            What to do when the existing pool was created with another
+            configuration: "refuse" raises a ValueError, "replace" deletes and
+            recreates it and "reuse" uses it anyway, by default "refuse"
+        reuse_warm : bool, optional
+            Re-use an idle compatible pool under another name, by default True
+        images : List[str], optional
+            Extra images pulled onto every node as it joins the pool, on top of
+            the configured image and ACR PREPULL_IMAGES, so tasks can pick any
+            of them without pulling (see pool_images), by default None
+        profile_readiness : bool, optional
+            Profile how long the new nodes take to get ready in the background
+            (see profile_readiness), by default False
 
         """
         pool_id = self.config["POOL"]["POOL_ID"].strip("'")
@@ -193,8 +314,9 @@ class AzureBatchContainers(object):
         node_agent_sku = self.config["POOL"]["AGENT_SKU"].strip("'")
         self.use_fileshare = use_fileshare
 
+        self.pulled_images = self.pool_images(images)
         container_conf = batch.models.ContainerConfiguration(
-            container_image_names=[self.image_name + ":" + self.image_version],
+            container_image_names=self.pulled_images,
             container_registries=[self.registry],
         )
 
@@ -228,14 +350,10 @@ class AzureBatchContainers(object):
                 scope=batch.models.AutoUserScope.pool,
                 elevation_level=batch.models.ElevationLevel.admin,
             )
-            if self.config["ACR"]["PLATFORM"] == "linux":
-                command_line = "/bin/bash -c 'wget  -O - https://raw.githubusercontent.com/Azure/batch-insights/master/scripts/1.x/run-linux.sh | bash'"
-            elif self.config["ACR"]["PLATFORM"] == "windows":
-                command_line = 'cmd /c @/"%SystemRoot%\System32\WindowsPowerShell\v1.0\powershell.exe/" -NoProfile -InputFormat None -ExecutionPolicy Bypass -Command /"iex ((New-Object System.Net.WebClient).DownloadString(\'https://raw.githubusercontent.com/Azure/batch-insights/master/scripts/1.x/run-windows.ps1\'))/"'
-            else:
-                raise ValueError(f"Unknown platform selected {self.config['ACR']['PLATFORM']}")
+            command_line, resource_files = self.batch_insights_start_command()
             start_task = batch.models.StartTask(
                 command_line=command_line,
+                resource_files=resource_files,
                 user_identity=batch.models.UserIdentity(auto_user=user),
                 wait_for_success=True,
                 environment_settings=[
@@ -258,6 +376,12 @@ class AzureBatchContainers(object):
         else:
             start_task = None
 
+        if auto_scale:
+            auto_scale_formula = auto_scale_formula or self.autoscale_formula()
+            # target node counts may not be set together with a formula
+            pool_dedicated_node_count = pool_low_priority_node_count = None
+            logger.info(f"Autoscaling pool with formula:\n{auto_scale_formula}")
+
         self.new_pool = batch.models.PoolAddParameter(
             id=pool_id,
             virtual_machine_configuration=batch.models.VirtualMachineConfiguration(
@@ -270,11 +394,73 @@ class AzureBatchContainers(object):
             task_slots_per_node=num_tasks_per_node,
             target_dedicated_nodes=pool_dedicated_node_count,
             target_low_priority_nodes=pool_low_priority_node_count,
+            enable_auto_scale=auto_scale,
+            auto_scale_formula=auto_scale_formula if auto_scale else None,
+            auto_scale_evaluation_interval=(
+                evaluation_interval(auto_scale_interval) if auto_scale else None
+            ),
             mount_configuration=fileshare_mount,
             start_task=start_task,
         )
 
-        if not skip_if_exists or not self.batch_client.pool.exists(pool_id):
+        fingerprint = pool_fingerprint(self.new_pool)
+        self.new_pool.metadata = [
+            batchmodels.MetadataItem(name=POOL_FINGERPRINT_KEY, value=fingerprint)
+        ]
+        account = self.config["BATCH"]["ACCOUNT_NAME"]
+        registry = self.state_store or StateStore()
+
+        existing = self._get_pool(pool_id)
+        if existing is None and skip_if_exists and reuse_warm:
+            warm_pool_id = self.find_warm_pool(fingerprint, registry)
+            if warm_pool_id:
+                logger.warning(
+                    "Re-using warm pool [bold magenta]{0}[/bold magenta] instead of creating {1}".format(
+                        warm_pool_id, pool_id
+                    )
+                )
+                pool_id = self.new_pool.id = warm_pool_id
+                existing = self._get_pool(pool_id)
+                # later commands (delete, resize, list nodes) act on the pool in use
+                self.save_pool_id(pool_id)
+
+        registered_fingerprint = fingerprint
+        if existing is not None and skip_if_exists:
+            found = _pool_metadata(existing).get(
+                POOL_FINGERPRINT_KEY
+            ) or registry.pool_fingerprint(account, pool_id)
+            if found is None:
+                logger.warning(
+                    f"Pool {pool_id} has no configuration fingerprint, re-using it without checking"
+                )
+                registered_fingerprint = None
+            elif found != fingerprint:
+                message = f"Pool {pool_id} was created with a different configuration (image, VM size, mounts or start task)"
+                if on_mismatch == "replace":
+                    logger.warning(f"{message}, replacing it")
+                    self.teardown("pool", [pool_id], wait=True)
+                    registry.forget_pool(account, pool_id)
+                    existing = None
+                elif on_mismatch == "reuse":
+                    logger.warning(f"{message}, re-using it anyway")
+                    registered_fingerprint = found
+                else:
+                    raise ValueError(
+                        f"{message}. Delete it, use another pool name, or pass on_mismatch='replace'"
+                    )
+
+        if (
+            existing is not None
+            and skip_if_exists
+            and existing.task_slots_per_node
+            and existing.task_slots_per_node != num_tasks_per_node
+        ):
+            logger.warning(
+                f"Pool {pool_id} runs {existing.task_slots_per_node} tasks per node, "
+                f"not {num_tasks_per_node}: task slots can only change by deleting the pool"
+            )
+
+        if existing is None or not skip_if_exists:
             logger.warning(
                 "Creating new pool named [bold magenta]{}[/bold magenta]".format(
                     pool_id
@@ -287,66 +473,403 @@ class AzureBatchContainers(object):
                     pool_id
                 ),
             )
+            if auto_scale:
+                self.enable_autoscale(
+                    auto_scale_formula, auto_scale_interval, pool_id=pool_id
+                )
+            else:
+                if existing.enable_auto_scale:
+                    self.disable_autoscale(pool_id=pool_id)
+                if (
+                    existing.target_dedicated_nodes,
+                    existing.target_low_priority_nodes,
+                ) != (pool_dedicated_node_count, pool_low_priority_node_count):
+                    self.resize_pool(
+                        pool_id=pool_id,
+                        dedicated_nodes=pool_dedicated_node_count,
+                        low_pri_nodes=pool_low_priority_node_count,
+                    )
+        if registered_fingerprint:
+            registry.register_pool(
+                account, pool_id, registered_fingerprint, vm_size=pool_vm_size
+            )
 
         # update pool id for jobs
         self.pool_id = pool_id
+        if profile_readiness:
+            self.profile_readiness(pool_id)
 
-    def add_job(self, job_name: str = None):
-        """Add a job to Azure Batch Pool in self.pool_id. Job is specified using config['POOL'] parameters. Job ID is retained to self.job_id attribute."""
+    def batch_insights_start_command(self):
+        """Start task command line and resource files launching batch-insights on every node.
+
+        When the assets were mirrored into the linked storage account (see
+        mirror_start_task_assets), the binary is delivered as a resource file
+        and started directly. Otherwise every node downloads the run script and
+        the binary from GitHub, which is slower and fails when GitHub throttles.
+
+        Returns
+        -------
+        Tuple[str, List[batchmodels.ResourceFile]]
+        """
+
+        platform = self.config["ACR"]["PLATFORM"]
+        if platform not in BATCH_INSIGHTS_BINARIES:
+            raise ValueError(f"Unknown platform selected {platform}")
+        container = self.config["APP_INSIGHTS"].get("ASSETS_CONTAINER", "").strip("'")
 
-        if job_name:
-            self.job_id = job_name
+        if not container:
+            logger.warning(
+                "Every node downloads batch-insights from GitHub in its start task, run mirror_start_task_assets to serve it from your storage account"
+            )
+            if platform == "linux":
+                command_line = "/bin/bash -c 'wget  -O - https://raw.githubusercontent.com/Azure/batch-insights/master/scripts/1.x/run-linux.sh | bash'"
+            else:
+                command_line = 'cmd /c @/"%SystemRoot%\System32\WindowsPowerShell\v1.0\powershell.exe/" -NoProfile -InputFormat None -ExecutionPolicy Bypass -Command /"iex ((New-Object System.Net.WebClient).DownloadString(\'https://raw.githubusercontent.com/Azure/batch-insights/master/scripts/1.x/run-windows.ps1\'))/"'
+            return command_line, None
+
+        binary = BATCH_INSIGHTS_BINARIES[platform]
+        resource_files = [
+            batchmodels.ResourceFile(
+                auto_storage_container_name=container,
+                blob_prefix=binary,
+                file_mode="0755" if platform == "linux" else None,
+            )
+        ]
+        if platform == "linux":
+            # the same launch as the upstream run-linux.sh, minus its download
+            command_line = f"/bin/bash -c 'nohup ./{binary} $AZ_BATCH_INSIGHTS_ARGS > node-stats.log 2>&1 &'"
         else:
-            self.job_id = (
-                "Job-"
-                + self.config["POOL"]["JOB_NAME"].strip("'")
-                + "-"
-                + "{:%Y-%m-%d-%H-%M-%S}".format(datetime.datetime.now())
+            # like run-windows.ps1, a scheduled task keeps it running after the start task exits
+            command_line = (
+                f'cmd /c schtasks /create /f /ru System /sc onstart /tn batchappinsights /tr "'
+                f"%AZ_BATCH_NODE_STARTUP_DIR%\\wd\\{binary} %AZ_BATCH_POOL_ID% %AZ_BATCH_NODE_ID% %APP_INSIGHTS_INSTRUMENTATION_KEY%"
+                f'" && schtasks /run /tn batchappinsights'
+            )
+        return command_line, resource_files
+
+    def start_task_times(self, pool_id: str = None) -> dict:
+        """Seconds each node of a pool spent in its start task, None while it has not finished.
+
+        Nodes only take tasks once the start task succeeded (wait_for_success),
+        so this is the part of pool readiness the start task adds.
+        """
+
+        nodes = self.batch_client.compute_node.list(
+            pool_id or self.pool_id,
+            compute_node_list_options=batchmodels.ComputeNodeListOptions(
+                select="id,startTaskInfo"
+            ),
+        )
+        durations, failed = {}, []
+        for node in nodes:
+            durations[node.id] = node_phases(node_sample(node))["start_task"]
+            info = node.start_task_info
+            if info and info.result == batchmodels.TaskExecutionResult.failure:
+                failed.append(node.id)
+
+        measured = [t for t in durations.values() if t is not None]
+        if measured:
+            logger.info(
+                "Start task on {0}/{1} nodes: median {2:.0f}s, max {3:.0f}s".format(
+                    len(measured),
+                    len(durations),
+                    percentile(measured, 50),
+                    percentile(measured, 100),
+                )
+            )
+        if failed:
+            logger.error(f"Start task failed on nodes {', '.join(failed)}")
+        return durations
+
+    def _get_pool(self, pool_id: str) -> batchmodels.CloudPool:
+        """The pool's state, node targets and metadata, or None if it does not exist."""
+
+        try:
+            return self.batch_client.pool.get(
+                pool_id,
+                pool_get_options=batchmodels.PoolGetOptions(
+                    select="id,state,allocationState,enableAutoScale,targetDedicatedNodes,targetLowPriorityNodes,taskSlotsPerNode,metadata"
+                ),
+            )
+        except batchmodels.BatchErrorException as e:
+            if e.error.code == "PoolNotFound":
+                return None
+            raise
+
+    def save_pool_id(self, pool_id: str):
+        """Set config['POOL']['POOL_ID'] and write it back to self.config_file."""
+
+        self.config["POOL"]["POOL_ID"] = pool_id
+        tmp_path = self.config_file + ".tmp"
+        with open(tmp_path, "w") as conf_file:
+            self.config.write(conf_file)
+        os.replace(tmp_path, self.config_file)
+        logger.info(f"Saved pool {pool_id} to {self.config_file}")
+
+    def find_warm_pool(self, fingerprint: str, registry: StateStore = None) -> str:
+        """Id of an active registered pool with this fingerprint which is not running any tasks."""
+
+        registry = registry or self.state_store or StateStore()
+        account = self.config["BATCH"]["ACCOUNT_NAME"]
+        for pool_id in registry.compatible_pools(account, fingerprint):
+            pool = self._get_pool(pool_id)
+            if pool is None:
+                registry.forget_pool(account, pool_id)
+                continue
+            if pool.state != batchmodels.PoolState.active:
+                continue
+            if (
+                _pool_metadata(pool).get(POOL_FINGERPRINT_KEY, fingerprint)
+                != fingerprint
+            ):
+                continue
+            counts = list(
+                self.batch_client.account.list_pool_node_counts(
+                    account_list_pool_node_counts_options=batchmodels.AccountListPoolNodeCountsOptions(
+                        filter=f"poolId eq '{pool_id}'"
+                    )
+                )
             )
+            if any(
+                nodes is not None and nodes.running
+                for count in counts
+                for nodes in (count.dedicated, count.low_priority)
+            ):
+                continue
+            return pool_id
+        return None
+
+    def autoscale_formula(self) -> str:
+        """Autoscale formula bounded by the node counts and task slots in config['POOL']."""
+
+        return AutoscaleFormula(
+            max_low_pri=int(self.config["POOL"]["LOW_PRI_NODES"]),
+            max_dedicated=int(self.config["POOL"]["DEDICATED_NODES"]),
+            tasks_per_node=int(self.config["POOL"]["TASKS_PER_NODE"]),
+        ).formula()
+
+    def enable_autoscale(
+        self, formula: str = None, interval: int = 5, pool_id: str = None
+    ):
+        """Attach an autoscale formula to an existing pool, by default self.autoscale_formula()."""
+
+        pool_id = pool_id or self.pool_id
+        self.batch_client.pool.enable_auto_scale(
+            pool_id,
+            auto_scale_formula=formula or self.autoscale_formula(),
+            auto_scale_evaluation_interval=evaluation_interval(interval),
+        )
+        logger.info(f"Enabled autoscaling on pool {pool_id}")
+
+    def disable_autoscale(self, pool_id: str = None):
+        """Stop autoscaling a pool, leaving it at its current size for resize_pool."""
+
+        pool_id = pool_id or self.pool_id
+        self.batch_client.pool.disable_auto_scale(pool_id)
+        logger.info(f"Disabled autoscaling on pool {pool_id}")
+
+    def evaluate_autoscale(self, formula: str = None, pool_id: str = None) -> str:
+        """Evaluate a formula against a pool's current samples on the service without applying it."""
+
+        result = self.batch_client.pool.evaluate_auto_scale(
+            pool_id or self.pool_id, formula or self.autoscale_formula()
+        )
+        if result.error:
+            raise ValueError(f"Autoscale formula failed: {result.error.message}")
+        return result.results
+
+    def add_job(self, job_name: str = None):
+        """Add a job to Azure Batch Pool in self.pool_id. Job is specified using config['POOL'] parameters. Job ID is retained to self.job_id attribute."""
+
+        self.job_id = job_name or self.new_job_id()
         job = batch.models.JobAddParameter(
             id=self.job_id, pool_info=batch.models.PoolInformation(pool_id=self.pool_id)
         )
 
         logger.info("Adding job {0} to pool {1}".format(self.job_id, self.pool_id))
-        self.batch_client.job.add(job)
+        try:
+            self.batch_client.job.add(job)
+        except batchmodels.BatchErrorException as e:
+            if e.error.code != "JobExists":
+                raise
+            logger.info(f"Job {self.job_id} already exists, adding tasks to it")
+
+    def new_job_id(self) -> str:
+        """Timestamped id for a new job named after config['POOL']['JOB_NAME']."""
+
+        return (
+            "Job-"
+            + self.config["POOL"]["JOB_NAME"].strip("'")
+            + "-"
+            + "{:%Y-%m-%d-%H-%M-%S}".format(datetime.datetime.now())
+        )
 
     def delete_job(self, job_name: str = None):
         """Deletes a job that already exists in an Azure Batch Pool in self.pool_id. Job is specified using config['POOL'] parameters."""
         self.batch_client.job.delete(job_name)
 
-    def delete_all_tasks(self):
-        """Deletes all tasks in given pool"""
+    def delete_all_tasks(
+        self, wait: bool = False, max_workers: int = 16, timeout: int = 600
+    ) -> dict:
+        """Deletes all jobs (and with them their tasks) in the Batch account.
 
-        jobs = [l for l in self.batch_client.job.list()]
+        Parameters
+        ----------
+        wait : bool, optional
+            Block until every job is actually gone, by default False
+        max_workers : int, optional
+            Number of concurrent delete requests, by default 16
+        timeout : int, optional
+            Seconds to wait for jobs to disappear when wait is set, by default 600
 
-        def try_delete(jid):
-            try:
-                self.batch_client.job.delete(job_id=jid)
-            except Exception as e:
-                print("already gone")
+        Returns
+        -------
+        dict
+            Teardown report, see self.teardown
+        """
 
-        jid_list = [job.as_dict()["id"] for job in jobs]
-        return [try_delete(j_id) for j_id in jid_list]
+        jobs = self.batch_client.job.list(
+            job_list_options=batchmodels.JobListOptions(select="id")
+        )
+        jid_list = [job.id for job in jobs]
+        return self.teardown(
+            "job", jid_list, wait=wait, max_workers=max_workers, timeout=timeout
+        )
 
-    def delete_pool(self, pool_name=None, delete_all=False):
+    def delete_pool(
+        self,
+        pool_name=None,
+        delete_all=False,
+        wait: bool = False,
+        max_workers: int = 16,
+        timeout: int = 1200,
+    ) -> dict:
 
         if delete_all:
             logger.warn("Deleting all pools!")
-            # Iterate over each pool and delete it, then return
-            pool_iterator = self.batch_client.pool.list()
-            pool_names = map(lambda x: x.id, pool_iterator)
-            for pool_name in pool_names:
-                self.batch_client.pool.delete(pool_name)
-                logger.info("Deleting pool: {0}".format(pool_name))
-            return
+            pool_iterator = self.batch_client.pool.list(
+                pool_list_options=batchmodels.PoolListOptions(select="id")
+            )
+            pool_names = [pool.id for pool in pool_iterator]
         else:
             if pool_name is None:
                 pool_name = self.config["POOL"]["POOL_ID"]
-            logger.info("Deleting pool: {0}".format(pool_name))
-        self.batch_client.pool.delete(pool_name)
+            pool_names = [pool_name]
+        report = self.teardown(
+            "pool", pool_names, wait=wait, max_workers=max_workers, timeout=timeout
+        )
+        registry = self.state_store or StateStore()
+        for pool_id in report["deleted"] + report["already_gone"]:
+            registry.forget_pool(self.config["BATCH"]["ACCOUNT_NAME"], pool_id)
+        return report
+
+    def teardown(
+        self,
+        kind: str,
+        resource_ids: List[str],
+        wait: bool = False,
+        max_workers: int = 16,
+        timeout: int = 1200,
+        poll_interval: int = 5,
+    ) -> dict:
+        """Delete jobs or pools concurrently and report what happened to each.
+
+        Parameters
+        ----------
+        kind : str
+            Either "job" or "pool"
+        resource_ids : List[str]
+            Ids of the jobs or pools to delete
+        wait : bool, optional
+            Block until every deleted resource is actually gone, by default False
+        max_workers : int, optional
+            Number of concurrent delete requests, by default 16
+        timeout : int, optional
+            Seconds to wait for resources to disappear when wait is set, by default 1200
+        poll_interval : int, optional
+            Seconds between existence checks when wait is set, by default 5
+
+        Returns
+        -------
+        dict
+            Keys "deleted" and "already_gone" (lists of ids) and "failed" (id to error message).
+        """
+
+        if kind == "job":
+            delete = self.batch_client.job.delete
+            exists = lambda job_id: _job_exists(self.batch_client, job_id)
+        elif kind == "pool":
+            delete = self.batch_client.pool.delete
+            exists = self.batch_client.pool.exists
+        else:
+            raise ValueError(f"Unknown resource kind {kind}, expected job or pool")
+
+        not_found = "{}NotFound".format(kind.capitalize())
+        being_deleted = "{}BeingDeleted".format(kind.capitalize())
+
+        def try_delete(resource_id):
+            try:
+                delete(resource_id)
+                logger.info("Deleting {0}: {1}".format(kind, resource_id))
+                return "deleted", None
+            except batchmodels.BatchErrorException as e:
+                if e.error.code == not_found:
+                    return "already_gone", None
+                if e.error.code == being_deleted:
+                    return "deleted", None
+                return "failed", _batch_error_message(e)
+
+        report = {"deleted": [], "already_gone": [], "failed": {}}
+        with ThreadPoolExecutor(max_workers=max(int(max_workers), 1)) as executor:
+            futures = {
+                executor.submit(try_delete, resource_id): resource_id
+                for resource_id in resource_ids
+            }
+            for future in as_completed(futures):
+                outcome, message = future.result()
+                if outcome == "failed":
+                    report["failed"][futures[future]] = message
+                else:
+                    report[outcome].append(futures[future])
+
+        if wait and report["deleted"]:
+            remaining = list(report["deleted"])
+            deadline = time.monotonic() + timeout
+            logger.info(f"Waiting for {len(remaining)} {kind}s to finish deleting...")
+            with ThreadPoolExecutor(max_workers=max(int(max_workers), 1)) as executor:
+                while remaining and time.monotonic() < deadline:
+                    still_there = list(executor.map(exists, remaining))
+                    remaining = [
+                        resource_id
+                        for resource_id, present in zip(remaining, still_there)
+                        if present
+                    ]
+                    if remaining:
+                        time.sleep(poll_interval)
+            for resource_id in remaining:
+                report["deleted"].remove(resource_id)
+                report["failed"][resource_id] = "still deleting after {}s".format(
+                    timeout
+                )
+
+        for resource_id, message in report["failed"].items():
+            logger.error(f"Could not delete {kind} {resource_id}: {message}")
+        logger.info(
+            "Deleted {0} {1}s, {2} already gone, {3} failed".format(
+                len(report["deleted"]),
+                kind,
+                len(report["already_gone"]),
+                len(report["failed"]),
+            )
+        )
+        return report
 
     def resize_pool(
-        self, pool_id: str = None, dedicated_nodes: int = 0, low_pri_nodes: int = 9
+        self,
+        pool_id: str = None,
+        dedicated_nodes: int = 0,
+        low_pri_nodes: int = 9,
+        profile_readiness: bool = False,
     ):
 
         if pool_id is None:
@@ -362,32 +885,182 @@ class AzureBatchContainers(object):
         self.batch_client.pool.resize(
             pool_id=pool_id, pool_resize_parameter=pool_resize_param
         )
+        if profile_readiness:
+            self.profile_readiness(pool_id)
+
+    def profile_readiness(
+        self, pool_id: str = None, poll_interval: float = 10.0
+    ) -> ReadinessProfiler:
+        """Start a ReadinessProfiler (self.readiness_profiler) on a pool which was just created or resized.
+
+        It samples the pool's new nodes in the background until they are all
+        ready, then logs the time to ready with its allocation, boot, image
+        pull and start task phases and records the profile in the StateStore.
+        The profiler does not keep the process alive, call its finish method to
+        wait for the profile before exiting.
+        """
+
+        self.readiness_profiler = ReadinessProfiler(
+            self, pool_id=pool_id or self.pool_id, poll_interval=poll_interval
+        )
+        self.readiness_profiler.start()
+        return self.readiness_profiler
 
     def list_pools(self):
 
-        return [i.id for i in self.batch_client.pool.list()]
+        pools = self.batch_client.pool.list(
+            pool_list_options=batchmodels.PoolListOptions(select="id")
+        )
+        return [i.id for i in pools]
+
+    def list_tasks(self, job_id, state_filter: str = None, select: str = "id,state"):
+        """List tasks in a job, returning only the fields in select.
+
+        Parameters
+        ----------
+        job_id : str
+            Job to list tasks from
+        state_filter : str, optional
+            OData filter evaluated by the Batch service, e.g. "state ne 'completed'"
+        select : str, optional
+            Comma separated task properties to return, by default "id,state"
+        """
 
-    def list_tasks(self, job_id):
+        self.tasks = self.batch_client.task.list(
+            job_id,
+            task_list_options=batchmodels.TaskListOptions(
+                filter=state_filter, select=select
+            ),
+        )
+        return self.tasks
 
-        self.tasks = batch.task.list(job_id)
+    def copy_logfiles(
+        self,
+        file_path: str = None,
+        output_dir: str = "logs",
+        job_id: str = None,
+        node_info: bool = False,
+        max_workers: int = 8,
+    ) -> dict:
+        """Download a file from every task in a job into output_dir/<job>/<task>/.
+
+        Files are streamed straight to disk by a bounded pool of threads.
+        Partially downloaded files are resumed with a single ranged read, which
+        returns nothing for files that are already complete. Files which
+        started over since they were copied, e.g. because the task was
+        requeued, are copied again from the start.
 
-    def copy_logfiles(self, file_path: str, encoding):
+        Parameters
+        ----------
+        file_path : str, optional
+            File to copy relative to the task directory, by default config['POOL']['STANDARD_OUT_FILE_NAME']
+        output_dir : str, optional
+            Local directory to write logs to, by default "logs"
+        job_id : str, optional
+            Job to copy logs from, by default self.job_id
+        node_info : bool, optional
+            Log the node each task ran on, by default False
+        max_workers : int, optional
+            Number of files to download concurrently, by default 8
 
-        self.tasks = batch.task.list(self.job_id)
-        for task in self.tasks:
+        Returns
+        -------
+        dict
+            Mapping of task id to local file path for every downloaded file.
+        """
 
-            node_id = batch.task.get(self.job_id, task.id).node_info.node_id
-            logger.info("Task: {}".format(task.id))
-            logger.info("Node: {}".format(node_id))
+        job_id = job_id or self.job_id
+        if not file_path:
+            file_path = self.config["POOL"].get("STANDARD_OUT_FILE_NAME", "stdout.txt")
+        select = "id,nodeInfo" if node_info else "id"
 
-            stream = batch.file.get_from_task(self.job_id, task.id, file_path)
+        # tasks still waiting for a node have no output to copy
+        self.tasks = self.list_tasks(
+            job_id, state_filter="state ne 'active'", select=select
+        )
 
-            file_text = _read_stream_as_string(stream, encoding)
-            logger.info("Standard output:")
-            logger.info(file_text)
+        def get_file(task, offset: int):
+            options = None
+            if offset > 0:
+                options = batchmodels.FileGetFromTaskOptions(
+                    ocp_range="bytes={}-".format(offset)
+                )
+            return self.batch_client.file.get_from_task(
+                job_id, task.id, file_path, file_get_from_task_options=options, raw=True
+            )
 
-    def add_task(self, task_command: str, task_name: str, start_dir: str = None):
-        """Add tasks to Azure Batch Job.
+        def download(task):
+            if node_info:
+                node_id = task.node_info.node_id if task.node_info else None
+                logger.info("Task: {0}, Node: {1}".format(task.id, node_id))
+
+            local_path = pathlib.Path(output_dir, job_id, task.id, file_path)
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            offset = local_path.stat().st_size if local_path.exists() else 0
+
+            try:
+                response = get_file(task, offset)
+            except batchmodels.BatchErrorException as e:
+                # the range starts at the end of the file: nothing new, unless
+                # the file started over shorter than the local copy
+                if not offset or getattr(e.response, "status_code", None) != 416:
+                    raise
+                if not _file_restarted(e.response.headers, local_path, offset):
+                    logger.debug(f"{local_path} already downloaded, skipping")
+                    return str(local_path)
+                response = None
+            if response is not None and offset:
+                if _file_restarted(response.response.headers, local_path, offset):
+                    response.response.close()
+                    response = None
+            if response is None:
+                logger.warning(
+                    f"{file_path} of task {task.id} started over, e.g. after the task was requeued, copying it again"
+                )
+                offset = 0
+                response = get_file(task, offset)
+
+            with open(local_path, "ab" if offset else "wb") as local_file:
+                for data in response.output:
+                    local_file.write(data)
+            # mirror the remote modification time, see _file_restarted
+            last_modified = _http_timestamp(
+                response.response.headers.get("Last-Modified")
+            )
+            if last_modified is not None:
+                os.utime(local_path, (time.time(), last_modified))
+            return str(local_path)
+
+        downloaded = {}
+        with ThreadPoolExecutor(max_workers=max(int(max_workers), 1)) as executor:
+            futures = {executor.submit(download, task): task.id for task in self.tasks}
+            for future in as_completed(futures):
+                task_id = futures[future]
+                try:
+                    downloaded[task_id] = future.result()
+                except batchmodels.BatchErrorException as e:
+                    logger.error(
+                        f"Could not copy {file_path} from task {task_id}: {_batch_error_message(e)}"
+                    )
+                except OSError as e:
+                    logger.error(f"Could not copy {file_path} from task {task_id}: {e}")
+
+        logger.info(
+            "Copied {0} from {1} tasks into {2}".format(
+                file_path, len(downloaded), pathlib.Path(output_dir, job_id)
+            )
+        )
+        return downloaded
+
+    def build_task(
+        self,
+        task_command: str,
+        task_name: str,
+        start_dir: str = None,
+        environment: dict = None,
+        image: str = None,
+    ) -> batchmodels.TaskAddParameter:
+        """Build the TaskAddParameter for a task without submitting it.
 
         Parameters
         ----------
@@ -395,7 +1068,14 @@ class AzureBatchContainers(object):
             Task to run on job. This can be any task to run on the current job_id.
         task_name : str
             Name of task.
+        environment : dict, optional
+            Extra environment variables set for the task, by default None
+        image : str, optional
+            Container image to run the task in, see image_ref, by default the configured image
 
+        Returns
+        -------
+        azure.batch.models.TaskAddParameter
         """
         user = batchmodels.UserIdentity(
             auto_user=batchmodels.AutoUserSpecification(
@@ -422,19 +1102,28 @@ class AzureBatchContainers(object):
                 mount = f"/azfileshare/:{start_dir}/logs"
             extra_opts += f" --volume {mount}"
 
-        self.task_id = task_name
         logger.debug(
             "Submitting task {0} to pool {1} with command {2}".format(
                 task_name, self.pool_id, task_command
             )
         )
         logger.debug(f"Extra configuration operations: {extra_opts}")
+        image = self.image_ref(image)
+        if (
+            self.pulled_images is not None
+            and image not in self.pulled_images
+            and image not in self._unpulled_images
+        ):
+            self._unpulled_images.add(image)
+            logger.warning(
+                f"{image} is not pre-pulled on pool {self.pool_id}, tasks using it pull it when they start"
+            )
         task_container_settings = batch.models.TaskContainerSettings(
-            image_name=self.image_name + ":" + self.image_version,
+            image_name=image,
             container_run_options=extra_opts,
         )
-        task = batch.models.TaskAddParameter(
-            id=self.task_id,
+        return batch.models.TaskAddParameter(
+            id=task_name,
             command_line=task_command,
             container_settings=task_container_settings,
             environment_settings=[
@@ -444,46 +1133,493 @@ class AzureBatchContainers(object):
                 batchmodels.EnvironmentSetting(
                     name="SIM_ACCESS_KEY", value=self.access_key
                 ),
+            ]
+            + [
+                batchmodels.EnvironmentSetting(name=name, value=str(value))
+                for name, value in (environment or {}).items()
             ],
             user_identity=user,
         )
 
+    def add_task(
+        self,
+        task_command: str,
+        task_name: str,
+        start_dir: str = None,
+        environment: dict = None,
+        image: str = None,
+    ):
+        """Add tasks to Azure Batch Job.
+
+        Parameters
+        ----------
+        task_command : str
+            Task to run on job. This can be any task to run on the current job_id.
+        task_name : str
+            Name of task.
+        environment : dict, optional
+            Extra environment variables set for the task, by default None
+        image : str, optional
+            Container image to run the task in, by default the configured image
+
+        """
+        self.task_id = task_name
+        task = self.build_task(
+            task_command,
+            task_name,
+            start_dir=start_dir,
+            environment=environment,
+            image=image,
+        )
+
         self.batch_client.task.add(self.job_id, task)
 
-    def wait_for_tasks_to_complete(self, timeout):
+    def add_tasks(
+        self,
+        tasks: Iterable[batchmodels.TaskAddParameter],
+        chunk_size: int = TASK_COLLECTION_LIMIT,
+        max_workers: int = 8,
+        log_summary: bool = True,
+    ) -> dict:
+        """Submit tasks to the current job in bulk using task.add_collection.
+
+        Tasks are grouped into chunks of at most ``chunk_size`` (the service
+        limit is 100 per request) and the chunks are submitted concurrently.
+        tasks is consumed lazily: at most two chunks per worker are held at
+        once, so a generator of any length can be streamed to the service.
+        Tasks which already exist in the job count as submitted, and when
+        self.state_store is set every chunk's outcome is recorded in it.
+
+        Parameters
+        ----------
+        tasks : Iterable[batchmodels.TaskAddParameter]
+            Tasks to submit, e.g. built with self.build_task
+        chunk_size : int, optional
+            Number of tasks per add_collection request, by default 100
+        max_workers : int, optional
+            Number of chunks to submit concurrently, by default 8
+        log_summary : bool, optional
+            Log submission throughput, by default True
+
+        Returns
+        -------
+        dict
+            Mapping of task id to error message for every task the service rejected.
+        """
+
+        chunk_size = min(max(int(chunk_size), 1), TASK_COLLECTION_LIMIT)
+        max_workers = max(int(max_workers), 1)
+        tasks = iter(tasks)
+        chunks = iter(lambda: list(islice(tasks, chunk_size)), [])
+
+        def submit_chunk(chunk) -> dict:
+            try:
+                result = self.batch_client.task.add_collection(self.job_id, chunk)
+            except batchmodels.BatchErrorException as e:
+                # a request is limited to 1 MB, so long commands or environments
+                # can overflow a full chunk: submit each half on its own
+                if e.error and e.error.code == "RequestBodyTooLarge" and len(chunk) > 1:
+                    middle = len(chunk) // 2
+                    return {
+                        **submit_chunk(chunk[:middle]),
+                        **submit_chunk(chunk[middle:]),
+                    }
+                return {task.id: _batch_error_message(e) for task in chunk}
+            return {
+                task_result.task_id: (
+                    task_result.error.message.value
+                    if task_result.error and task_result.error.message
+                    else str(task_result.status)
+                )
+                for task_result in result.value
+                if task_result.status != batchmodels.TaskAddStatus.success
+                # submitted before, e.g. by a run which is being resumed
+                and not (task_result.error and task_result.error.code == "TaskExists")
+            }
+
+        failures = {}
+
+        def collect(done):
+            for future in done:
+                chunk = futures.pop(future)
+                chunk_failures = future.result()
+                failures.update(chunk_failures)
+                self.submitted_tasks += len(chunk) - len(chunk_failures)
+                if self.state_store is not None:
+                    self.state_store.record_tasks(
+                        self.job_id,
+                        [task.id for task in chunk if task.id not in chunk_failures],
+                        chunk_failures,
+                    )
+
+        total = 0
+        futures = {}
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for chunk in chunks:
+                # backpressure: wait for a request to finish before building more chunks
+                if len(futures) >= 2 * max_workers:
+                    done, _ = wait_for_futures(futures, return_when=FIRST_COMPLETED)
+                    collect(done)
+                futures[executor.submit(submit_chunk, chunk)] = chunk
+                total += len(chunk)
+            collect(wait_for_futures(futures).done)
+        elapsed = time.perf_counter() - start_time
+
+        for task_id, message in failures.items():
+            logger.error(f"Failed to submit task {task_id}: {message}")
+        submitted = total - len(failures)
+        (logger.info if log_summary else logger.debug)(
+            "Submitted {0}/{1} tasks in {2:.1f}s ({3:.1f} tasks/sec)".format(
+                submitted, total, elapsed, submitted / max(elapsed, 1e-6)
+            )
+        )
+
+        return failures
+
+    def get_task_counts(self, job_id: str = None) -> batchmodels.TaskCounts:
+        """Aggregated task counts for a job, computed by the Batch service.
+
+        Parameters
+        ----------
+        job_id : str, optional
+            Job to count tasks for, by default self.job_id
+
+        Returns
+        -------
+        azure.batch.models.TaskCounts
+            Counts of active, running, completed, succeeded and failed tasks.
+        """
+
+        counts = self.batch_client.job.get_task_counts(job_id or self.job_id)
+        # newer SDKs wrap the counts together with task slot counts
+        return getattr(counts, "task_counts", counts)
+
+    def tasks_complete(self, counts: batchmodels.TaskCounts = None) -> bool:
+        """Whether every task submitted to self.job_id has reached the completed state.
+
+        Task counts lag behind new submissions, right after add_tasks a job can
+        report no active or running tasks at all. So besides no active or
+        running tasks, as many completed tasks as self.submitted_tasks are
+        required, or else an id-only listing of the incomplete tasks confirms
+        that none is left. The listing is always used when this instance did
+        not submit the tasks itself (self.submitted_tasks is 0).
+
+        Parameters
+        ----------
+        counts : batchmodels.TaskCounts, optional
+            Task counts of the job if already fetched, by default they are fetched
+
+        Returns
+        -------
+        bool
+            True once the job has no incomplete tasks
+        """
+
+        counts = counts or self.get_task_counts()
+        if counts.active + counts.running > 0:
+            return False
+        if self.submitted_tasks and counts.completed >= self.submitted_tasks:
+            return True
+        return not self.list_incomplete_tasks()
+
+    def list_incomplete_tasks(self, job_id: str = None) -> List[str]:
+        """List the ids of tasks in a job which have not reached the completed state."""
+
+        tasks = self.list_tasks(
+            job_id or self.job_id, state_filter="state ne 'completed'", select="id"
+        )
+        return [task.id for task in tasks]
+
+    def wait_for_tasks_to_complete(
+        self,
+        timeout: datetime.timedelta,
+        per_task_detail: bool = False,
+        min_interval: float = 1.0,
+        max_interval: float = 30.0,
+    ):
+        """Block until every task in self.job_id reaches the completed state.
+
+        Polls the job's aggregated task counts rather than listing every task,
+        backing off between polls while nothing changes.
+
+        Parameters
+        ----------
+        timeout : datetime.timedelta
+            Maximum time to wait for tasks to complete
+        per_task_detail : bool, optional
+            Also list the ids of incomplete tasks on each progress update, by default False
+        min_interval : float, optional
+            Seconds between polls while tasks are changing state, by default 1.0
+        max_interval : float, optional
+            Upper bound on seconds between polls when nothing changes, by default 30.0
+        """
 
         timeout_expiration = datetime.datetime.now() + timeout
 
         logger.info(
             "Monitoring all tasks for 'Completed' state, timeout in {}...".format(
                 timeout
-            ),
-            end="",
+            )
         )
 
-        while datetime.datetime.now() < timeout_expiration:
-            print(".", end="")
-            sys.stdout.flush()
-            tasks = self.batch_client.task.list(self.job_id)
-
-            incomplete_tasks = [
-                task for task in tasks if task.state != batchmodels.TaskState.completed
-            ]
-            if not incomplete_tasks:
-                print()
-                return True
-            else:
-                time.sleep(1)
+        for interval in self.poll_task_completion(
+            per_task_detail, min_interval, max_interval
+        ):
+            remaining = (timeout_expiration - datetime.datetime.now()).total_seconds()
+            if remaining <= 0:
+                break
+            time.sleep(min(interval, remaining))
+        else:
+            return True
 
-        print()
         raise RuntimeError(
             "ERROR: Tasks did not reach 'Completed' state within "
             "timeout period of " + str(timeout)
         )
 
+    def wait_for_submission(self):
+        """Block until the background scheduler of batch_main, if any, released every task.
+
+        Raises
+        ------
+        RuntimeError
+            If the scheduler stopped early because reading tasks or polling
+            the job failed, the run can then be resumed
+        """
+
+        if self.scheduler is None:
+            return
+        self.scheduler.join()
+        if self.scheduler.error is not None:
+            raise RuntimeError(
+                f"Task submission to job {self.job_id} stopped after {self.scheduler.submitted} "
+                f"tasks: {self.scheduler.error}"
+            ) from self.scheduler.error
+
+    def tasks_completed(
+        self, profile_readiness: bool = False, app_insights: bool = True
+    ):
+        """Wrap up a batch_main run once its tasks completed: stop the
+        preemption watcher and, when profiling readiness, report node start up times."""
+
+        if self.preemption_watcher is not None:
+            self.preemption_watcher.stop()
+            self.preemption_watcher.join()
+        if self.readiness_profiler is not None:
+            self.readiness_profiler.finish()
+        if profile_readiness:
+            # lists every node of the pool, only worth it when asked for
+            self.image_pull_times()
+            if app_insights:
+                self.start_task_times()
+        logger.info(
+            "Success! All tasks reached the 'Completed' state within the specified timeout period."
+        )
+
+    def poll_task_completion(
+        self,
+        per_task_detail: bool = False,
+        min_interval: float = 1.0,
+        max_interval: float = 30.0,
+    ) -> Iterator[float]:
+        """Poll the job's task counts, logging changes, until every task completed.
+
+        Yields the seconds to wait before the next poll, backing off while
+        nothing changes, and stops once tasks_complete. The caller does the
+        waiting, so the same polling serves blocking and asyncio waits.
+        """
+
+        interval = min_interval
+        last_summary = None
+        while True:
+            counts = self.get_task_counts()
+            summary = (
+                counts.active,
+                counts.running,
+                counts.completed,
+                counts.succeeded,
+                counts.failed,
+            )
+            if summary != last_summary:
+                logger.info(
+                    "Tasks active: {0}, running: {1}, completed: {2} "
+                    "(succeeded: {3}, failed: {4})".format(*summary)
+                )
+                if per_task_detail and counts.active + counts.running > 0:
+                    logger.info(
+                        "Incomplete tasks: {}".format(
+                            ", ".join(self.list_incomplete_tasks())
+                        )
+                    )
+                last_summary = summary
+                interval = min_interval
+            else:
+                interval = min(interval * 1.5, max_interval)
+
+            if self.tasks_complete(counts):
+                return
+            yield interval
+
+    def image_pull_times(self, pool_id: str = None) -> dict:
+        """Seconds each node of a pool took from booting to being ready, which is when it pulls the pool's images.
+
+        Batch pulls a pool's container images (see pool_images) while a node
+        starts, before its start task runs, so this measures the pull time plus
+        a little node agent setup. Nodes which are not ready yet are None.
+        """
+
+        nodes = self.batch_client.compute_node.list(
+            pool_id or self.pool_id,
+            compute_node_list_options=batchmodels.ComputeNodeListOptions(
+                select="id,state,lastBootTime,stateTransitionTime,startTaskInfo"
+            ),
+        )
+        pull_times = {
+            node.id: node_phases(node_sample(node))["image_pull"] for node in nodes
+        }
+
+        measured = [t for t in pull_times.values() if t is not None]
+        if measured:
+            logger.info(
+                "Image pull on {0}/{1} nodes: median {2:.0f}s, max {3:.0f}s for {4}".format(
+                    len(measured),
+                    len(pull_times),
+                    percentile(measured, 50),
+                    percentile(measured, 100),
+                    ", ".join(self.pulled_images or [self.image_ref()]),
+                )
+            )
+        return pull_times
+
+    def pool_task_capacity(self, pool_id: str = None) -> int:
+        """Task slots across the nodes currently allocated to a pool."""
+
+        pool = self.batch_client.pool.get(
+            pool_id or self.pool_id,
+            pool_get_options=batchmodels.PoolGetOptions(
+                select="currentDedicatedNodes,currentLowPriorityNodes,taskSlotsPerNode"
+            ),
+        )
+        nodes = (pool.current_dedicated_nodes or 0) + (
+            pool.current_low_priority_nodes or 0
+        )
+        return nodes * (pool.task_slots_per_node or 1)
+
+    def _task_progress(self) -> tuple:
+
+        counts = self.get_task_counts()
+        return counts.active + counts.running, counts.completed
+
+    def hourly_price(self) -> float:
+        """Hourly price of the pool described in config['POOL']."""
+
+        from get_azure_data import show_hourly_price
+
+        return show_hourly_price(
+            region=self.config["BATCH"]["LOCATION"],
+            machine_sku=self.config["POOL"]["VM_SIZE"],
+            low_pri_nodes=int(self.config["POOL"]["LOW_PRI_NODES"]),
+            dedicated_nodes=int(self.config["POOL"]["DEDICATED_NODES"]),
+            host_os=self.config["ACR"]["PLATFORM"],
+        )
+
+    def run_key(
+        self, command: Union[str, Iterable, None] = None, workdir: str = None
+    ) -> Optional[str]:
+        """Identify a batch_main run by its account, pool, job name, tasks and command.
+
+        Returns None for iterators and generators, which can't be fingerprinted
+        without consuming them, so runs fed by them are never resumed.
+        """
+
+        if is_command_file(command):
+            stat = os.stat(command)
+            command = (os.path.abspath(command), stat.st_size, stat.st_mtime_ns)
+        elif not isinstance(command, (str, list, tuple, type(None))):
+            return None
+        return state_run_key(
+            self.config["BATCH"]["ACCOUNT_NAME"],
+            self.config["POOL"]["POOL_ID"].strip("'"),
+            self.config["POOL"]["JOB_NAME"].strip("'"),
+            self.config["POOL"]["NUM_TASKS"],
+            command,
+            workdir,
+        )
+
+    def resumable_job(self, job_id: str, submitted: int) -> bool:
+        """Whether an unfinished run's job still exists, is active and holds its submitted tasks."""
+
+        try:
+            job = self.batch_client.job.get(
+                job_id, job_get_options=batchmodels.JobGetOptions(select="id,state")
+            )
+        except batchmodels.BatchErrorException as e:
+            if e.error.code != "JobNotFound":
+                raise
+            logger.warning(f"Not resuming: job {job_id} no longer exists")
+            return False
+        if job.state != batchmodels.JobState.active:
+            logger.warning(
+                f"Not resuming: job {job_id} is {getattr(job.state, 'value', job.state)}"
+            )
+            return False
+        counts = self.get_task_counts(job_id)
+        found = counts.active + counts.running + counts.completed
+        if found < submitted:
+            logger.warning(
+                f"Not resuming: job {job_id} holds {found} of the {submitted} tasks recorded for it"
+            )
+            return False
+        return True
+
+    def num_tasks(self) -> int:
+        """config['POOL']['NUM_TASKS'] as an int, or None when it is empty or 0 (no limit)."""
+
+        num_tasks = self.config["POOL"].get("NUM_TASKS", "").strip("'")
+        return int(num_tasks) if num_tasks and int(num_tasks) > 0 else None
+
+    def task_commands(self, command: Union[str, Iterable, None] = None):
+        """Yield a (task_name, command, environment, image) tuple per task, reading command lazily.
+
+        At most config['POOL']['NUM_TASKS'] tasks are produced. Tasks are named
+        after the id given by the command source, or job_number{i}_{JOB_NAME}.
+
+        Parameters
+        ----------
+        command : Union[str, Iterable, None], optional
+            A single command run by every task, a list, iterator or generator of
+            commands, or the path of a .jsonl/.csv file of commands (see
+            command_source), by default "python main.py"
+        """
+
+        job_name = self.config["POOL"]["JOB_NAME"].strip("'")
+        for i, item in enumerate(command_source(command, limit=self.num_tasks())):
+            task_name = item.get("id") or "job_number{0}_{1}".format(i, job_name)
+            yield task_name, item["command"], item.get("env"), item.get("image")
+
+    def iter_tasks(
+        self,
+        command: Union[str, Iterable, None] = None,
+        workdir: str = None,
+        skip: set = None,
+    ):
+        """Lazily build a TaskAddParameter for each command in task_commands, except tasks named in skip."""
+
+        for task_name, run_command, environment, image in self.task_commands(command):
+            if skip and task_name in skip:
+                continue
+            yield self.build_task(
+                run_command,
+                task_name,
+                start_dir=workdir,
+                environment=environment,
+                image=image,
+            )
+
     def batch_main(
         self,
-        command: Union[str, List[str]] = None,
+        command: Union[str, Iterable, None] = None,
         brain_name: str = None,
         wait_for_tasks: bool = False,
         log_iterations: bool = False,
@@ -492,70 +1628,260 @@ class AzureBatchContainers(object):
         wait_time: int = 10,
         delay_next: int = 0,
         app_insights: bool = True,
+        task_detail: bool = False,
+        submit_rate: float = None,
+        submit_burst: int = 1,
+        submit_schedule: List[float] = None,
+        slot_aware: bool = False,
+        max_in_flight: int = None,
+        backlog: int = None,
+        autoscale: bool = False,
+        autoscale_interval: int = 5,
+        watch_preemption: bool = False,
+        max_fallback_dedicated: int = 0,
+        resume: bool = False,
+        resume_max_age: float = RESUME_MAX_AGE_HOURS,
+        state_db: str = None,
+        on_pool_mismatch: str = "refuse",
+        images: List[str] = None,
+        profile_readiness: bool = False,
+        metrics: Union[str, List[str]] = None,
     ):
-        """Hub to run Bonsai scale-sim job. This adds the command as tasks to run on the current job_id. The command pulls config['POOL']['PYTHON_EXEC']."""
+        """Hub to run Bonsai scale-sim job. This adds the command as tasks to run on the current job_id. The command pulls config['POOL']['PYTHON_EXEC'].
+
+        command is read lazily (see task_commands) and tasks are built as they
+        are submitted, so generators and .jsonl/.csv files of any size can be
+        used. Tasks are submitted in bulk unless delay_next, submit_rate or submit_schedule
+        ask for paced submission, which runs in a background SubmissionScheduler
+        (self.scheduler) so this method returns without waiting for it.
+
+        With slot_aware, a SlotAwareScheduler only keeps as many tasks active or
+        running as the pool has task slots (plus backlog queued tasks, by default
+        one node's worth), or max_in_flight when given, and submits more as
+        tasks complete.
+
+        With autoscale, the pool is sized by an autoscale formula (see
+        create_pool) between zero nodes and the configured node counts.
+
+        With watch_preemption, a PreemptionWatcher (self.preemption_watcher)
+        follows preempted low priority nodes and requeued tasks until the job
+        is done, reactivates tasks lost with their node, adds up to
+        max_fallback_dedicated dedicated nodes while preempted nodes are not
+        replaced, and records the preemption rate for later sizing.
+
+        Runs and accepted tasks are recorded in a StateStore (state_db). With
+        resume, a run of the same command, pool and job name which did not get
+        all of its tasks submitted within the last resume_max_age hours is
+        picked up again: only the missing tasks are submitted, into its
+        existing job, provided that job is still active and holds the recorded
+        tasks (see resumable_job). Iterator commands are never resumed.
+
+        on_pool_mismatch is passed to create_pool as on_mismatch, deciding what
+        happens when the existing pool has a different configuration, and
+        images are pre-pulled onto every node next to the configured image.
+        Tasks pick their image with an "image" field in the command source.
+
+        With profile_readiness, a ReadinessProfiler (self.readiness_profiler)
+        records how long the pool's new nodes take to get ready.
+
+        Every phase (price lookup, wait_time, create_pool, add_job, task
+        submission, time until no task is queued) and every Batch API call is
+        timed in self.metrics, which logs a summary and hands the spans to the
+        sinks named in metrics (see metrics.make_sinks).
+        """
 
-        if show_price:
-            vm_prices = show_hourly_price(
-                region=self.config["BATCH"]["LOCATION"],
-                machine_sku=self.config["POOL"]["VM_SIZE"],
-                low_pri_nodes=int(self.config["POOL"]["LOW_PRI_NODES"]),
-                dedicated_nodes=int(self.config["POOL"]["DEDICATED_NODES"]),
-                host_os=self.config["ACR"]["PLATFORM"],
+        main_started = time.perf_counter()
+        self.metrics = Metrics(
+            make_sinks(metrics, self.config),
+            pool_id=self.config["POOL"]["POOL_ID"].strip("'"),
+        )
+        self.batch_client = instrument(self.batch_client, self.metrics)
+
+        self.state_store = StateStore(state_db)
+        key = self.run_key(command, workdir)
+        run = None
+        if resume and key is None:
+            logger.warning(
+                "Not resuming: tasks from an iterator can't be matched to an earlier run"
             )
+        elif resume:
+            run = self.state_store.unfinished_run(key, max_age_hours=resume_max_age)
+        submitted = self.state_store.submitted_task_ids(run["job_id"]) if run else set()
+        if run and not self.resumable_job(run["job_id"], len(submitted)):
+            self.state_store.finish_run(run["job_id"], status=ABANDONED)
+            run, submitted = None, set()
+        if run:
+            job_id = run["job_id"]
+            logger.warning(
+                f"Resuming unfinished run in job {job_id}, {len(submitted)} tasks were already submitted"
+            )
+        else:
+            job_id = self.new_job_id()
+            self.state_store.start_run(
+                # runs without a key get one of their own, which never matches another run
+                key or state_run_key(job_id),
+                self.config["POOL"]["POOL_ID"].strip("'"),
+                job_id,
+            )
+        self.metrics.labels["job_id"] = job_id
+
+        if show_price:
+            with self.metrics.span("price_lookup"):
+                vm_prices = self.hourly_price()
 
             logger.warning(
                 f":moneybag: Hourly cost of Batch Pool: ${vm_prices}. Pausing for {wait_time} seconds before submitting tasks. Press Ctrl-C to cancel job."
             )
-            time.sleep(wait_time)
-
-        self.create_pool(use_fileshare=log_iterations, app_insights=app_insights)
-        self.add_job()
+            with self.metrics.span("wait_time"):
+                time.sleep(wait_time)
+
+        with self.metrics.span("create_pool"):
+            self.create_pool(
+                use_fileshare=log_iterations,
+                app_insights=app_insights,
+                auto_scale=autoscale,
+                auto_scale_interval=autoscale_interval,
+                on_mismatch=on_pool_mismatch,
+                images=images,
+                profile_readiness=profile_readiness,
+            )
+        pool_id = self.config["POOL"]["POOL_ID"].strip("'")
+        if pool_id != self.metrics.labels["pool_id"]:
+            # a warm pool was reused, key the run on it so a rerun resumes it
+            self.metrics.labels["pool_id"] = pool_id
+            self.state_store.move_run(
+                job_id, self.run_key(command, workdir) or state_run_key(job_id), pool_id
+            )
+        with self.metrics.span("add_job"):
+            self.add_job(job_id)
+        self.submitted_tasks = len(submitted)
 
         if not brain_name:
             brain_name = self.config["BONSAI"]["BRAIN_NAME"].strip("'")
 
+        num_tasks = self.num_tasks()
+        known = count_commands(command)
+        if known is not None:
+            num_tasks = min(num_tasks or known, known)
         logger.info(
             "Using batch account {0} to run job {1} with {2} tasks".format(
                 self.config["BATCH"]["ACCOUNT_NAME"],
                 self.config["POOL"]["JOB_NAME"],
-                self.config["POOL"]["NUM_TASKS"],
+                num_tasks if num_tasks is not None else "all",
+            )
+        )
+
+        tasks = self.iter_tasks(command, workdir=workdir, skip=submitted)
+        submission_started = time.perf_counter()
+        submission_done = threading.Event()
+
+        def finish_run(failures: dict):
+            self.metrics.record(
+                "submit_tasks",
+                time.perf_counter() - submission_started,
+                failed_tasks=len(failures),
             )
+            submission_done.set()
+            self.metrics.flush()
+            # runs with failed tasks stay unfinished, so running again retries them
+            if not failures:
+                self.state_store.finish_run(job_id)
+
+        # recorded once every task was submitted and none waits in the active state
+        self.metrics.when(
+            "tasks_running",
+            lambda: submission_done.is_set()
+            and self.get_task_counts(job_id).active == 0,
         )
 
-        for i in range(int(self.config["POOL"]["NUM_TASKS"])):
-            if delay_next > 0:
-                logger.debug(
-                    "Staggering {} seconds between task".format(int(delay_next))
+        if delay_next > 0 and not submit_rate:
+            submit_rate = 1.0 / delay_next
+
+        if slot_aware:
+            slots_per_node = int(self.config["POOL"]["TASKS_PER_NODE"])
+            if backlog is None:
+                # keep one node's worth of tasks queued so new nodes start work at once
+                backlog = slots_per_node
+            if autoscale and not max_in_flight:
+                # an autoscaled pool only grows when tasks are pending, so fill it
+                # up to its maximum size rather than its current one
+                max_in_flight = slots_per_node * (
+                    int(self.config["POOL"]["LOW_PRI_NODES"])
+                    + int(self.config["POOL"]["DEDICATED_NODES"])
                 )
-                time.sleep(int(delay_next))
-
-            if not command:
-                run_command = "python main.py"
-            elif type(command) == list:
-                run_command = command[i]
-            elif type(command) == str:
-                run_command = command
-            else:
-                raise ValueError(f"Unknown command provided {command}")
-            self.add_task(
-                task_command=run_command,
-                task_name="job_number{0}_{1}".format(
-                    i, self.config["POOL"]["JOB_NAME"].strip("'")
+            self.scheduler = SlotAwareScheduler(
+                functools.partial(self.add_tasks, log_summary=False),
+                tasks,
+                progress=self._task_progress,
+                capacity=(
+                    (lambda: int(max_in_flight))
+                    if max_in_flight
+                    else (lambda: self.pool_task_capacity() + backlog)
                 ),
-                start_dir=workdir,
+                total=num_tasks,
+                on_finished=finish_run,
+                submitted=len(submitted),
+            )
+            self.scheduler.start()
+            logger.info(
+                "Keeping {} tasks in flight, pulling more as tasks complete".format(
+                    max_in_flight or "the pool's task slots of"
+                )
+            )
+        elif submit_rate or submit_schedule is not None:
+            # paced submission runs in the background, the process stays alive
+            # until the scheduler has released every task
+            self.scheduler = SubmissionScheduler(
+                functools.partial(self.add_tasks, log_summary=False),
+                tasks,
+                rate=submit_rate,
+                burst=submit_burst,
+                schedule=submit_schedule,
+                on_finished=finish_run,
+                submitted=len(submitted),
             )
+            self.scheduler.start()
+            logger.info(
+                "Submitting tasks in the background{}".format(
+                    f" at {submit_rate:g} tasks/sec" if submit_rate else " on schedule"
+                )
+            )
+        else:
+            failures = self.add_tasks(tasks)
+            if failures:
+                logger.warning(f"{len(failures)} tasks could not be submitted")
+            finish_run(failures)
+
+        if watch_preemption:
+            # like the schedulers this keeps the process alive, until the job is done
+            self.preemption_watcher = PreemptionWatcher(
+                self,
+                max_fallback_dedicated=max_fallback_dedicated,
+                is_done=lambda: (
+                    (self.scheduler is None or not self.scheduler.is_alive())
+                    and self.tasks_complete()
+                ),
+            )
+            self.preemption_watcher.start()
+
+        self.metrics.record("batch_main", time.perf_counter() - main_started)
 
         # Pause execution until tasks reach Completed state.
         if wait_for_tasks:
-            self.wait_for_tasks_to_complete(datetime.timedelta(hours=2))
-            logger.info(
-                "Success! All tasks reached the 'Completed' state within the specified timeout period."
+            self.wait_for_submission()
+            with self.metrics.span("wait_for_tasks"):
+                self.wait_for_tasks_to_complete(
+                    datetime.timedelta(hours=2), per_task_detail=task_detail
+                )
+            self.tasks_completed(
+                profile_readiness=profile_readiness, app_insights=app_insights
             )
         else:
             logger.info(
                 "Submitted all tasks, use self.list_tasks to view currently running tasks."
             )
+        self.metrics.flush()
+        self.metrics.log_summary("Orchestration: ")
 
 
 def _read_stream_as_string(stream, encoding):
@@ -577,6 +1903,191 @@ def _read_stream_as_string(stream, encoding):
     raise RuntimeError("could not write data to stream or decode bytes")
 
 
+def _batch_error_message(error: batchmodels.BatchErrorException) -> str:
+    """Human readable message from a Batch service error."""
+
+    if error.error and error.error.message:
+        return "{0}: {1}".format(error.error.code, error.error.message.value)
+    return str(error)
+
+
+def _http_timestamp(value: str) -> Optional[float]:
+    """Seconds since the epoch of an HTTP date header, None if missing or malformed."""
+
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _file_restarted(headers, local_path: pathlib.Path, local_size: int) -> bool:
+    """Whether a task file was recreated since local_path was partly copied from it.
+
+    A requeued task writes its files anew: the remote file is then shorter than
+    the local copy (the total of a "bytes */<size>" Content-Range), or it was
+    created after the local copy's modification time, which copy_logfiles sets
+    to the remote file's.
+    """
+
+    content_range = headers.get("Content-Range") or ""
+    total = content_range.rpartition("/")[2]
+    if total.isdigit() and int(total) < local_size:
+        return True
+    created = _http_timestamp(headers.get("ocp-creation-time"))
+    return created is not None and created > local_path.stat().st_mtime
+
+
+def pool_fingerprint(pool: batchmodels.PoolAddParameter) -> str:
+    """Digest of the pool settings which decide what runs on its nodes.
+
+    Covers the VM size, image, containers, registries, mounts and start task,
+    but not the pool id, node counts, autoscaling or metadata, which can change
+    without recreating the pool. Task slots per node are left out too: run_tasks
+    derives them from the number of tasks, and a pool with another slot count
+    still runs the same tasks. Secrets are left out.
+    """
+
+    settings = pool.as_dict()
+    for volatile in (
+        "id",
+        "display_name",
+        "task_slots_per_node",
+        "target_dedicated_nodes",
+        "target_low_priority_nodes",
+        "enable_auto_scale",
+        "auto_scale_formula",
+        "auto_scale_evaluation_interval",
+        "resize_timeout",
+        "metadata",
+    ):
+        settings.pop(volatile, None)
+
+    def strip_secrets(value):
+        if isinstance(value, dict):
+            return {
+                key: strip_secrets(item)
+                for key, item in value.items()
+                if key not in ("password", "account_key", "sas_key")
+            }
+        if isinstance(value, list):
+            return [strip_secrets(item) for item in value]
+        return value
+
+    return hashlib.sha1(
+        json.dumps(strip_secrets(settings), sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def _pool_metadata(pool) -> dict:
+
+    return {item.name: item.value for item in (pool.metadata or [])}
+
+
+def _job_exists(batch_client: batch.BatchServiceClient, job_id: str) -> bool:
+    """Job operations have no exists call, so probe with a minimal get."""
+
+    try:
+        batch_client.job.get(
+            job_id, job_get_options=batchmodels.JobGetOptions(select="id")
+        )
+        return True
+    except batchmodels.BatchErrorException as e:
+        if e.error.code == "JobNotFound":
+            return False
+        raise
+
+
+# fire entry points which may be forwarded to a running batch_daemon. run_tasks
+# is not one of them: it prompts, streams logs and runs for as long as the job
+DAEMON_COMMANDS = (
+    "stop_job",
+    "delete_pool",
+    "resize_pool",
+    "list_pool_nodes",
+    "copy_logs",
+    "kill_tasks",
+)
+# arguments of daemon commands which are local paths, sent as absolute paths
+DAEMON_PATH_ARGUMENTS = ("config_file", "output_dir")
+
+# authenticated AzureBatchContainers kept alive across commands, see enable_client_cache
+_client_cache = None
+
+
+def enable_client_cache():
+    """Reuse AzureBatchContainers instances across commands in this process."""
+
+    global _client_cache
+    if _client_cache is None:
+        _client_cache = {}
+
+
+def get_batch_containers(
+    config_file: str = user_config,
+    service_principal: bool = False,
+    workspace: str = None,
+    access_key: str = None,
+) -> AzureBatchContainers:
+    """Create an AzureBatchContainers, or reuse a warm one when caching is enabled.
+
+    Cached instances are keyed on the config file's path and modification time,
+    so editing the config (as run_tasks does) builds a fresh client.
+    """
+
+    if _client_cache is None or not os.path.exists(config_file):
+        return AzureBatchContainers(
+            config_file=config_file,
+            service_principal=service_principal,
+            workspace=workspace,
+            access_key=access_key,
+        )
+
+    key = (
+        os.path.abspath(config_file),
+        os.stat(config_file).st_mtime_ns,
+        service_principal,
+        workspace,
+        access_key,
+    )
+    if key not in _client_cache:
+        for stale_key in [k for k in _client_cache if k[0] == key[0]]:
+            del _client_cache[stale_key]
+        _client_cache[key] = AzureBatchContainers(
+            config_file=config_file,
+            service_principal=service_principal,
+            workspace=workspace,
+            access_key=access_key,
+        )
+    return _client_cache[key]
+
+
+def _daemon_command(func):
+    """Forward a fire entry point to the local batch_daemon when one is running."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if batch_daemon.is_available():
+            bound = inspect.signature(func).bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            # the daemon runs in its own working directory
+            for name in DAEMON_PATH_ARGUMENTS:
+                if isinstance(arguments.get(name), str):
+                    arguments[name] = os.path.abspath(arguments[name])
+            try:
+                # generators and other live objects cannot be sent to the daemon
+                json.dumps(arguments)
+            except TypeError:
+                return func(*args, **kwargs)
+            try:
+                return batch_daemon.call(func.__name__, **arguments)
+            except ConnectionError:
+                logger.debug(f"No daemon reachable, running {func.__name__} locally")
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
 def load_bonsai_env(env_file: str = ".env"):
 
     env_file_exists = os.path.exists(env_file)
@@ -595,7 +2106,7 @@ def load_bonsai_env(env_file: str = ".env"):
 
 
 def run_tasks(
-    task_to_run: Union[str, List[str]] = None,
+    task_to_run: Union[str, Iterable, None] = None,
     workspace: str = None,
     access_key: str = None,
     num_tasks: int = None,
@@ -615,21 +2126,40 @@ def run_tasks(
     wait_time: int = 10,
     time_delay: int = 0,
     app_insights: bool = True,
+    cpu_per_sim: float = 0.5,
+    mem_per_sim: float = 2.0,
+    optimize_mix: bool = False,
+    preemption_rate: float = None,
+    budget: float = None,
+    submit_rate: float = None,
+    max_in_flight: int = None,
+    autoscale: bool = False,
+    autoscale_interval: int = 5,
+    watch_preemption: bool = False,
+    max_fallback_dedicated: int = 0,
+    resume: bool = False,
+    resume_max_age: float = RESUME_MAX_AGE_HOURS,
+    on_pool_mismatch: str = "refuse",
+    prepull_images: List[str] = None,
+    profile_readiness: bool = False,
+    metrics: Union[str, List[str]] = None,
 ):
     """Run simulators in Azure Batch.
 
     Parameters
     ----------
-    task_to_run : Union[str, List[str]], optional
+    task_to_run : Union[str, Iterable, None], optional
         Task(s) to run, by default None, which forces user to enter (a single task)
-        If you want to run distinct tasks provide a List of tasks to run.
-        In the case whena list is provided, note that len(task_to_run) must equal num_tasks.
+        If you want to run distinct tasks provide a list, iterator or generator of
+        tasks, or the path of a .jsonl/.csv file with one task per line, which is
+        read lazily. num_tasks defaults to the length of a list or file and bounds it otherwise.
     workspace : str, optional
         [description], by default None
     access_key : str, optional
         [description], by default None
-    num_tasks : str, mandatory
-        Number of simulators to run as separate tasks
+    num_tasks : str, optional
+        Number of simulators to run as separate tasks, required when it cannot
+        be inferred from task_to_run
     low_pri_nodes : int, optional
         Number of low priority to create in pool, by default 9
     dedicated_nodes : int, optional
@@ -659,9 +2189,56 @@ def run_tasks(
     wait_time : int, optional
         [description], by default 10
     time_delay: int, optional
-        time to delay next task, by default 0
+        time to delay next task, by default 0. Tasks are released in the background
+        at one every time_delay seconds, see submit_rate
     app_insights: bool, optional
         whether to use application_insights to monitor azure batch pools
+    cpu_per_sim: float, optional
+        vCPUs each simulator needs, used to pick a VM size when vm_sku is empty, by default 0.5
+    mem_per_sim: float, optional
+        memory in GiB each simulator needs, used to pick a VM size when vm_sku is empty, by default 2.0
+    optimize_mix: bool, optional
+        replace low_pri_nodes, dedicated_nodes and tasks per node with the mix that
+        maximizes expected running simulators per dollar, by default False
+    preemption_rate: float, optional
+        expected share of low priority capacity lost to preemption when optimizing the mix, by default
+        the rate recorded by earlier runs with watch_preemption for this region and VM size, or 0.1
+    budget: float, optional
+        maximum hourly cost of the pool, implies optimize_mix, by default None
+    submit_rate: float, optional
+        tasks submitted per second from a background scheduler, by default None (all at once)
+    max_in_flight: int, optional
+        keep at most this many tasks active or running, submitting more as tasks complete;
+        0 follows the pool's task slots, by default None (submit every task up front)
+    autoscale: bool, optional
+        grow and shrink the pool with the number of pending tasks, between zero nodes and
+        low_pri_nodes/dedicated_nodes, instead of keeping it at full size, by default False
+    autoscale_interval: int, optional
+        minutes between autoscale evaluations, at least 5, by default 5
+    watch_preemption: bool, optional
+        follow preempted low priority nodes and requeued tasks until the job is done,
+        reactivating tasks lost with their node and recording the preemption rate, by default False
+    max_fallback_dedicated: int, optional
+        dedicated nodes added while preempted nodes are not replaced, implies
+        watch_preemption, by default 0
+    resume: bool, optional
+        when an earlier run of the same tasks, pool and job name stopped before every
+        task was submitted, and its job is still active, submit only the missing tasks
+        into its job, by default False
+    resume_max_age: float, optional
+        only resume runs interrupted within this many hours, by default 24
+    on_pool_mismatch: str, optional
+        when pool_name exists with a different image, VM size, mounts or start task:
+        "refuse" stops, "replace" deletes and recreates it, "reuse" uses it anyway, by default "refuse"
+    prepull_images: List[str], optional
+        more images ("name:version") pulled onto every node next to image_name, so tasks
+        can choose between them with an "image" field in a .jsonl/.csv task_to_run, by default None
+    profile_readiness: bool, optional
+        record how long new nodes take to get ready, split into allocation, boot, image pull
+        and start task, for comparison with `python readiness.py compare`, by default False
+    metrics: Union[str, List[str]], optional
+        sinks for the timings of each phase and Batch API call: jsonl, prometheus and/or
+        appinsights, each optionally followed by ":<path>", e.g. "jsonl,prometheus", by default None
     """
 
     if not os.path.exists(config_file):
@@ -675,13 +2252,17 @@ def run_tasks(
         task_to_run = input(
             "Please enter task to run from container (e.g., python main.py): "
         )
+    known_tasks = count_commands(task_to_run)
+    if not num_tasks:
+        num_tasks = known_tasks
     if not num_tasks:
         num_tasks = input("Number of simulators to run as tasks on Batch: ")
-
-    if type(task_to_run) == List:
-        assert len(task_to_run) == int(
-            num_tasks
-        ), "Number of tasks must equal number of tasks to run"
+    if known_tasks is not None and int(num_tasks) > known_tasks:
+        raise ValueError(
+            f"num_tasks is {num_tasks} but task_to_run only holds {known_tasks} tasks"
+        )
+    if is_command_file(task_to_run):
+        logger.info(f"Reading {num_tasks} tasks lazily from {task_to_run}")
 
     total_nodes = low_pri_nodes + dedicated_nodes
 
@@ -704,33 +2285,101 @@ def run_tasks(
             "What VM Name / SKU do you want to use? (if you don't know leave this empty): "
         )
     if vm_sku.lower() == "none" or vm_sku.lower() == "":
-        if tasks_per_node <= 8:
-            vm_sku = "Standard_E2s_v3"
-        elif tasks_per_node <= 16:
-            vm_sku = "Standard_E8s_v3"
-        elif tasks_per_node <= 32:
-            vm_sku = "Standard_E16s_v3"
-        elif tasks_per_node <= 75:
-            vm_sku = "Standard_E32s_v3"
-        elif tasks_per_node > 75:
-            vm_sku = "Standard_E64s_v3"
-            logger.info(
-                "Running {0} tasks per node, please check if VM Size is compatible".format(
-                    tasks_per_node
-                )
+        try:
+            from get_azure_data import select_vm_sku, sku_catalogue
+
+            selection = select_vm_sku(
+                sku_catalogue(region=config["BATCH"]["LOCATION"], host_os=platform),
+                num_sims=int(num_tasks),
+                cpu_per_sim=cpu_per_sim,
+                mem_per_sim=mem_per_sim,
+                low_pri_fraction=low_pri_nodes / total_nodes,
             )
-        logger.warning(
-            f"Auto-selecting [bold green]{vm_sku}[/bold green] for your pool based on calculated tasks per node.",
-        )
-        if tasks_per_node > 8:
+        except (ImportError, OSError, ValueError, KeyError) as e:
             logger.warning(
-                f"You have asked to run {tasks_per_node} tasks per node! You also did not provide a VM SKU. Based on this we selected {vm_sku} as your VM, which may be costly! Please confirm with [bold magenta]yes[/bold magenta] in the next prompt or choose a different VM. Our calculator https://share.streamlit.io/akzaidi/bonsai-cost-calculator/main/st-azure-pricing.py may be helpful for your calculations.",
+                f"Could not select a VM size from current prices ({e}), falling back to tasks per node"
             )
-            confirm_sku = input(
-                f"Confirm with yes if you want to use {vm_sku} for your pool, or type in a new VM SKU: "
+            selection = None
+
+        if selection:
+            vm_sku = selection["vm_sku"]
+            low_pri_nodes = selection["low_pri_nodes"]
+            dedicated_nodes = selection["dedicated_nodes"]
+            tasks_per_node = selection["tasks_per_node"]
+            total_nodes = low_pri_nodes + dedicated_nodes
+            config["POOL"]["TASKS_PER_NODE"] = str(tasks_per_node)
+            config["POOL"]["LOW_PRI_NODES"] = str(low_pri_nodes)
+            config["POOL"]["DEDICATED_NODES"] = str(dedicated_nodes)
+            logger.warning(
+                f"Auto-selecting [bold green]{vm_sku}[/bold green]: {selection['explanation']}"
             )
-            if confirm_sku.lower() != "yes":
-                vm_sku = confirm_sku
+        else:
+            if tasks_per_node <= 8:
+                vm_sku = "Standard_E2s_v3"
+            elif tasks_per_node <= 16:
+                vm_sku = "Standard_E8s_v3"
+            elif tasks_per_node <= 32:
+                vm_sku = "Standard_E16s_v3"
+            elif tasks_per_node <= 75:
+                vm_sku = "Standard_E32s_v3"
+            elif tasks_per_node > 75:
+                vm_sku = "Standard_E64s_v3"
+                logger.info(
+                    "Running {0} tasks per node, please check if VM Size is compatible".format(
+                        tasks_per_node
+                    )
+                )
+            logger.warning(
+                f"Auto-selecting [bold green]{vm_sku}[/bold green] for your pool based on calculated tasks per node.",
+            )
+            if tasks_per_node > 8:
+                logger.warning(
+                    f"You have asked to run {tasks_per_node} tasks per node! You also did not provide a VM SKU. Based on this we selected {vm_sku} as your VM, which may be costly! Please confirm with [bold magenta]yes[/bold magenta] in the next prompt or choose a different VM. Our calculator https://share.streamlit.io/akzaidi/bonsai-cost-calculator/main/st-azure-pricing.py may be helpful for your calculations.",
+                )
+                confirm_sku = input(
+                    f"Confirm with yes if you want to use {vm_sku} for your pool, or type in a new VM SKU: "
+                )
+                if confirm_sku.lower() != "yes":
+                    vm_sku = confirm_sku
+
+    if optimize_mix or budget is not None:
+        from get_azure_data import get_sku_prices, optimize_node_mix, price_column
+
+        region = config["BATCH"]["LOCATION"]
+        low_prices, dedicated_prices = [
+            get_sku_prices(region, [vm_sku], low_pri=low_pri, host_os=platform)
+            for low_pri in (True, False)
+        ]
+        if low_prices.empty or dedicated_prices.empty:
+            raise ValueError(f"No prices found for {vm_sku} in {region}")
+        if preemption_rate is None:
+            preemption_rate = observed_preemption_rate(region, vm_sku, default=0.1)
+        max_tasks_per_node = min(
+            low_prices["vCPUs"].iloc[0] / cpu_per_sim,
+            low_prices["Memory (GiB)"].iloc[0] / mem_per_sim,
+        )
+        mix = optimize_node_mix(
+            int(num_tasks),
+            low_pri_price=float(low_prices[price_column(low_prices)].iloc[0]),
+            dedicated_price=float(
+                dedicated_prices[price_column(dedicated_prices)].iloc[0]
+            ),
+            preemption_rate=preemption_rate,
+            budget=budget,
+            max_tasks_per_node=max(int(max_tasks_per_node), 1),
+        )
+        low_pri_nodes = mix["low_pri_nodes"]
+        dedicated_nodes = mix["dedicated_nodes"]
+        tasks_per_node = mix["task_slots_per_node"]
+        total_nodes = low_pri_nodes + dedicated_nodes
+        config["POOL"]["TASKS_PER_NODE"] = str(tasks_per_node)
+        config["POOL"]["LOW_PRI_NODES"] = str(low_pri_nodes)
+        config["POOL"]["DEDICATED_NODES"] = str(dedicated_nodes)
+        logger.warning(
+            f"Optimized pool for {preemption_rate:.0%} preemption: {low_pri_nodes} low priority and "
+            f"{dedicated_nodes} dedicated {vm_sku} nodes with {tasks_per_node} task slots each, "
+            f"expecting {mix['expected_running_sims']:g} running simulators for ${mix['hourly_cost']:.2f}/hour"
+        )
 
     config["POOL"]["VM_SIZE"] = vm_sku
     config["POOL"]["TASK_START_DIR"] = workdir
@@ -766,7 +2415,7 @@ def run_tasks(
     with open(config_file, "w") as conf_file:
         config.write(conf_file)
 
-    batch_run = AzureBatchContainers(
+    batch_run = get_batch_containers(
         config_file=config_file,
         service_principal=use_service_principal,
         workspace=workspace,
@@ -778,6 +2427,8 @@ def run_tasks(
         batch_run.config["ACR"]["IMAGE_VERSION"] = image_version
 
     if type(log_iterations) == str:
+        from distutils.util import strtobool
+
         log_iterations = bool(strtobool(log_iterations))
 
     batch_run.batch_main(
@@ -787,18 +2438,38 @@ def run_tasks(
         show_price=show_price,
         wait_time=wait_time,
         delay_next=time_delay,
+        submit_rate=submit_rate,
+        slot_aware=max_in_flight is not None,
+        max_in_flight=max_in_flight,
         app_insights=app_insights,
+        autoscale=autoscale,
+        autoscale_interval=autoscale_interval,
+        watch_preemption=watch_preemption or max_fallback_dedicated > 0,
+        max_fallback_dedicated=max_fallback_dedicated,
+        resume=resume,
+        resume_max_age=resume_max_age,
+        on_pool_mismatch=on_pool_mismatch,
+        images=prepull_images,
+        profile_readiness=profile_readiness,
+        metrics=metrics,
     )
+    if profile_readiness and batch_run.readiness_profiler is not None:
+        batch_run.readiness_profiler.finish()
 
 
+@_daemon_command
 def stop_job(config_file: str = user_config):
 
-    batch_run = AzureBatchContainers(config_file=config_file)
+    batch_run = get_batch_containers(config_file=config_file)
     batch_run.delete_job()
 
 
+@_daemon_command
 def delete_pool(
-    pool_name: str = None, delete_all: bool = False, config_file: str = user_config
+    pool_name: str = None,
+    delete_all: bool = False,
+    config_file: str = user_config,
+    wait: bool = False,
 ):
     """Kill pools for existing resource group in Azure Batch.
 
@@ -810,24 +2481,30 @@ def delete_pool(
         Allows to delete all existing pools in current Resource Group
     config_file : str, optional
         Location of configuration file containing ACR and Batch parameters, by default user_config
+    wait : bool, optional
+        Block until the pools are actually gone, by default False
+
+    Returns
+    -------
+    dict
+        Teardown report with the deleted, already gone and failed pools
     """
 
-    batch_run = AzureBatchContainers(config_file=config_file)
+    batch_run = get_batch_containers(config_file=config_file)
 
     if delete_all is True:
-        batch_run.delete_pool(delete_all=delete_all)
-        return
-
-    if pool_name is None:
-        batch_run.delete_pool()
-    else:
-        batch_run.delete_pool(pool_name=pool_name)
+        return batch_run.delete_pool(delete_all=delete_all, wait=wait)
 
-    return False
+    return batch_run.delete_pool(pool_name=pool_name, wait=wait)
 
 
+@_daemon_command
 def resize_pool(
-    pool_name: str = None, low_pri_nodes: int = None, dedicated_nodes: int = None
+    pool_name: str = None,
+    low_pri_nodes: int = None,
+    dedicated_nodes: int = None,
+    profile_readiness: bool = False,
+    config_file: str = user_config,
 ):
     """Resize pool
 
@@ -839,12 +2516,21 @@ def resize_pool(
         [description], by default None
     dedicated_nodes : int, optional
         [description], by default None
+    profile_readiness : bool, optional
+        record how long the new nodes take to get ready, by default False
+    config_file : str, optional
+        config file of the pool, by default user_config
     """
 
-    batch_run = AzureBatchContainers(config_file=user_config)
+    batch_run = get_batch_containers(config_file=config_file)
     batch_run.resize_pool(
-        pool_name, low_pri_nodes=low_pri_nodes, dedicated_nodes=dedicated_nodes
+        pool_name,
+        low_pri_nodes=low_pri_nodes,
+        dedicated_nodes=dedicated_nodes,
+        profile_readiness=profile_readiness,
     )
+    if profile_readiness and batch_run.readiness_profiler is not None:
+        batch_run.readiness_profiler.finish()
 
 
 def upload_files(directory: str, config_file: str = user_config):
@@ -858,14 +2544,17 @@ def upload_files(directory: str, config_file: str = user_config):
         config file containing storage keys, by default 'newconf.ini'
     """
 
+    import xfer_utils
+
     context = xfer_utils.create_context(config_file=config_file, local_path=directory)
 
     xfer_utils.start_uploader(context, directory)
 
 
+@_daemon_command
 def list_pool_nodes(config_file: str = user_config):
 
-    batch_pool = AzureBatchContainers(config_file=config_file)
+    batch_pool = get_batch_containers(config_file=config_file)
     pool_id = batch_pool.config["POOL"]["POOL_ID"].strip("'")
 
     pc = batch_pool.batch_client.account.list_pool_node_counts(
@@ -880,15 +2569,124 @@ def list_pool_nodes(config_file: str = user_config):
         raise RuntimeError("pool {} does not exist".format(pool_id))
 
 
-def kill_tasks(config_file: str = user_config):
+def pull_times(config_file: str = user_config):
+    """Seconds each node of the configured pool took to pull its images."""
+
+    batch_pool = get_batch_containers(config_file=config_file)
+    return batch_pool.image_pull_times(batch_pool.config["POOL"]["POOL_ID"].strip("'"))
+
+
+def start_task_times(config_file: str = user_config):
+    """Seconds each node of the configured pool spent in its start task."""
 
-    batch_pool = AzureBatchContainers(config_file=config_file)
-    batch_pool.delete_all_tasks()
+    batch_pool = get_batch_containers(config_file=config_file)
+    return batch_pool.start_task_times(batch_pool.config["POOL"]["POOL_ID"].strip("'"))
+
+
+def mirror_start_task_assets(
+    config_file: str = user_config, container: str = START_TASK_ASSETS_CONTAINER
+):
+    """Copy the batch-insights binary into the linked storage account once, for every later pool's start task.
+
+    Downloads BATCH_INSIGHTS_DOWNLOAD_URL for the configured platform, uploads
+    it into container and records the container as ASSETS_CONTAINER under
+    APP_INSIGHTS in config_file. Pools created afterwards with app_insights get
+    the binary as a resource file instead of downloading it from GitHub on
+    every node.
+
+    Parameters
+    ----------
+    config_file : str, optional
+        config file with the STORAGE keys and the APP_INSIGHTS section, by default 'newconf.ini'
+    container : str, optional
+        blob container the assets are uploaded into, by default "batch-insights"
+    """
+
+    import tempfile
+    import urllib.request
+
+    import xfer_utils
+
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    platform = config["ACR"]["PLATFORM"]
+    if platform not in BATCH_INSIGHTS_BINARIES:
+        raise ValueError(f"Unknown platform selected {platform}")
+    url = config["APP_INSIGHTS"]["BATCH_INSIGHTS_DOWNLOAD_URL"].strip("'")
+    if platform == "windows" and not url.endswith(".exe"):
+        url += ".exe"
+
+    with tempfile.TemporaryDirectory() as local_dir:
+        binary = os.path.join(local_dir, BATCH_INSIGHTS_BINARIES[platform])
+        logger.info(f"Downloading {url}")
+        urllib.request.urlretrieve(url, binary)
+        context = xfer_utils.create_context(
+            config_file=config_file, local_path=local_dir
+        )
+        xfer_utils.start_uploader(context, container)
+
+    config["APP_INSIGHTS"]["ASSETS_CONTAINER"] = container
+    with open(config_file, "w") as conf_file:
+        config.write(conf_file)
+    logger.info(
+        f"Mirrored batch-insights into container {container}, new pools start it from there"
+    )
+    return container
+
+
+def preemption_stats():
+    """Preemption rates recorded by watch_preemption, per region and VM size."""
+
+    from preemption import load_preemption_stats
+
+    return {
+        key: dict(
+            entry, rate=entry["preempted_samples"] / max(entry["node_samples"], 1)
+        )
+        for key, entry in load_preemption_stats().items()
+    }
+
+
+@_daemon_command
+def copy_logs(
+    job_id: str,
+    file_path: str = None,
+    output_dir: str = "logs",
+    node_info: bool = False,
+    config_file: str = user_config,
+):
+    """Download a file (stdout by default) from every task of a job.
+
+    Parameters
+    ----------
+    job_id : str
+        Job to copy task files from
+    file_path : str, optional
+        File to copy relative to the task directory, by default config['POOL']['STANDARD_OUT_FILE_NAME']
+    output_dir : str, optional
+        Local directory files are written to as <job>/<task>/<file>, by default "logs"
+    node_info : bool, optional
+        Log the node each task ran on, by default False
+    config_file : str, optional
+        Location of configuration file containing ACR and Batch parameters, by default user_config
+    """
+
+    batch_run = get_batch_containers(config_file=config_file)
+    return batch_run.copy_logfiles(
+        file_path=file_path, output_dir=output_dir, job_id=job_id, node_info=node_info
+    )
+
+
+@_daemon_command
+def kill_tasks(config_file: str = user_config, wait: bool = False):
+
+    batch_pool = get_batch_containers(config_file=config_file)
+    return batch_pool.delete_all_tasks(wait=wait)
 
 
 def pool_statistics(config_file: str = user_config):
 
-    batch_pool = AzureBatchContainers(config_file=config_file)
+    batch_pool = get_batch_containers(config_file=config_file)
 
 
 def run_sims_connect(
@@ -923,6 +2721,8 @@ def run_sims_connect(
         brain_list_cmd = f"bonsai brain version list -n {brain_name} -o json"
         logger.debug(brain_list_cmd)
         brain_list = json.loads(subprocess.check_output(brain_list_cmd.split()))
+        import pandas as pd
+
         brain_df = pd.DataFrame(brain_list["value"])
         if int(brain_version) not in brain_df["version"].values:
             logger.warn(
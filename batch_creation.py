@@ -11,7 +11,6 @@ import re
 from typing import Dict, Union
 
 import fire
-from azure.cli.core import get_default_cli
 from error_handles import *
 
 from rich import print
@@ -25,11 +24,6 @@ logging.basicConfig(
     handlers=[RichHandler(markup=True)],
 )
 
-for name in logging.Logger.manager.loggerDict.keys():
-    if "azure" in name:
-        logging.getLogger(name).setLevel(logging.WARNING)
-        logging.propagate = True
-
 logger = logging.getLogger("batch_creation")
 
 default_config = os.path.join("configs", "config.ini")
@@ -51,6 +45,13 @@ def azure_cli_run(cmd: str) -> Union[Dict, bool]:
         If sterror occurs due to azure CLI command
     """
 
+    # azure.cli.core is slow to import, so only load it once a CLI command runs
+    from azure.cli.core import get_default_cli
+
+    for name in list(logging.Logger.manager.loggerDict.keys()):
+        if "azure" in name:
+            logging.getLogger(name).setLevel(logging.WARNING)
+
     args = cmd.split()
     cli = get_default_cli()
     cli.invoke(args)
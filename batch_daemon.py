@@ -0,0 +1,259 @@
+#! /usr/bin/env python
+"""Long-running local daemon which keeps authenticated Batch clients warm.
+
+Start it once and every ``batch_containers.py`` command sends its arguments
+to the daemon over a Unix socket instead of re-parsing the config,
+re-authenticating and opening new connections:
+
+    python batch_daemon.py serve &
+    python batch_containers.py list_pool_nodes   # answered by the daemon
+    python batch_daemon.py stop
+
+When no daemon is listening the commands run in-process as before.
+"""
+
+import io
+import json
+import logging
+import os
+import pathlib
+import socket
+import sys
+import threading
+import time
+
+import fire
+
+logger = logging.getLogger("batch_daemon")
+
+DEFAULT_SOCKET = os.path.join(str(pathlib.Path.home()), ".bonsai-batch", "daemon.sock")
+
+# seconds a client waits for the daemon to answer, see call
+CALL_TIMEOUT = 3600.0
+# seconds the daemon waits for a connected client to send its request
+REQUEST_TIMEOUT = 10.0
+
+# set inside the daemon process so commands run locally instead of forwarding
+IN_DAEMON = False
+
+
+def socket_path() -> str:
+    """Socket the daemon listens on, overridable with BONSAI_BATCH_DAEMON_SOCKET."""
+
+    return os.environ.get("BONSAI_BATCH_DAEMON_SOCKET", DEFAULT_SOCKET)
+
+
+def is_available(path: str = None) -> bool:
+    """Whether commands should be forwarded to a daemon."""
+
+    if IN_DAEMON or not hasattr(socket, "AF_UNIX"):
+        return False
+    if os.environ.get("BONSAI_BATCH_NO_DAEMON"):
+        return False
+    return os.path.exists(path or socket_path())
+
+
+def _send(request: dict, path: str = None, timeout: float = None) -> dict:
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(path or socket_path())
+        conn.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with conn.makefile("rb") as reader:
+            line = reader.readline()
+    if not line:
+        raise ConnectionError("daemon closed the connection without replying")
+    return json.loads(line)
+
+
+def call(command: str, path: str = None, timeout: float = None, **kwargs):
+    """Run a batch_containers command in the daemon and return its result.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Seconds to wait for the result, by default BONSAI_BATCH_DAEMON_TIMEOUT
+        or CALL_TIMEOUT
+
+    Raises
+    ------
+    ConnectionError
+        If no daemon is listening on the socket
+    TimeoutError
+        If the daemon did not answer in time. The command may still be running
+        there, so it is not retried locally
+    RuntimeError
+        If the command raised inside the daemon
+    """
+
+    if timeout is None:
+        timeout = float(os.environ.get("BONSAI_BATCH_DAEMON_TIMEOUT", CALL_TIMEOUT))
+    try:
+        response = _send(
+            {"command": command, "kwargs": kwargs}, path=path, timeout=timeout
+        )
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        raise ConnectionError(f"no daemon listening on {path or socket_path()}") from e
+    except socket.timeout as e:
+        raise TimeoutError(
+            f"{command} did not finish in the daemon within {timeout}s"
+        ) from e
+    if not response["ok"]:
+        raise RuntimeError(f"{command} failed in daemon: {response['error']}")
+    return response["result"]
+
+
+def _handle(request: dict) -> dict:
+
+    import batch_containers
+
+    command = request.get("command")
+    if command == "ping":
+        return {"ok": True, "result": "pong"}
+    if command not in batch_containers.DAEMON_COMMANDS:
+        return {"ok": False, "error": f"unknown command {command}"}
+
+    started = time.perf_counter()
+    try:
+        result = getattr(batch_containers, command)(**request.get("kwargs", {}))
+    except EOFError:
+        return {
+            "ok": False,
+            "error": "command needs interactive input, pass every argument on the command line",
+        }
+    except Exception as e:
+        logger.exception(f"{command} failed")
+        return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    logger.info(f"{command} finished in {time.perf_counter() - started:.2f}s")
+    return {"ok": True, "result": result}
+
+
+def _reply(conn: socket.socket, request: dict):
+    """Run a request on its own thread and send the response back."""
+
+    with conn:
+        response = _handle(request)
+        try:
+            conn.sendall(json.dumps(response, default=str).encode("utf-8") + b"\n")
+        except OSError as e:
+            logger.warning(f"Could not reply to {request.get('command')}: {e}")
+
+
+def _read_request(conn: socket.socket) -> dict:
+    """Read one JSON request line from a client.
+
+    Raises
+    ------
+    ValueError
+        If the client sent something other than a JSON object
+    """
+
+    conn.settimeout(REQUEST_TIMEOUT)
+    with conn.makefile("rb") as reader:
+        line = reader.readline()
+    conn.settimeout(None)
+    request = json.loads(line or "{}")
+    if not isinstance(request, dict):
+        raise ValueError(f"expected a JSON object, got {type(request).__name__}")
+    return request
+
+
+def serve(path: str = None, idle_timeout: int = None):
+    """Run the daemon in the foreground until stopped.
+
+    Each request runs on its own thread, so a long copy_logs or delete_pool
+    does not hold up other commands.
+
+    Parameters
+    ----------
+    path : str, optional
+        Unix socket to listen on, by default ~/.bonsai-batch/daemon.sock
+    idle_timeout : int, optional
+        Exit after this many seconds without a request, by default None (never)
+    """
+
+    global IN_DAEMON
+
+    import batch_containers
+
+    path = path or socket_path()
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    if os.path.exists(path):
+        try:
+            _send({"command": "ping"}, path=path, timeout=1)
+            raise RuntimeError(f"a daemon is already listening on {path}")
+        except (ConnectionRefusedError, socket.timeout):
+            os.remove(path)
+
+    IN_DAEMON = True
+    # batch_containers imports this file as its own module when the daemon is
+    # started as a script, so commands would otherwise forward to this socket
+    os.environ["BONSAI_BATCH_NO_DAEMON"] = "1"
+    batch_containers.enable_client_cache()
+    # commands must never block waiting for a terminal the daemon does not have
+    sys.stdin = io.StringIO("")
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen()
+    server.settimeout(idle_timeout)
+    logger.info(f"Listening on {path}")
+
+    workers = []
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                workers = [worker for worker in workers if worker.is_alive()]
+                if workers:
+                    continue
+                logger.info(f"No requests for {idle_timeout}s, exiting")
+                break
+            try:
+                request = _read_request(conn)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring malformed request: {e}")
+                with conn:
+                    response = {"ok": False, "error": f"malformed request: {e}"}
+                    try:
+                        conn.sendall(json.dumps(response).encode("utf-8") + b"\n")
+                    except OSError:
+                        pass
+                continue
+            if request.get("command") == "shutdown":
+                with conn:
+                    conn.sendall(b'{"ok": true, "result": "stopping"}\n')
+                break
+            worker = threading.Thread(target=_reply, args=(conn, request))
+            worker.start()
+            workers = [worker for worker in workers if worker.is_alive()]
+            workers.append(worker)
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+        for worker in workers:
+            worker.join()
+
+
+def stop(path: str = None):
+    """Stop a running daemon."""
+
+    return _send({"command": "shutdown"}, path=path)["result"]
+
+
+def status(path: str = None):
+    """Report whether a daemon is listening."""
+
+    try:
+        _send({"command": "ping"}, path=path, timeout=1)
+        return f"running on {path or socket_path()}"
+    except (FileNotFoundError, ConnectionRefusedError, socket.timeout):
+        return "not running"
+
+
+if __name__ == "__main__":
+
+    fire.Fire({"serve": serve, "stop": stop, "status": status})
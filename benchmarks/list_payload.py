@@ -0,0 +1,262 @@
+#! /usr/bin/env python
+"""Count the bytes Batch list calls transfer with and without $select and $filter.
+
+A local fake Batch service answers task, job and pool listings the way the
+service does: pages of at most 1000 items, only the properties named in
+$select, and only the items matching a simple $filter. The real Batch SDK
+client is pointed at it, so each listing is measured end to end, including
+deserialization:
+
+    python benchmarks/list_payload.py run --num_tasks 10000 --incomplete 0.1
+"""
+
+import base64
+import json
+import pathlib
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import azure.batch.models as batchmodels
+import fire
+from azure.batch import BatchServiceClient
+from azure.batch.batch_auth import SharedKeyCredentials
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from batch_containers import AzureBatchContainers
+
+PAGE_SIZE = 1000
+JOB_ID = "benchmark-job"
+
+
+def _task(i: int, completed: bool) -> dict:
+    """A task as returned by the service, with the properties of a typical run_tasks task."""
+
+    return {
+        "id": f"task-{i:06d}",
+        "url": f"https://account.region.batch.azure.com/jobs/{JOB_ID}/tasks/task-{i:06d}",
+        "eTag": "0x8D9AE1E4F1E6C7B",
+        "creationTime": "2026-01-01T00:00:00Z",
+        "lastModified": "2026-01-01T00:00:00Z",
+        "state": "completed" if completed else "active",
+        "stateTransitionTime": "2026-01-01T00:10:00Z",
+        "commandLine": f"python main.py --log-iterations --sim-name scenario{i}",
+        "containerSettings": {
+            "imageName": "myregistry.azurecr.io/sim:latest",
+            "containerRunOptions": "--rm --workdir /src",
+        },
+        "environmentSettings": [
+            {"name": "SIM_WORKSPACE", "value": "00000000-0000-0000-0000-000000000000"},
+            {"name": "SIM_ACCESS_KEY", "value": "x" * 64},
+            {"name": "BONSAI_BRAIN", "value": "cartpole"},
+        ],
+        "userIdentity": {"autoUser": {"scope": "task", "elevationLevel": "admin"}},
+        "constraints": {
+            "maxWallClockTime": "P10675199DT2H48M5.4775807S",
+            "retentionTime": "P7D",
+            "maxTaskRetryCount": 0,
+        },
+        "executionInfo": {
+            "startTime": "2026-01-01T00:01:00Z",
+            "endTime": "2026-01-01T00:10:00Z" if completed else None,
+            "exitCode": 0 if completed else None,
+            "retryCount": 0,
+            "requeueCount": 0,
+            "result": "success" if completed else None,
+        },
+        "nodeInfo": {
+            "affinityId": "TVM:tvmps_0000000000000000000000000000000000000000000000000000000000000000_d",
+            "nodeUrl": "https://account.region.batch.azure.com/pools/pool/nodes/tvmps_0",
+            "poolId": "pool",
+            "nodeId": "tvmps_0",
+            "taskRootDirectory": f"workitems/{JOB_ID}/job-1/task-{i:06d}",
+        },
+    }
+
+
+def _resource(kind: str, i: int) -> dict:
+    """A job or pool as returned by the service."""
+
+    return {
+        "id": f"{kind}-{i:04d}",
+        "url": f"https://account.region.batch.azure.com/{kind}s/{kind}-{i:04d}",
+        "eTag": "0x8D9AE1E4F1E6C7B",
+        "creationTime": "2026-01-01T00:00:00Z",
+        "lastModified": "2026-01-01T00:00:00Z",
+        "state": "active",
+        "stateTransitionTime": "2026-01-01T00:00:00Z",
+        "poolInfo": {"poolId": "pool"},
+        "vmSize": "standard_e2s_v3",
+        "taskSlotsPerNode": 4,
+        "metadata": [{"name": "bonsai-batch-fingerprint", "value": "f" * 64}],
+        "startTask": {
+            "commandLine": "/bin/bash -c 'wget -O - https://example.org/batch-insights | bash'",
+            "userIdentity": {"autoUser": {"scope": "pool", "elevationLevel": "admin"}},
+            "waitForSuccess": True,
+        },
+    }
+
+
+def _matches(item: dict, odata_filter: str) -> bool:
+    """Evaluate "<property> eq|ne '<value>'", the filters this repo sends."""
+
+    if not odata_filter:
+        return True
+    name, operator, value = odata_filter.split(" ", 2)
+    equal = item.get(name) == value.strip("'")
+    return equal if operator == "eq" else not equal
+
+
+class FakeBatchService(ThreadingHTTPServer):
+    def __init__(
+        self, num_tasks: int, incomplete: float, num_jobs: int, num_pools: int
+    ):
+        """Local HTTP server answering Batch list calls, counting the bytes it sends."""
+
+        super().__init__(("127.0.0.1", 0), _FakeBatchHandler)
+        completed = int(num_tasks * (1 - incomplete))
+        self.collections = {
+            f"/jobs/{JOB_ID}/tasks": [
+                _task(i, i < completed) for i in range(num_tasks)
+            ],
+            "/jobs": [_resource("job", i) for i in range(num_jobs)],
+            "/pools": [_resource("pool", i) for i in range(num_pools)],
+        }
+        self.bytes_sent = 0
+        self.requests = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def reset(self):
+
+        self.bytes_sent = 0
+        self.requests = 0
+
+
+class _FakeBatchHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        items = [
+            item
+            for item in self.server.collections.get(url.path, [])
+            if _matches(item, query.get("$filter"))
+        ]
+        skip = int(query.pop("skip", 0))
+        page_size = min(int(query.get("maxresults", PAGE_SIZE)), PAGE_SIZE)
+        page = items[skip : skip + page_size]
+        if "$select" in query:
+            names = query["$select"].split(",")
+            page = [
+                {name: item[name] for name in names if name in item} for item in page
+            ]
+
+        body = {"value": page}
+        if skip + page_size < len(items):
+            query["skip"] = skip + page_size
+            body["odata.nextLink"] = f"{self.server.url}{url.path}?{urlencode(query)}"
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json;odata=minimalmetadata")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.bytes_sent += len(payload)
+        self.server.requests += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _measure(service: FakeBatchService, func) -> dict:
+
+    service.reset()
+    start = time.perf_counter()
+    items = len(func())
+    return {
+        "items": items,
+        "requests": service.requests,
+        "kilobytes": round(service.bytes_sent / 1024, 1),
+        "ms": round((time.perf_counter() - start) * 1000, 1),
+    }
+
+
+def run(
+    num_tasks: int = 10000,
+    incomplete: float = 0.1,
+    num_jobs: int = 200,
+    num_pools: int = 50,
+):
+    """Compare full listings with the selected and filtered ones batch_containers makes.
+
+    Parameters
+    ----------
+    num_tasks : int, optional
+        Tasks in the benchmark job, by default 10000
+    incomplete : float, optional
+        Share of those tasks which have not completed yet, by default 0.1
+    num_jobs : int, optional
+        Jobs in the account, listed by delete_all_tasks, by default 200
+    num_pools : int, optional
+        Pools in the account, listed by list_pools, by default 50
+    """
+
+    service = FakeBatchService(
+        int(num_tasks), float(incomplete), int(num_jobs), int(num_pools)
+    )
+    threading.Thread(target=service.serve_forever, daemon=True).start()
+    client = BatchServiceClient(
+        SharedKeyCredentials("account", base64.b64encode(b"key").decode()),
+        batch_url=service.url,
+    )
+    batch = AzureBatchContainers.__new__(AzureBatchContainers)
+    batch.batch_client = client
+
+    # the same results fetched as before, in full, and as batch_containers fetches them now
+    cases = {
+        "incomplete tasks": (
+            lambda: [
+                t.id for t in client.task.list(JOB_ID) if t.state.value != "completed"
+            ],
+            lambda: batch.list_incomplete_tasks(JOB_ID),
+        ),
+        "job ids": (
+            lambda: [job.id for job in client.job.list()],
+            lambda: [
+                job.id
+                for job in batch.batch_client.job.list(
+                    job_list_options=batchmodels.JobListOptions(select="id")
+                )
+            ],
+        ),
+        "pool ids": (
+            lambda: [pool.id for pool in client.pool.list()],
+            batch.list_pools,
+        ),
+    }
+
+    results = {}
+    try:
+        for name, (full, selected) in cases.items():
+            before, after = _measure(service, full), _measure(service, selected)
+            results[name] = {"full": before, "selected": after}
+            print(
+                f"{name:<18} full: {before['kilobytes']:>9.1f} KiB {before['ms']:>8.1f} ms  "
+                f"selected: {after['kilobytes']:>9.1f} KiB {after['ms']:>8.1f} ms  "
+                f"({before['kilobytes'] / max(after['kilobytes'], 0.1):.0f}x fewer bytes)"
+            )
+    finally:
+        service.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+
+    fire.Fire({"run": run})
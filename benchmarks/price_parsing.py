@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+"""Compare full-table and targeted parsing of azureprice.net pages.
+
+Benchmarks run against HTML fixtures saved in benchmarks/fixtures so results
+do not depend on the network:
+
+    python benchmarks/price_parsing.py save_fixture --region westus
+    python benchmarks/price_parsing.py run --vm_names "['Standard_E2s_v3']"
+
+When no fixture has been saved a synthetic page with the same layout is used.
+"""
+
+import pathlib
+import statistics
+import sys
+import time
+
+import fire
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from get_azure_data import _open_price_page, parse_prices, parse_table
+
+FIXTURE_DIR = REPO_ROOT / "benchmarks" / "fixtures"
+
+
+def save_fixture(region: str = "westus", low_pri: bool = True):
+    """Download an azureprice.net page into benchmarks/fixtures."""
+
+    tier = "low" if low_pri else "standard"
+    fixture = FIXTURE_DIR / f"azureprice-{region}-{tier}.html"
+    FIXTURE_DIR.mkdir(parents=True, exist_ok=True)
+    with _open_price_page(region, low_pri) as html:
+        fixture.write_bytes(html.read())
+    return str(fixture)
+
+
+def synthetic_page(num_rows: int = 1000) -> str:
+    """Price page with the same table layout as azureprice.net."""
+
+    header = "".join(
+        f"<th>{name}</th>"
+        for name in [
+            "VM Name",
+            "vCPUs",
+            "Memory (GiB)",
+            "Linux price",
+            "Windows price",
+            "Best region",
+            "Alternatives",
+        ]
+    )
+    rows = "".join(
+        f"<tr><td>Standard_S{i}_v1</td><td>{1 + i % 64}</td><td>{2 + i % 256}</td>"
+        f"<td>{0.01 * (i + 1):.4f}</td><td>{0.02 * (i + 1):.4f}</td>"
+        f"<td>eastus</td><td>...</td></tr>"
+        for i in range(num_rows)
+    )
+    return (
+        f"<html><body><table><thead><tr>{header}</tr></thead>"
+        f"<tbody>{rows}</tbody></table></body></html>"
+    )
+
+
+def _chunks(page: str, chunk_size: int = 64 * 1024):
+
+    for start in range(0, len(page), chunk_size):
+        yield page[start : start + chunk_size]
+
+
+def _median_ms(func, repeat: int) -> float:
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def run(vm_names: list = None, repeat: int = 5, host_os: str = "linux"):
+    """Time full and targeted parsing of every fixture.
+
+    Parameters
+    ----------
+    vm_names : list, optional
+        VM sizes the targeted parser looks for, by default Standard_E2s_v3
+        (or a row near the top of the synthetic page)
+    repeat : int, optional
+        Number of timed parses per fixture, by default 5
+    """
+
+    fixtures = {
+        path.name: path.read_text() for path in sorted(FIXTURE_DIR.glob("*.html"))
+    }
+    if not fixtures:
+        fixtures = {"synthetic-1000-rows": synthetic_page(1000)}
+        vm_names = vm_names or ["Standard_S10_v1"]
+    vm_names = vm_names or ["Standard_E2s_v3"]
+
+    results = {}
+    for name, page in fixtures.items():
+        full_ms = _median_ms(lambda: parse_table(page, host_os), repeat)
+        targeted_ms = _median_ms(
+            lambda: parse_prices(_chunks(page), vm_names=vm_names, host_os=host_os),
+            repeat,
+        )
+        results[name] = {
+            "full_ms": round(full_ms, 1),
+            "targeted_ms": round(targeted_ms, 1),
+        }
+        print(
+            f"{name:<40} full: {full_ms:>8.1f} ms  targeted: {targeted_ms:>8.1f} ms  "
+            f"({full_ms / max(targeted_ms, 1e-6):.1f}x)"
+        )
+    return results
+
+
+if __name__ == "__main__":
+
+    fire.Fire({"run": run, "save_fixture": save_fixture})
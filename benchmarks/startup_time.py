@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+"""Measure cold import time of each command line entry point.
+
+Every run imports each module in a fresh interpreter with ``-X importtime``
+and appends the results to a JSON lines file, so regressions show up when
+comparing against earlier runs:
+
+    python benchmarks/startup_time.py run --repeat 5
+    python benchmarks/startup_time.py compare
+"""
+
+import datetime
+import json
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+
+import fire
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+ENTRY_POINTS = [
+    "batch_containers",
+    "batch_creation",
+    "batch_daemon",
+    "async_batch_containers",
+    "autoscale",
+    "get_azure_data",
+    "sweep",
+]
+DEFAULT_RESULTS = os.path.join("benchmarks", "results", "startup_time.jsonl")
+
+
+def import_time(module: str) -> dict:
+    """Import module in a fresh interpreter and parse its -X importtime report.
+
+    Returns
+    -------
+    dict
+        Total import time of the module and the slowest top-level imports, in milliseconds.
+    """
+
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=str(REPO_ROOT),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{proc.stderr}")
+
+    # lines look like "import time: self [us] | cumulative | imported package",
+    # with each module's own imports listed, indented, just before it
+    total_ms = 0.0
+    direct_imports = []
+    heaviest = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        cumulative_ms = int(cumulative_us) / 1000.0
+        if depth == 1:
+            direct_imports.append((name.strip(), cumulative_ms))
+        elif depth == 0:
+            if name.strip() == module:
+                total_ms = cumulative_ms
+                heaviest = sorted(
+                    direct_imports, key=lambda item: item[1], reverse=True
+                )[:10]
+            direct_imports = []
+
+    return {"total_ms": total_ms, "heaviest": heaviest}
+
+
+def run(repeat: int = 3, results_file: str = DEFAULT_RESULTS, modules: list = None):
+    """Record median cold import time per entry point.
+
+    Parameters
+    ----------
+    repeat : int, optional
+        Number of fresh interpreters per module, by default 3
+    results_file : str, optional
+        JSON lines file results are appended to, by default benchmarks/results/startup_time.jsonl
+    modules : list, optional
+        Modules to measure, by default every entry point
+    """
+
+    record = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "results": {},
+    }
+    for module in modules or ENTRY_POINTS:
+        samples = [import_time(module) for _ in range(int(repeat))]
+        record["results"][module] = {
+            "median_ms": round(statistics.median(s["total_ms"] for s in samples), 1),
+            "heaviest": samples[-1]["heaviest"],
+        }
+        print(f"{module:<25} {record['results'][module]['median_ms']:>8.1f} ms")
+
+    results_path = REPO_ROOT / results_file
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(results_path, "a") as results:
+        results.write(json.dumps(record) + "\n")
+    return record["results"]
+
+
+def compare(results_file: str = DEFAULT_RESULTS, tolerance: float = 0.2):
+    """Compare the latest run with the previous one and flag regressions.
+
+    Parameters
+    ----------
+    tolerance : float, optional
+        Relative slowdown reported as a regression, by default 0.2 (20%)
+    """
+
+    with open(REPO_ROOT / results_file) as results:
+        runs = [json.loads(line) for line in results if line.strip()]
+    if len(runs) < 2:
+        raise ValueError("need at least two recorded runs to compare")
+
+    previous, latest = runs[-2]["results"], runs[-1]["results"]
+    regressions = {}
+    for module, result in latest.items():
+        if module not in previous:
+            continue
+        before, after = previous[module]["median_ms"], result["median_ms"]
+        flag = "REGRESSION" if after > before * (1 + tolerance) else ""
+        if flag:
+            regressions[module] = (before, after)
+        print(f"{module:<25} {before:>8.1f} -> {after:>8.1f} ms {flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+
+    fire.Fire({"run": run, "compare": compare})
@@ -0,0 +1,124 @@
+"""Lazy sources of task commands for batch_main.
+
+A command source can be a single command string, a list of commands, any
+iterator or generator, or the path of a JSON lines or CSV file. Items are
+produced one at a time so huge parameter sweeps never sit in memory at once.
+"""
+
+import csv
+import itertools
+import json
+import os
+from typing import Iterable, Iterator, Optional, Union
+
+DEFAULT_COMMAND = "python main.py"
+COMMAND_FILE_SUFFIXES = (".jsonl", ".csv")
+
+
+def is_command_file(command) -> bool:
+    """Whether command names a JSON lines or CSV file of commands."""
+
+    return (
+        isinstance(command, str)
+        and command.lower().endswith(COMMAND_FILE_SUFFIXES)
+        and os.path.isfile(command)
+    )
+
+
+def _normalize(item) -> dict:
+
+    if isinstance(item, str):
+        return {"command": item}
+    if isinstance(item, dict) and "command" in item:
+        return item
+    raise ValueError(f"Unknown command provided {item}")
+
+
+def _read_jsonl(path: str) -> Iterator[dict]:
+    """Each line is either a JSON string or an object with "command" and optional "id", "env" and "image"."""
+
+    with open(path) as commands:
+        for line in commands:
+            if line.strip():
+                yield _normalize(json.loads(line))
+
+
+def _read_csv(path: str) -> Iterator[dict]:
+    """Rows need a "command" column; "id" names the task, "image" picks its container image and other columns become environment variables.
+
+    Raises
+    ------
+    ValueError
+        If the file has no "command" column
+    """
+
+    with open(path, newline="") as commands:
+        rows = csv.DictReader(commands)
+        if "command" not in (rows.fieldnames or []):
+            raise ValueError(
+                f'{path} has no "command" column, its columns are {rows.fieldnames or []}'
+            )
+        for row in rows:
+            item = {"command": row.pop("command")}
+            for key in ("id", "image"):
+                if row.get(key):
+                    item[key] = row.pop(key)
+                row.pop(key, None)
+            if row:
+                item["env"] = row
+            yield item
+
+
+def command_source(
+    command: Union[str, Iterable, None] = None, limit: Optional[int] = None
+) -> Iterator[dict]:
+    """Yield one {"command", optional "id", "env" and "image"} dict per task.
+
+    Parameters
+    ----------
+    command : Union[str, Iterable, None], optional
+        A command run by every task, a .jsonl/.csv file of commands, or an
+        iterable of command strings or dicts, by default "python main.py"
+    limit : Optional[int], optional
+        Stop after this many tasks. Required when a single command is repeated,
+        by default None
+
+    Returns
+    -------
+    Iterator[dict]
+    """
+
+    if command is None or command == "":
+        command = DEFAULT_COMMAND
+    if is_command_file(command):
+        if command.lower().endswith(".jsonl"):
+            items = _read_jsonl(command)
+        else:
+            items = _read_csv(command)
+    elif isinstance(command, str):
+        if limit is None:
+            raise ValueError("limit is required when repeating a single command")
+        items = itertools.repeat({"command": command}, int(limit))
+    else:
+        items = (_normalize(item) for item in command)
+
+    if limit is not None:
+        items = itertools.islice(items, int(limit))
+    return items
+
+
+def count_commands(command) -> Optional[int]:
+    """Number of tasks a source holds without loading it, or None if unknown (single commands, iterators)."""
+
+    if is_command_file(command):
+        if command.lower().endswith(".csv"):
+            # rows, not lines: quoted fields may span lines
+            with open(command, newline="") as commands:
+                rows = sum(1 for row in csv.reader(commands) if row)
+            # the CSV header is not a task
+            return max(rows - 1, 0)
+        with open(command) as commands:
+            return sum(1 for line in commands if line.strip())
+    if isinstance(command, (list, tuple)):
+        return len(command)
+    return None
@@ -1,8 +1,231 @@
+import logging
+import os
+from math import ceil
+import pathlib
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import Iterable, List
+from urllib.error import URLError
 from urllib.request import Request, urlopen
 
+import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 
+logger = logging.getLogger("get_azure_data")
+
+# price tables are cached as parquet files, one per (region, tier, OS)
+PRICE_CACHE_DIR = os.environ.get(
+    "BONSAI_BATCH_PRICE_CACHE",
+    os.path.join(str(pathlib.Path.home()), ".bonsai-batch", "prices"),
+)
+PRICE_CACHE_TTL = 24 * 60 * 60
+PRICE_CACHE_MAX_ENTRIES = 32
+# column of cached tables holding when each row was fetched, rows without it
+# date from the table's last full refresh (its modification time)
+FETCHED_COLUMN = "_fetched"
+# family, vCPUs (e.g. 4 or 4-2 for constrained sizes), then feature letters
+ARM64_SKU = re.compile(r"^standard_[a-z]+[\d-]+[a-z]*p[a-z]*(_|$)", re.IGNORECASE)
+BURSTABLE_SKU = re.compile(r"^standard_b\d", re.IGNORECASE)
+
+
+def _open_price_page(region: str, low_pri: bool):
+    """Open the azureprice.net page for region and priority tier."""
+
+    azure_price_url = "https://azureprice.net/" + "?region=" + region
+
+    if low_pri:
+        azure_price_url += "&tier=low"
+    else:
+        azure_price_url += "&tier=standard"
+
+    hdr = {"User-Agent": "Mozilla/5.0"}
+    req = Request(azure_price_url, headers=hdr)
+    return urlopen(req)
+
+
+def _tidy_price_table(data_df: pd.DataFrame, host_os: str = "linux") -> pd.DataFrame:
+    """Drop columns for the other OS and convert vCPUs and memory to numbers."""
+
+    table_df = data_df.drop(columns=data_df.columns.to_list()[-2])
+
+    if host_os == "linux":
+        drop_os = "windows"
+    else:
+        drop_os = "linux"
+    regex_os = "(?i)" + drop_os
+
+    table_df = table_df[table_df.columns.drop(list(table_df.filter(regex=regex_os)))]
+    table_df[["vCPUs", "Memory (GiB)"]] = table_df[["vCPUs", "Memory (GiB)"]].apply(
+        pd.to_numeric
+    )
+    return table_df
+
+
+def parse_table(html, host_os: str = "linux") -> pd.DataFrame:
+    """Parse every row of an azureprice.net price page.
+
+    Parameters
+    ----------
+    html : str or file-like
+        Page source
+    host_os : str, optional
+        "linux" or "windows", by default "linux"
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+
+    soup = BeautifulSoup(html, "html.parser")
+    table = soup.find("table")
+    headings = [th.get_text().strip() for th in table.find("tr").find_all("th")]
+    table_body = soup.find("tbody")
+    data_list = []
+
+    rows = table_body.find_all("tr")
+    for row in rows:
+        data_list.append([x.get_text() for x in row.find_all("td")])
+    data_df = pd.DataFrame(data_list, columns=headings)
+    return _tidy_price_table(data_df, host_os)
+
+
+class _PriceTableParser(HTMLParser):
+    """Incremental parser for the first table of an azureprice.net page.
+
+    Rows are collected as the page is fed in. When vm_names is given only
+    matching rows are kept and ``done`` is set once all of them were seen,
+    so the caller can stop reading the page.
+    """
+
+    def __init__(self, vm_names: List[str] = None):
+        super().__init__(convert_charrefs=True)
+        self.wanted = {name.lower() for name in vm_names} if vm_names else None
+        self.headings = []
+        self.rows = []
+        self.done = False
+        self._tables_seen = 0
+        self._in_body = False
+        self._row = None
+        self._cell = None
+        self._name_column = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            self._tables_seen += 1
+        if self._tables_seen != 1:
+            return
+        if tag == "tbody":
+            self._in_body = True
+        elif tag == "tr":
+            self._row = []
+        elif tag in ("th", "td") and self._row is not None:
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if self._tables_seen != 1:
+            return
+        if tag in ("th", "td") and self._cell is not None:
+            text = "".join(self._cell)
+            self._row.append(text.strip() if tag == "th" else text)
+            self._cell = None
+        elif tag == "tr" and self._row is not None:
+            self._end_row()
+            self._row = None
+        elif tag in ("tbody", "table"):
+            self._in_body = False
+            self.done = self.done or tag == "table"
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+    def _end_row(self):
+        if not self._in_body:
+            if not self.headings:
+                self.headings = self._row
+                self._name_column = self.headings.index("VM Name")
+            return
+        if self.wanted is None:
+            self.rows.append(self._row)
+            return
+        name = self._row[self._name_column].strip().lower()
+        if name in self.wanted:
+            self.rows.append(self._row)
+            if len(
+                {row[self._name_column].strip().lower() for row in self.rows}
+            ) == len(self.wanted):
+                self.done = True
+
+
+def parse_prices(
+    chunks: Iterable, vm_names: List[str] = None, host_os: str = "linux"
+) -> pd.DataFrame:
+    """Incrementally parse an azureprice.net page, stopping once every VM in vm_names was found.
+
+    Parameters
+    ----------
+    chunks : Iterable
+        Page source as an iterable of bytes or str chunks
+    vm_names : List[str], optional
+        VM sizes to extract, by default None (every row)
+    host_os : str, optional
+        "linux" or "windows", by default "linux"
+
+    Returns
+    -------
+    pd.DataFrame
+        Same columns as get_table, one row per matching VM
+    """
+
+    parser = _PriceTableParser(vm_names)
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode("utf-8", errors="replace")
+        parser.feed(chunk)
+        if parser.done:
+            break
+    parser.close()
+    if not parser.headings:
+        raise ValueError("No price table found in page")
+    data_df = pd.DataFrame(parser.rows, columns=parser.headings)
+    return _tidy_price_table(data_df, host_os)
+
+
+def _read_chunks(stream, chunk_size: int = 64 * 1024):
+
+    return iter(lambda: stream.read(chunk_size), b"")
+
+
+def get_prices(
+    region: str = "eastus",
+    vm_names: List[str] = None,
+    low_pri: bool = True,
+    host_os: str = "linux",
+) -> pd.DataFrame:
+    """Retrieves prices for the given VM sizes only, reading the page just until they are found.
+
+    Parameters
+    ----------
+    region : str, optional
+        Azure region, by default "eastus"
+    vm_names : List[str], optional
+        VM sizes to extract, by default None (every row)
+    low_pri : bool, optional
+        Low priority (True) or dedicated (False) prices, by default True
+    host_os : str, optional
+        "linux" or "windows", by default "linux"
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+
+    with _open_price_page(region, low_pri) as html:
+        return parse_prices(_read_chunks(html), vm_names=vm_names, host_os=host_os)
+
 
 def get_table(
     region: str = "eastus", low_pri: bool = True, host_os: str = "linux"
@@ -24,55 +247,471 @@ def get_table(
     pd.DataFrame
     """
 
-    azure_price_url = "https://azureprice.net/" + "?region=" + region
+    html = _open_price_page(region, low_pri)
+    return parse_table(html, host_os)
 
-    if low_pri:
-        azure_price_url += "&tier=low"
-    else:
-        azure_price_url += "&tier=standard"
 
-    # print(azure_price_url)
+def price_column(table_df: pd.DataFrame) -> str:
+    """Name of the hourly price column of a price table, e.g. "Linux price"."""
 
-    # html = urlopen(azure_price_url)
-    hdr = {"User-Agent": "Mozilla/5.0"}
-    req = Request(azure_price_url, headers=hdr)
-    html = urlopen(req)
+    for column in table_df.columns:
+        if "price" in column.lower():
+            return column
+    raise ValueError(f"No price column in {table_df.columns.to_list()}")
 
-    soup = BeautifulSoup(html, "html.parser")
-    table = soup.find("table")
-    headings = [th.get_text().strip() for th in table.find("tr").find_all("th")]
-    table_body = soup.find("tbody")
-    data_list = []
 
-    rows = table_body.find_all("tr")
-    for row in rows:
-        data_list.append([x.get_text() for x in row.find_all("td")])
-    data_df = pd.DataFrame(data_list, columns=headings)
-    table_df = data_df.drop(columns=data_df.columns.to_list()[-2])
+def _price_cache_path(
+    region: str, low_pri: bool, host_os: str, cache_dir: str = None
+) -> pathlib.Path:
 
-    # body_script = soup.find("body").script
-    # body_script = soup.find_all("script")[17]
-    # body_script_contents = body_script.contents
+    tier = "low" if low_pri else "standard"
+    file_name = "{0}-{1}-{2}.parquet".format(region.lower(), tier, host_os.lower())
+    return pathlib.Path(cache_dir or PRICE_CACHE_DIR, file_name)
 
-    # table_str = str(body_script_contents)
-    # # extract data
-    # b = table_str[15:-7]
 
-    if host_os == "linux":
-        drop_os = "windows"
-    else:
-        drop_os = "linux"
-    regex_os = "(?i)" + drop_os
+def _evict_price_cache(
+    cache_dir: str = None, max_entries: int = PRICE_CACHE_MAX_ENTRIES
+):
+    """Remove the least recently refreshed tables beyond max_entries."""
 
-    # table_df = pd.DataFrame(json.loads(b))
-    # table_df = table_df[columns_to_show]
-    table_df = table_df[table_df.columns.drop(list(table_df.filter(regex=regex_os)))]
-    table_df[["vCPUs", "Memory (GiB)"]] = table_df[["vCPUs", "Memory (GiB)"]].apply(
-        pd.to_numeric
+    tables = sorted(
+        pathlib.Path(cache_dir or PRICE_CACHE_DIR).glob("*.parquet"),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True,
     )
+    for stale_table in tables[max_entries:]:
+        logger.debug(f"Evicting cached price table {stale_table}")
+        stale_table.unlink()
+
+
+def _is_fresh(cache_path: pathlib.Path, ttl: int) -> bool:
+
+    return cache_path.exists() and time.time() - cache_path.stat().st_mtime < ttl
+
+
+def _write_price_cache(cache_path: pathlib.Path, table_df: pd.DataFrame, mtime=None):
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # write then rename so readers never see a partially written table
+    partial_path = cache_path.with_suffix(".partial")
+    table_df.reset_index(drop=True).to_parquet(partial_path)
+    if mtime is not None:
+        os.utime(partial_path, (mtime, mtime))
+    os.replace(partial_path, cache_path)
+
+
+def _read_price_cache(
+    cache_path: pathlib.Path, fetch_times: bool = False
+) -> pd.DataFrame:
+    """Read a cached table, with or without the time each row was fetched."""
+
+    table_df = pd.read_parquet(cache_path)
+    if not fetch_times:
+        return table_df.drop(columns=FETCHED_COLUMN, errors="ignore")
+    mtime = cache_path.stat().st_mtime
+    if FETCHED_COLUMN in table_df:
+        table_df[FETCHED_COLUMN] = table_df[FETCHED_COLUMN].fillna(mtime)
+    else:
+        table_df[FETCHED_COLUMN] = mtime
+    return table_df
+
+
+def _update_price_cache(cache_path: pathlib.Path, prices_df: pd.DataFrame):
+    """Merge freshly fetched rows of a few VM sizes into a cached table.
+
+    The rows are stamped with their fetch time, so get_sku_prices serves them
+    for ttl seconds. The table keeps its modification time, a cache seeded with
+    just these rows is dated to the epoch: only full tables are fresh as a whole.
+    """
+
+    if prices_df.empty:
+        return
+    prices_df = prices_df.assign(**{FETCHED_COLUMN: time.time()})
+    if cache_path.exists():
+        mtime = cache_path.stat().st_mtime
+        cached_df = _read_price_cache(cache_path, fetch_times=True)
+        fetched = prices_df["VM Name"].str.lower()
+        cached_df = cached_df[~cached_df["VM Name"].str.lower().isin(fetched)]
+        prices_df = pd.concat([cached_df, prices_df], ignore_index=True)
+    else:
+        mtime = 0
+    _write_price_cache(cache_path, prices_df, mtime=mtime)
+
+
+def get_cached_table(
+    region: str = "eastus",
+    low_pri: bool = True,
+    host_os: str = "linux",
+    ttl: int = PRICE_CACHE_TTL,
+    offline: bool = False,
+    cache_dir: str = None,
+    max_entries: int = PRICE_CACHE_MAX_ENTRIES,
+) -> pd.DataFrame:
+    """Same as get_table, but served from a local cache refreshed every ttl seconds.
+
+    When azureprice.net cannot be reached the last good snapshot is returned,
+    however old it is.
+
+    Parameters
+    ----------
+    region : str, optional
+        Azure region, by default "eastus"
+    low_pri : bool, optional
+        Low priority (True) or dedicated (False) prices, by default True
+    host_os : str, optional
+        "linux" or "windows", by default "linux"
+    ttl : int, optional
+        Seconds a cached table is considered fresh, by default one day
+    offline : bool, optional
+        Never contact azureprice.net, only use cached tables, by default False
+    cache_dir : str, optional
+        Directory holding cached tables, by default ~/.bonsai-batch/prices
+    max_entries : int, optional
+        Maximum number of cached tables to keep, by default 32
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+
+    cache_path = _price_cache_path(region, low_pri, host_os, cache_dir)
+    cached = cache_path.exists()
+    if cached and (offline or _is_fresh(cache_path, ttl)):
+        return _read_price_cache(cache_path)
+    if offline:
+        raise FileNotFoundError(f"No cached price table at {cache_path}")
+
+    try:
+        table_df = get_table(region=region, low_pri=low_pri, host_os=host_os)
+    except (URLError, OSError) as e:
+        if not cached:
+            raise
+        logger.warning(
+            f"Could not reach azureprice.net ({e}), using cached prices from "
+            + time.strftime(
+                "%Y-%m-%d %H:%M", time.localtime(cache_path.stat().st_mtime)
+            )
+        )
+        return _read_price_cache(cache_path)
+
+    _write_price_cache(cache_path, table_df)
+    _evict_price_cache(cache_dir, max_entries)
     return table_df
 
 
+def clear_price_cache(cache_dir: str = None):
+    """Delete every cached price table."""
+
+    for table in pathlib.Path(cache_dir or PRICE_CACHE_DIR).glob("*.parquet"):
+        table.unlink()
+
+
+def get_sku_prices(
+    region: str = "eastus",
+    vm_names: List[str] = None,
+    low_pri: bool = True,
+    host_os: str = "linux",
+    ttl: int = PRICE_CACHE_TTL,
+    offline: bool = False,
+) -> pd.DataFrame:
+    """Prices for a few VM sizes, from the cache or a targeted fetch.
+
+    Cached rows are used while their table or the rows themselves were
+    fetched less than ttl seconds ago. Fetched rows are written through to the
+    cached table, and the last cached prices are used when azureprice.net is
+    unreachable.
+    """
+
+    wanted = {name.lower() for name in vm_names}
+    cache_path = _price_cache_path(region, low_pri, host_os)
+    if offline or _is_fresh(cache_path, ttl):
+        table_df = get_cached_table(region, low_pri, host_os, offline=True)
+        return table_df[table_df["VM Name"].str.lower().isin(wanted)]
+    if cache_path.exists():
+        table_df = _read_price_cache(cache_path, fetch_times=True)
+        rows = table_df[table_df["VM Name"].str.lower().isin(wanted)]
+        rows = rows[time.time() - rows[FETCHED_COLUMN] < ttl]
+        if set(rows["VM Name"].str.lower()) >= wanted:
+            return rows.drop(columns=FETCHED_COLUMN)
+    try:
+        prices_df = get_prices(region, vm_names, low_pri=low_pri, host_os=host_os)
+    # socket timeouts and connection resets are OSErrors, a changed page a ValueError
+    except (URLError, OSError, ValueError) as e:
+        logger.warning(f"Could not reach azureprice.net ({e}), trying cached prices")
+        try:
+            table_df = get_cached_table(region, low_pri, host_os, offline=True)
+        except FileNotFoundError:
+            raise e
+        return table_df[table_df["VM Name"].str.lower().isin(wanted)]
+    _update_price_cache(cache_path, prices_df)
+    return prices_df
+
+
+def sku_catalogue(
+    region: str = "eastus",
+    host_os: str = "linux",
+    ttl: int = PRICE_CACHE_TTL,
+    offline: bool = False,
+) -> pd.DataFrame:
+    """VM sizes with their vCPUs, memory, low priority and dedicated hourly price.
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns "VM Name", "vCPUs", "Memory (GiB)", "low_pri_price" and "dedicated_price"
+    """
+
+    tables = []
+    for low_pri, tier_column in [(True, "low_pri_price"), (False, "dedicated_price")]:
+        table_df = get_cached_table(
+            region=region, low_pri=low_pri, host_os=host_os, ttl=ttl, offline=offline
+        )
+        prices = pd.to_numeric(table_df[price_column(table_df)], errors="coerce")
+        tables.append(
+            table_df[["VM Name", "vCPUs", "Memory (GiB)"]].assign(
+                **{tier_column: prices}
+            )
+        )
+    catalogue = tables[0].merge(
+        tables[1][["VM Name", "dedicated_price"]], on="VM Name", how="inner"
+    )
+    return catalogue.dropna().reset_index(drop=True)
+
+
+def vm_architecture(vm_name: str) -> str:
+    """CPU architecture of a VM size, "arm64" when its feature letters include p (e.g. D4ps_v5), else "x86"."""
+
+    return "arm64" if ARM64_SKU.match(vm_name) else "x86"
+
+
+def is_burstable(vm_name: str) -> bool:
+    """Whether a VM size is a burstable B-series size, e.g. Standard_B2ms."""
+
+    return bool(BURSTABLE_SKU.match(vm_name))
+
+
+def select_vm_sku(
+    catalogue: pd.DataFrame,
+    num_sims: int,
+    cpu_per_sim: float = 0.5,
+    mem_per_sim: float = 2.0,
+    low_pri_fraction: float = 0.9,
+    max_tasks_per_node: int = None,
+    vm_filter: str = None,
+    architecture: str = "x86",
+    include_burstable: bool = False,
+) -> dict:
+    """Pick the VM size and node count with the lowest cost per simulator-hour.
+
+    Every SKU in the catalogue is scored at once: the number of simulators a
+    node fits is bounded by both its vCPUs and its memory, the node count is
+    what it takes to run num_sims simulators, and nodes are split between low
+    priority and dedicated according to low_pri_fraction.
+
+    Parameters
+    ----------
+    catalogue : pd.DataFrame
+        SKU catalogue, see sku_catalogue
+    num_sims : int
+        Number of simulators to run
+    cpu_per_sim : float, optional
+        vCPUs each simulator needs, by default 0.5
+    mem_per_sim : float, optional
+        Memory in GiB each simulator needs, by default 2.0
+    low_pri_fraction : float, optional
+        Share of nodes which are low priority, by default 0.9
+    max_tasks_per_node : int, optional
+        Upper bound on simulators per node, by default None
+    vm_filter : str, optional
+        Regular expression VM names must match, e.g. "_(D|E)\\d+s_v3$", by default None
+    architecture : str, optional
+        Only VM sizes of this CPU architecture, "x86" or "arm64", as images
+        are built for one of them, by default "x86" (None for any)
+    include_burstable : bool, optional
+        Also consider burstable B-series sizes, whose CPU credits run out
+        under sustained simulator load, by default False
+
+    Returns
+    -------
+    dict
+        Selected vm_sku, low_pri_nodes, dedicated_nodes, tasks_per_node,
+        hourly_cost, cost_per_sim_hour, an explanation and the runner-up candidates.
+    """
+
+    if vm_filter:
+        catalogue = catalogue[catalogue["VM Name"].str.contains(vm_filter, regex=True)]
+    if architecture:
+        catalogue = catalogue[catalogue["VM Name"].map(vm_architecture) == architecture]
+    if not include_burstable:
+        catalogue = catalogue[~catalogue["VM Name"].map(is_burstable)]
+
+    vcpus = catalogue["vCPUs"].to_numpy(dtype=float)
+    memory = catalogue["Memory (GiB)"].to_numpy(dtype=float)
+    low_price = catalogue["low_pri_price"].to_numpy(dtype=float)
+    dedicated_price = catalogue["dedicated_price"].to_numpy(dtype=float)
+
+    by_cpu = np.floor(vcpus / cpu_per_sim)
+    by_memory = np.floor(memory / mem_per_sim)
+    sims_per_node = np.minimum(by_cpu, by_memory)
+    if max_tasks_per_node:
+        sims_per_node = np.minimum(sims_per_node, max_tasks_per_node)
+    sims_per_node = np.minimum(sims_per_node, num_sims)
+
+    fits = sims_per_node >= 1
+    nodes = np.ceil(num_sims / np.where(fits, sims_per_node, 1))
+    dedicated_nodes = nodes - np.floor(nodes * low_pri_fraction)
+    low_pri_nodes = nodes - dedicated_nodes
+    hourly_cost = low_pri_nodes * low_price + dedicated_nodes * dedicated_price
+    cost_per_sim_hour = np.where(fits, hourly_cost / num_sims, np.inf)
+
+    # cheapest first, fewer nodes breaks ties
+    order = np.lexsort((nodes, cost_per_sim_hour))
+    order = order[np.isfinite(cost_per_sim_hour[order])]
+    if not len(order):
+        raise ValueError(
+            f"No VM size fits a simulator needing {cpu_per_sim} vCPUs and {mem_per_sim} GiB"
+        )
+
+    candidates = [
+        {
+            "vm_sku": catalogue["VM Name"].iloc[i],
+            "low_pri_nodes": int(low_pri_nodes[i]),
+            "dedicated_nodes": int(dedicated_nodes[i]),
+            "tasks_per_node": int(sims_per_node[i]),
+            "hourly_cost": round(float(hourly_cost[i]), 4),
+            "cost_per_sim_hour": round(float(cost_per_sim_hour[i]), 5),
+        }
+        for i in order[:5]
+    ]
+    best_index = order[0]
+    selection = dict(candidates[0])
+    limited_by = "vCPUs" if by_cpu[best_index] <= by_memory[best_index] else "memory"
+    explanation = (
+        "{vm_sku} ({cpus:g} vCPUs, {mem:g} GiB) fits {tasks_per_node} simulators per node "
+        "(limited by {limited_by}); {low_pri_nodes} low priority + {dedicated_nodes} "
+        "dedicated nodes cost ${hourly_cost:.2f}/hour, ${cost_per_sim_hour:.4f} per "
+        "simulator-hour, cheapest of {scored} sizes scored".format(
+            cpus=vcpus[best_index],
+            mem=memory[best_index],
+            limited_by=limited_by,
+            scored=int(fits.sum()),
+            **selection,
+        )
+    )
+    if len(candidates) > 1:
+        explanation += "; runner-up {vm_sku} at ${cost_per_sim_hour:.4f}".format(
+            **candidates[1]
+        )
+    selection["explanation"] = explanation
+    selection["candidates"] = candidates
+    return selection
+
+
+def optimize_node_mix(
+    target_sims: int,
+    low_pri_price: float,
+    dedicated_price: float,
+    preemption_rate: float = 0.1,
+    budget: float = None,
+    max_tasks_per_node: int = 8,
+    min_dedicated_nodes: int = 0,
+) -> dict:
+    """Low priority / dedicated node mix maximizing expected running simulators per dollar.
+
+    A low priority node is expected to be running a (1 - preemption_rate)
+    share of the time, a dedicated node always is. Every combination of task
+    slots per node and dedicated node count is scored at once; low priority
+    nodes fill the rest of the target. Mixes which reach target_sims within
+    budget are ranked by expected running simulators per dollar. When the
+    budget cannot reach the target, the mix running the most simulators
+    within budget is returned instead.
+
+    Parameters
+    ----------
+    target_sims : int
+        Number of simulators which should be running concurrently
+    low_pri_price : float
+        Hourly price of a low priority node
+    dedicated_price : float
+        Hourly price of a dedicated node
+    preemption_rate : float, optional
+        Expected share of low priority capacity lost to preemption, by default 0.1
+    budget : float, optional
+        Maximum hourly cost of the pool, by default None (unbounded)
+    max_tasks_per_node : int, optional
+        Most simulators a node of the chosen VM size can run, by default 8
+    min_dedicated_nodes : int, optional
+        Dedicated nodes to keep regardless of price, by default 0
+
+    Returns
+    -------
+    dict
+        low_pri_nodes, dedicated_nodes, task_slots_per_node, hourly_cost,
+        expected_running_sims and expected_sims_per_dollar
+
+    Raises
+    ------
+    ValueError
+        If the budget cannot pay for min_dedicated_nodes and a node running at
+        least one simulator
+    """
+
+    if not 0 <= preemption_rate < 1:
+        raise ValueError(f"preemption_rate must be in [0, 1), got {preemption_rate}")
+    if target_sims < 1:
+        raise ValueError(f"target_sims must be at least 1, got {target_sims}")
+
+    availability = 1.0 - preemption_rate
+    max_slots = max(min(int(max_tasks_per_node), int(target_sims)), 1)
+    slots = np.arange(1, max_slots + 1, dtype=float)[:, None]
+    dedicated = np.arange(
+        min_dedicated_nodes,
+        max(ceil(target_sims), min_dedicated_nodes) + 1,
+        dtype=float,
+    )[None, :]
+
+    low_pri = np.maximum(np.ceil((target_sims / slots - dedicated) / availability), 0)
+    if budget is not None:
+        affordable = np.floor((budget - dedicated * dedicated_price) / low_pri_price)
+        low_pri = np.minimum(low_pri, affordable)
+    hourly_cost = low_pri * low_pri_price + dedicated * dedicated_price
+    expected = np.minimum(slots * (low_pri * availability + dedicated), target_sims)
+
+    # an empty pool runs nothing, so it is no mix at all
+    feasible = (low_pri >= 0) & (expected > 0)
+    if budget is not None:
+        feasible &= hourly_cost <= budget
+    if not feasible.any():
+        raise ValueError(
+            f"A budget of ${budget}/hour cannot pay for {min_dedicated_nodes} dedicated nodes "
+            f"and a node to run simulators on (${low_pri_price}/hour low priority, "
+            f"${dedicated_price}/hour dedicated)"
+        )
+
+    per_dollar = np.where(
+        feasible, expected / np.maximum(hourly_cost, np.finfo(float).eps), -np.inf
+    )
+    # reach as many of the target simulators as the budget allows, then
+    # prefer the mix with the most expected running simulators per dollar
+    reachable = np.where(feasible, expected, -np.inf)
+    best_expected = reachable.max()
+    per_dollar = np.where(reachable >= best_expected, per_dollar, -np.inf)
+    best_slots, best_dedicated = np.unravel_index(
+        np.argmax(per_dollar), per_dollar.shape
+    )
+
+    return {
+        "low_pri_nodes": int(low_pri[best_slots, best_dedicated]),
+        "dedicated_nodes": int(dedicated[0, best_dedicated]),
+        "task_slots_per_node": int(slots[best_slots, 0]),
+        "hourly_cost": round(float(hourly_cost[best_slots, best_dedicated]), 4),
+        "expected_running_sims": round(float(expected[best_slots, best_dedicated]), 1),
+        "expected_sims_per_dollar": round(
+            float(per_dollar[best_slots, best_dedicated]), 2
+        ),
+    }
+
+
 def calculate_price(
     low_pri_df: pd.DataFrame,
     dedicated_df: pd.DataFrame,
@@ -119,16 +758,40 @@ def show_hourly_price(
     low_pri_nodes: int = 9,
     dedicated_nodes: int = 1,
     host_os: str = "linux",
+    ttl: int = PRICE_CACHE_TTL,
+    offline: bool = False,
 ):
+    """Hourly price of a pool of machine_sku nodes.
 
-    low_table = get_table(region=region, low_pri=True, host_os=host_os)
-    low_table = low_table[low_table["VM Name"].str.lower() == machine_sku.lower()]
-    ded_table = get_table(region=region, low_pri=False, host_os=host_os)
-    ded_table = ded_table[ded_table["VM Name"].str.lower() == machine_sku.lower()]
+    Raises
+    ------
+    ValueError
+        If azureprice.net lists no price for machine_sku in region
+    """
 
-    hourly_price = (float(low_table.iloc[0, 3]) * low_pri_nodes) + (
-        float(ded_table.iloc[0, 3]) * dedicated_nodes
-    )
+    # fetch both tiers at once, each page is only read until machine_sku is found
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        low_table, ded_table = executor.map(
+            lambda low_pri: get_sku_prices(
+                region=region,
+                vm_names=[machine_sku],
+                low_pri=low_pri,
+                host_os=host_os,
+                ttl=ttl,
+                offline=offline,
+            ),
+            [True, False],
+        )
+
+    for table_df, tier in [(low_table, "low priority"), (ded_table, "dedicated")]:
+        if table_df.empty:
+            raise ValueError(
+                f"No {tier} {host_os} price for {machine_sku} in {region}, "
+                "check the VM size and region"
+            )
+    hourly_price = (
+        float(low_table[price_column(low_table)].iloc[0]) * low_pri_nodes
+    ) + (float(ded_table[price_column(ded_table)].iloc[0]) * dedicated_nodes)
 
     return round(hourly_price, 2)
 
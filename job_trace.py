@@ -0,0 +1,283 @@
+#! /usr/bin/env python
+"""Export the task lifecycle of a job as a Chrome trace / Perfetto timeline.
+
+Every task is drawn as a span on the node slot it ran on, one process per
+node and one thread per slot, so idle slots, stragglers and scheduling gaps
+stand out even for jobs with tens of thousands of tasks. The time tasks
+waited in the active state is drawn in a separate queue track, a counter
+track shows queued and running tasks over time, and failed or requeued tasks
+are highlighted:
+
+    python job_trace.py export --job_id <job-id> --output job-trace.json
+
+Open the file in https://ui.perfetto.dev or chrome://tracing. Container
+start is part of each task's span, as the Batch service reports one start
+time for pulling (if needed), starting the container and running the command.
+"""
+
+import datetime
+import json
+import logging
+from typing import Iterable, List
+
+import azure.batch.models as batchmodels
+import fire
+
+logger = logging.getLogger("job_trace")
+
+TASK_SELECT = "id,state,creationTime,stateTransitionTime,executionInfo,nodeInfo"
+# process ids of the tracks which are not nodes
+JOB_PID = 0
+QUEUE_PID = 1
+
+
+def _micros(moment: datetime.datetime, origin: datetime.datetime) -> int:
+
+    return int((moment - origin).total_seconds() * 1e6)
+
+
+def _state_name(state) -> str:
+
+    return getattr(state, "value", state)
+
+
+def task_record(task: batchmodels.CloudTask) -> dict:
+    """The lifecycle fields of a task needed for the trace."""
+
+    info = task.execution_info
+    failure = info.failure_info if info else None
+    return {
+        "id": task.id,
+        "state": _state_name(task.state),
+        "created": task.creation_time,
+        "started": info.start_time if info else None,
+        "ended": info.end_time if info else None,
+        "node": task.node_info.node_id if task.node_info else None,
+        "exit_code": info.exit_code if info else None,
+        "failed": bool(info and _state_name(info.result) == "failure"),
+        "failure": failure.code if failure else None,
+        "retries": info.retry_count if info else 0,
+        "requeues": info.requeue_count if info else 0,
+        "requeued": info.last_requeue_time if info else None,
+    }
+
+
+def assign_slots(records: List[dict]) -> dict:
+    """Place each started task on the lowest slot of its node free at its start time."""
+
+    slots, slot_ends = {}, {}
+    for record in sorted(
+        (r for r in records if r["started"] and r["node"]), key=lambda r: r["started"]
+    ):
+        ends = slot_ends.setdefault(record["node"], [])
+        for slot, end in enumerate(ends):
+            if end is not None and end <= record["started"]:
+                break
+        else:
+            slot = len(ends)
+            ends.append(None)
+        ends[slot] = record["ended"]
+        slots[record["id"]] = slot
+    return slots
+
+
+def trace_events(records: List[dict], now: datetime.datetime = None) -> List[dict]:
+    """Chrome trace events of task records, relative to the first task's creation.
+
+    Tasks which have not ended yet run until now.
+    """
+
+    if not records:
+        return []
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    origin = min(r["created"] for r in records if r["created"])
+    slots = assign_slots(records)
+    nodes = sorted({r["node"] for r in records if r["id"] in slots})
+    node_pids = {node: QUEUE_PID + 1 + i for i, node in enumerate(nodes)}
+
+    events = [
+        {"ph": "M", "name": "process_name", "pid": JOB_PID, "args": {"name": "job"}},
+        {
+            "ph": "M",
+            "name": "process_name",
+            "pid": QUEUE_PID,
+            "args": {"name": "queue"},
+        },
+    ]
+    for node, pid in node_pids.items():
+        events.append(
+            {"ph": "M", "name": "process_name", "pid": pid, "args": {"name": node}}
+        )
+        events.append(
+            {
+                "ph": "M",
+                "name": "process_sort_index",
+                "pid": pid,
+                "args": {"sort_index": pid},
+            }
+        )
+    named_slots = set()
+
+    # +1 when a task is queued or starts running, -1 when it leaves that state
+    changes = []
+    for index, record in enumerate(records):
+        created, started, ended = record["created"], record["started"], record["ended"]
+        args = {
+            "state": record["state"],
+            "exit_code": record["exit_code"],
+            "retries": record["retries"],
+            "requeues": record["requeues"],
+        }
+        if record["failure"]:
+            args["failure"] = record["failure"]
+        queued_until = started or now
+        if created:
+            args["queued_seconds"] = round((queued_until - created).total_seconds(), 3)
+            events.append(
+                {
+                    "ph": "b",
+                    "cat": "queue",
+                    "name": record["id"],
+                    "id": index,
+                    "pid": QUEUE_PID,
+                    "tid": 0,
+                    "ts": _micros(created, origin),
+                }
+            )
+            events.append(
+                {
+                    "ph": "e",
+                    "cat": "queue",
+                    "name": record["id"],
+                    "id": index,
+                    "pid": QUEUE_PID,
+                    "tid": 0,
+                    "ts": _micros(queued_until, origin),
+                }
+            )
+            changes += [(created, "queued", 1), (queued_until, "queued", -1)]
+        if record["requeued"]:
+            events.append(
+                {
+                    "ph": "i",
+                    "s": "g",
+                    "name": f"requeued {record['id']}",
+                    "pid": JOB_PID,
+                    "tid": 0,
+                    "ts": _micros(record["requeued"], origin),
+                }
+            )
+        if record["id"] not in slots:
+            continue
+
+        pid, tid = node_pids[record["node"]], slots[record["id"]]
+        if (pid, tid) not in named_slots:
+            named_slots.add((pid, tid))
+            events.append(
+                {
+                    "ph": "M",
+                    "name": "thread_name",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": f"slot {tid}"},
+                }
+            )
+        run_until = ended or now
+        span = {
+            "ph": "X",
+            "cat": "task",
+            "name": record["id"],
+            "pid": pid,
+            "tid": tid,
+            "ts": _micros(started, origin),
+            "dur": max(_micros(run_until, origin) - _micros(started, origin), 0),
+            "args": args,
+        }
+        if record["failed"]:
+            span["cname"] = "terrible"
+        elif record["requeues"] or record["retries"]:
+            span["cname"] = "bad"
+        events.append(span)
+        changes += [(started, "running", 1), (run_until, "running", -1)]
+
+    counts = {"queued": 0, "running": 0}
+    for moment, series, delta in sorted(changes, key=lambda c: (c[0], c[2])):
+        counts[series] += delta
+        events.append(
+            {
+                "ph": "C",
+                "name": "tasks",
+                "pid": JOB_PID,
+                "ts": _micros(moment, origin),
+                "args": dict(counts),
+            }
+        )
+    return events
+
+
+def job_task_records(batch, job_id: str) -> Iterable[dict]:
+    """Lazily list a job's tasks with the fields of task_record, a page of 1000 at a time."""
+
+    tasks = batch.batch_client.task.list(
+        job_id,
+        task_list_options=batchmodels.TaskListOptions(
+            select=TASK_SELECT, max_results=1000
+        ),
+    )
+    return (task_record(task) for task in tasks)
+
+
+def export(
+    job_id: str = None,
+    output: str = "job-trace.json",
+    config_file: str = None,
+    state_db: str = None,
+):
+    """Write the task timeline of a job as Chrome trace JSON.
+
+    Parameters
+    ----------
+    job_id : str, optional
+        Job to export, by default the most recent run recorded in the StateStore
+    output : str, optional
+        Trace file, by default "job-trace.json"
+    config_file : str, optional
+        config file of the Batch account, by default 'newconf.ini'
+    state_db : str, optional
+        StateStore looked up for the latest job, by default STATE_DB
+    """
+
+    from batch_containers import get_batch_containers, user_config
+
+    if job_id is None:
+        from state_store import StateStore
+
+        runs = StateStore(state_db).runs(limit=1)
+        if not runs:
+            raise ValueError("No runs recorded, pass job_id")
+        job_id = runs[0]["job_id"]
+
+    batch = get_batch_containers(config_file=config_file or user_config)
+    records = list(job_task_records(batch, job_id))
+    events = trace_events(records)
+    with open(output, "w") as out:
+        json.dump(
+            {
+                "traceEvents": events,
+                "displayTimeUnit": "ms",
+                "otherData": {"job_id": job_id, "tasks": len(records)},
+            },
+            out,
+            default=str,
+        )
+    failed = sum(1 for r in records if r["failed"])
+    requeued = sum(1 for r in records if r["requeues"])
+    logger.info(
+        f"Wrote the timeline of {len(records)} tasks of {job_id} to {output} ({failed} failed, {requeued} requeued)"
+    )
+    return output
+
+
+if __name__ == "__main__":
+
+    fire.Fire({"export": export})
@@ -0,0 +1,611 @@
+"""Timing spans and structured metrics for batch_main and the Batch API calls it makes.
+
+A Metrics recorder times named spans (the phases of batch_main and every
+call made through an InstrumentedClient), keeps their counts, errors, retries
+and latencies, and hands each span to pluggable sinks:
+
+- jsonl: one JSON object per span plus a summary line per flush
+- prometheus: a text exposition file for the node exporter textfile collector,
+  rewritten on every flush
+- appinsights: span durations sent as metrics to Application Insights, using
+  INSTRUMENTATION_KEY from the APP_INSIGHTS section of the config
+
+Sinks are chosen with a comma separated spec such as
+"jsonl,prometheus:/var/lib/node_exporter/bonsai_batch.prom" (see make_sinks):
+
+    python batch_containers.py run_tasks --metrics jsonl,appinsights
+"""
+
+import atexit
+import contextlib
+import datetime
+import json
+import logging
+import os
+import pathlib
+import random
+import threading
+import time
+from typing import Callable, List, Optional, Union
+
+logger = logging.getLogger("metrics")
+
+METRICS_DIR = os.path.join(str(pathlib.Path.home()), ".bonsai-batch")
+DEFAULT_PATHS = {
+    "jsonl": os.path.join(METRICS_DIR, "metrics.jsonl"),
+    "prometheus": os.path.join(METRICS_DIR, "metrics.prom"),
+}
+APP_INSIGHTS_ENDPOINT = "https://dc.services.visualstudio.com/v2/track"
+# Batch service operation groups of BatchServiceClient which InstrumentedClient times
+OPERATION_GROUPS = (
+    "account",
+    "application",
+    "certificate",
+    "compute_node",
+    "compute_node_extension",
+    "file",
+    "job",
+    "job_schedule",
+    "pool",
+    "task",
+)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest rank percentile q (0-100) of values, None when there are none."""
+
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    rank = max(int(-(-q * len(values) // 100)), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+class JsonlSink(object):
+    def __init__(self, path: str = None):
+        """Append every span, and a summary on each flush, to a JSON lines file."""
+
+        self.path = path or DEFAULT_PATHS["jsonl"]
+        pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _write(self, record: dict):
+
+        with self._lock, open(self.path, "a") as out:
+            out.write(json.dumps(record, default=str) + "\n")
+
+    def emit(self, span: dict):
+
+        self._write(dict(span, type="span"))
+
+    def flush(self, summary: dict, labels: dict):
+
+        self._write(
+            {
+                "type": "summary",
+                "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                **labels,
+                "spans": summary,
+            }
+        )
+
+
+class PrometheusSink(object):
+    def __init__(self, path: str = None, prefix: str = "bonsai_batch"):
+        """Write span summaries in the Prometheus text format, replacing the file on each flush."""
+
+        self.path = path or DEFAULT_PATHS["prometheus"]
+        self.prefix = prefix
+        pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+    def emit(self, span: dict):
+
+        pass
+
+    @staticmethod
+    def _labels(labels: dict) -> str:
+
+        return ",".join(
+            '{0}="{1}"'.format(key, str(value).replace('"', '\\"'))
+            for key, value in labels.items()
+        )
+
+    def flush(self, summary: dict, labels: dict):
+
+        name = f"{self.prefix}_span_seconds"
+        lines = [
+            f"# HELP {name} Duration of batch_main phases and Batch API calls.",
+            f"# TYPE {name} summary",
+        ]
+        for span, stats in sorted(summary.items()):
+            span_labels = dict(labels, span=span)
+            for quantile, key in (("0.5", "p50"), ("0.95", "p95")):
+                quantile_labels = self._labels(dict(span_labels, quantile=quantile))
+                lines.append(f"{name}{{{quantile_labels}}} {stats[key]}")
+            lines.append(
+                f"{name}_sum{{{self._labels(span_labels)}}} {stats['total_seconds']}"
+            )
+            lines.append(
+                f"{name}_count{{{self._labels(span_labels)}}} {stats['count']}"
+            )
+        for counter in ("errors", "retries"):
+            counter_name = f"{self.prefix}_span_{counter}_total"
+            lines.append(f"# TYPE {counter_name} counter")
+            for span, stats in sorted(summary.items()):
+                span_labels = self._labels(dict(labels, span=span))
+                lines.append(f"{counter_name}{{{span_labels}}} {stats[counter]}")
+
+        partial_file = f"{self.path}.{os.getpid()}.tmp"
+        with open(partial_file, "w") as out:
+            out.write("\n".join(lines) + "\n")
+        os.replace(partial_file, self.path)
+
+
+class AppInsightsSink(object):
+    def __init__(
+        self,
+        instrumentation_key: str,
+        endpoint: str = APP_INSIGHTS_ENDPOINT,
+        max_buffer: int = 500,
+    ):
+        """Send span durations to Application Insights as metrics.
+
+        Spans are buffered until flush, or until max_buffer of them are waiting,
+        so the buffer stays bounded however long the run.
+        """
+
+        self.instrumentation_key = instrumentation_key.strip("'").strip()
+        self.endpoint = endpoint
+        self.max_buffer = max(int(max_buffer), 1)
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def emit(self, span: dict):
+
+        envelope = {
+            "name": "Microsoft.ApplicationInsights.Metric",
+            "time": span["time"],
+            "iKey": self.instrumentation_key,
+            "data": {
+                "baseType": "MetricData",
+                "baseData": {
+                    "ver": 2,
+                    "metrics": [
+                        {"name": span["name"], "value": span["seconds"], "count": 1}
+                    ],
+                    "properties": {
+                        key: str(value)
+                        for key, value in span.items()
+                        if key not in ("name", "seconds", "time")
+                    },
+                },
+            },
+        }
+        with self._lock:
+            self._buffer.append(envelope)
+            if len(self._buffer) < self.max_buffer:
+                return
+            envelopes, self._buffer = self._buffer, []
+        self._send(envelopes)
+
+    def flush(self, summary: dict, labels: dict):
+
+        with self._lock:
+            envelopes, self._buffer = self._buffer, []
+        self._send(envelopes)
+
+    def _send(self, envelopes: list):
+
+        if not envelopes:
+            return
+        import urllib.request
+
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(envelopes).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+        except OSError as e:
+            # metrics must never fail the run they describe
+            logger.error(
+                f"Could not send {len(envelopes)} metrics to App Insights: {e}"
+            )
+
+
+def make_sinks(spec: Union[str, List[str]] = None, config=None) -> list:
+    """Sinks from a comma separated spec of jsonl, prometheus or appinsights, each optionally ":path".
+
+    appinsights reads INSTRUMENTATION_KEY from config["APP_INSIGHTS"].
+    """
+
+    # fire turns "jsonl,prometheus" on the command line into a tuple
+    entries = spec.split(",") if isinstance(spec, str) else list(spec or [])
+    sinks = []
+    for entry in entries:
+        kind, _, path = entry.strip().partition(":")
+        if not kind:
+            continue
+        if kind == "jsonl":
+            sinks.append(JsonlSink(path or None))
+        elif kind == "prometheus":
+            sinks.append(PrometheusSink(path or None))
+        elif kind == "appinsights":
+            if config is None or "APP_INSIGHTS" not in config:
+                raise ValueError(
+                    "the appinsights metrics sink needs an APP_INSIGHTS config section"
+                )
+            sinks.append(AppInsightsSink(config["APP_INSIGHTS"]["INSTRUMENTATION_KEY"]))
+        else:
+            raise ValueError(
+                f"Unknown metrics sink {kind}, expected jsonl, prometheus or appinsights"
+            )
+    return sinks
+
+
+# durations kept per span name for percentiles, exact up to this many spans
+RESERVOIR_SIZE = 1024
+
+
+class Metrics(object):
+    def __init__(self, sinks: list = None, flush_interval: float = 60.0, **labels):
+        """Thread safe recorder of timing spans.
+
+        Besides explicit flush calls, the sinks are flushed when a span is
+        recorded flush_interval seconds after the last flush, and at exit, so
+        spans recorded by background threads after the last phase are sent too.
+
+        Parameters
+        ----------
+        sinks : list, optional
+            Objects with emit(span) and flush(summary, labels), see make_sinks, by default none
+        flush_interval : float, optional
+            Seconds between automatic flushes, by default 60.0
+        labels
+            Added to every span and summary, e.g. job_id and pool_id
+        """
+
+        self.sinks = sinks or []
+        self.labels = labels
+        self.flush_interval = flush_interval
+        self._stats = {}
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        self._last_flush = time.monotonic()
+        self._unflushed = False
+        if self.sinks:
+            atexit.register(self._flush_at_exit)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """Time the enclosed block as span name, counting it as an error if it raises."""
+
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, error=error, **attributes)
+
+    def add_retries(self, retries: int):
+        """Count retries against the Batch API call in progress on this thread."""
+
+        self._local.retries = getattr(self._local, "retries", 0) + retries
+
+    def _take_retries(self) -> int:
+
+        retries = getattr(self._local, "retries", 0)
+        self._local.retries = 0
+        return retries
+
+    def record(
+        self,
+        name: str,
+        seconds: float,
+        error: str = None,
+        retries: int = 0,
+        **attributes,
+    ):
+        """Record a span which took seconds, and pass it to the sinks.
+
+        Totals are kept as running aggregates and percentiles from a uniform
+        sample of at most RESERVOIR_SIZE durations, so memory stays bounded
+        however many Batch API calls a long run makes.
+        """
+
+        with self._lock:
+            stats = self._stats.setdefault(
+                name,
+                {
+                    "count": 0,
+                    "errors": 0,
+                    "retries": 0,
+                    "total_seconds": 0.0,
+                    "max": seconds,
+                    "sample": [],
+                },
+            )
+            stats["count"] += 1
+            stats["errors"] += 1 if error else 0
+            stats["retries"] += retries
+            stats["total_seconds"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            # reservoir sampling: every span is kept with probability size / count
+            if len(stats["sample"]) < RESERVOIR_SIZE:
+                stats["sample"].append(seconds)
+            else:
+                slot = self._random.randrange(stats["count"])
+                if slot < RESERVOIR_SIZE:
+                    stats["sample"][slot] = seconds
+
+        span = {
+            "name": name,
+            "seconds": round(seconds, 6),
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            **self.labels,
+            **attributes,
+        }
+        if error:
+            span["error"] = error
+        if retries:
+            span["retries"] = retries
+        for sink in self.sinks:
+            try:
+                sink.emit(span)
+            except Exception as e:
+                logger.error(f"Metrics sink {type(sink).__name__} failed: {e}")
+        self._unflushed = True
+        if self.sinks and time.monotonic() - self._last_flush >= self.flush_interval:
+            self._flush_if_idle()
+
+    def summary(self) -> dict:
+        """count, errors, retries, total_seconds, p50, p95 and max per span name."""
+
+        with self._lock:
+            stats = {
+                name: dict(s, sample=list(s["sample"]))
+                for name, s in self._stats.items()
+            }
+        return {
+            name: {
+                "count": s["count"],
+                "errors": s["errors"],
+                "retries": s["retries"],
+                "total_seconds": round(s["total_seconds"], 6),
+                "p50": round(percentile(s["sample"], 50), 6),
+                "p95": round(percentile(s["sample"], 95), 6),
+                "max": round(s["max"], 6),
+            }
+            for name, s in stats.items()
+        }
+
+    def flush(self):
+        """Hand the summary so far to every sink."""
+
+        self._last_flush = time.monotonic()
+        self._unflushed = False
+        summary = self.summary()
+        for sink in self.sinks:
+            try:
+                sink.flush(summary, self.labels)
+            except Exception as e:
+                logger.error(f"Metrics sink {type(sink).__name__} failed: {e}")
+        return summary
+
+    def _flush_if_idle(self):
+        """Flush unless another thread already is."""
+
+        if self._flush_lock.acquire(blocking=False):
+            try:
+                self.flush()
+            finally:
+                self._flush_lock.release()
+
+    def _flush_at_exit(self):
+
+        if self._unflushed:
+            self._flush_if_idle()
+
+    def log_summary(self, prefix: str = ""):
+        """Log the batch_main phases (spans without a "batch." prefix) and API call totals."""
+
+        summary = self.summary()
+        phases = [
+            f"{name} {stats['total_seconds']:.1f}s"
+            for name, stats in summary.items()
+            if not name.startswith("batch.")
+        ]
+        calls = [stats for name, stats in summary.items() if name.startswith("batch.")]
+        logger.info(
+            "{0}{1}; {2} Batch API calls, {3:.1f}s, {4} retried, {5} failed".format(
+                prefix,
+                ", ".join(phases) or "no phases",
+                sum(s["count"] for s in calls),
+                sum(s["total_seconds"] for s in calls),
+                sum(s["retries"] for s in calls),
+                sum(s["errors"] for s in calls),
+            )
+        )
+
+    def when(
+        self,
+        name: str,
+        condition: Callable[[], bool],
+        poll_interval: float = 15.0,
+        timeout: float = None,
+    ) -> threading.Thread:
+        """Record span name from now until condition() is true, polled in a background thread."""
+
+        start = time.perf_counter()
+
+        def watch():
+            while timeout is None or time.perf_counter() - start < timeout:
+                try:
+                    if condition():
+                        self.record(name, time.perf_counter() - start)
+                        self.flush()
+                        return
+                except Exception as e:
+                    logger.debug(f"Polling for {name} failed: {e}")
+                time.sleep(poll_interval)
+
+        # a daemon, so it never keeps the process alive on its own
+        watcher = threading.Thread(target=watch, name=f"metrics-{name}", daemon=True)
+        watcher.start()
+        return watcher
+
+
+def _error_name(error: Exception) -> str:
+    """Batch error code of a BatchErrorException, or the exception's type."""
+
+    code = getattr(getattr(error, "error", None), "code", None)
+    return code or type(error).__name__
+
+
+class _TimedPages(object):
+    def __init__(self, pages, metrics: Metrics, name: str):
+        """Iterate over a paged Batch listing, timing only the time spent fetching.
+
+        The span is recorded once the listing is exhausted, or when it is
+        closed or garbage collected after the caller stopped early.
+        """
+
+        self._pages = iter(pages)
+        self._metrics = metrics
+        self._name = name
+        self._seconds = 0.0
+        self._items = 0
+        self._error = None
+        self._done = False
+
+    def __iter__(self):
+
+        return self
+
+    def __next__(self):
+
+        start = time.perf_counter()
+        try:
+            item = next(self._pages)
+        except StopIteration:
+            self._seconds += time.perf_counter() - start
+            self._finish()
+            raise
+        except Exception as e:
+            self._seconds += time.perf_counter() - start
+            self._error = _error_name(e)
+            self._finish()
+            raise
+        self._seconds += time.perf_counter() - start
+        self._items += 1
+        return item
+
+    def close(self):
+        """Record the span of a listing which was not iterated to the end."""
+
+        self._finish(partial=True)
+
+    def __del__(self):
+
+        try:
+            self._finish(partial=True)
+        except Exception:
+            pass
+
+    def _finish(self, partial: bool = False):
+
+        if not self._done:
+            self._done = True
+            attributes = {"partial": True} if partial else {}
+            self._metrics.record(
+                self._name,
+                self._seconds,
+                error=self._error,
+                retries=self._metrics._take_retries(),
+                items=self._items,
+                **attributes,
+            )
+
+
+class _InstrumentedOperations(object):
+    def __init__(self, operations, group: str, metrics: Metrics):
+
+        self._operations = operations
+        self._group = group
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+
+        attribute = getattr(self._operations, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+        span_name = f"batch.{self._group}.{name}"
+        metrics = self._metrics
+
+        def timed(*args, **kwargs):
+            metrics._take_retries()
+            start = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception as e:
+                metrics.record(
+                    span_name,
+                    time.perf_counter() - start,
+                    error=_error_name(e),
+                    retries=metrics._take_retries(),
+                )
+                raise
+            # listings only fetch their pages while they are iterated
+            if hasattr(result, "advance_page"):
+                return _TimedPages(result, metrics, span_name)
+            metrics.record(
+                span_name, time.perf_counter() - start, retries=metrics._take_retries()
+            )
+            return result
+
+        return timed
+
+
+class InstrumentedClient(object):
+    def __init__(self, client, metrics: Metrics):
+        """Proxy of a BatchServiceClient recording a "batch.<group>.<operation>" span per call.
+
+        Retries made by the client's retry policy are counted with a response
+        hook, from the retry history urllib3 keeps on each response.
+        """
+
+        self._client = client
+        self.metrics = metrics
+        hooks = getattr(getattr(client, "config", None), "hooks", None)
+        if hooks is not None:
+            hooks.append(self._count_retries)
+
+    def _count_retries(self, response, *args, **kwargs):
+
+        retries = getattr(getattr(response, "raw", None), "retries", None)
+        if retries is not None and retries.history:
+            self.metrics.add_retries(len(retries.history))
+        return response
+
+    def __getattr__(self, name):
+
+        attribute = getattr(self._client, name)
+        if name in OPERATION_GROUPS:
+            return _InstrumentedOperations(attribute, name, self.metrics)
+        return attribute
+
+
+def instrument(client, metrics: Metrics):
+    """Time the calls made through client with metrics, re-using the proxy of an instrumented client."""
+
+    if isinstance(client, InstrumentedClient):
+        client.metrics = metrics
+        return client
+    return InstrumentedClient(client, metrics)
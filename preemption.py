@@ -0,0 +1,337 @@
+"""Track low priority node preemptions while a job runs and react to them.
+
+When a low priority node is preempted, the Batch service requeues the tasks
+which were running on it and replaces the node once capacity is available
+again. The PreemptionWatcher follows this as it happens: it logs preempted
+nodes and requeued tasks, reactivates tasks which failed because their node
+went away, and can cover lost capacity with extra dedicated nodes until the
+low priority nodes come back. Observed preemption is recorded per region and
+VM size, so later runs can size pools with a measured preemption rate.
+"""
+
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Callable
+
+import azure.batch.models as batchmodels
+
+logger = logging.getLogger("preemption")
+
+PREEMPTION_STATS_FILE = os.environ.get(
+    "BONSAI_BATCH_PREEMPTION_STATS",
+    os.path.join(str(pathlib.Path.home()), ".bonsai-batch", "preemptions.json"),
+)
+
+
+def _stats_key(region: str, vm_size: str) -> str:
+
+    return f"{region.lower()}/{vm_size.lower()}"
+
+
+def load_preemption_stats(stats_file: str = None) -> dict:
+    """Preemption statistics per "region/vm_size", empty when none were recorded."""
+
+    try:
+        with open(stats_file or PREEMPTION_STATS_FILE) as stats:
+            return json.load(stats)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_preemptions(
+    region: str,
+    vm_size: str,
+    node_samples: int,
+    preempted_samples: int,
+    preemption_events: int,
+    stats_file: str = None,
+):
+    """Add observations to the statistics for region and vm_size.
+
+    Parameters
+    ----------
+    node_samples : int
+        Low priority nodes seen across polls, i.e. node-polls of capacity
+    preempted_samples : int
+        Of those, the node-polls in which a node was preempted
+    preemption_events : int
+        Nodes which went into the preempted state
+    """
+
+    stats_file = stats_file or PREEMPTION_STATS_FILE
+    stats = load_preemption_stats(stats_file)
+    entry = stats.setdefault(
+        _stats_key(region, vm_size),
+        {"node_samples": 0, "preempted_samples": 0, "preemption_events": 0, "runs": 0},
+    )
+    entry["node_samples"] += int(node_samples)
+    entry["preempted_samples"] += int(preempted_samples)
+    entry["preemption_events"] += int(preemption_events)
+    entry["runs"] += 1
+    entry["updated"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    pathlib.Path(stats_file).parent.mkdir(parents=True, exist_ok=True)
+    partial_file = f"{stats_file}.{os.getpid()}.tmp"
+    with open(partial_file, "w") as out:
+        json.dump(stats, out, indent=2, sort_keys=True)
+    os.replace(partial_file, stats_file)
+
+
+def preemption_rate(
+    region: str, vm_size: str, default: float = None, stats_file: str = None
+) -> float:
+    """Share of low priority capacity observed preempted for region and vm_size, or default."""
+
+    entry = load_preemption_stats(stats_file).get(_stats_key(region, vm_size))
+    if not entry or not entry["node_samples"]:
+        return default
+    return entry["preempted_samples"] / entry["node_samples"]
+
+
+class PreemptionWatcher(threading.Thread):
+    def __init__(
+        self,
+        batch,
+        poll_interval: float = 30.0,
+        reactivate: bool = True,
+        max_reactivations: int = 3,
+        max_fallback_dedicated: int = 0,
+        grace_period: float = 300.0,
+        is_done: Callable[[], bool] = None,
+        stats_file: str = None,
+    ):
+        """Watch the pool and job of an AzureBatchContainers instance for preemptions.
+
+        Parameters
+        ----------
+        batch : AzureBatchContainers
+            Client whose pool_id and job_id are watched
+        poll_interval : float, optional
+            Seconds between polls of nodes and tasks, by default 30.0
+        reactivate : bool, optional
+            Reactivate tasks which completed with a server error after their
+            node was lost, by default True
+        max_reactivations : int, optional
+            Times a single task is reactivated, after which it is left failed
+            so a task which keeps failing its node can't loop, by default 3
+        max_fallback_dedicated : int, optional
+            Extra dedicated nodes added while preempted nodes have not been
+            replaced for grace_period seconds, by default 0 (never). Autoscaled
+            pools are left to their formula
+        grace_period : float, optional
+            Seconds preempted nodes are given to come back before falling back
+            to dedicated nodes, by default 300.0
+        is_done : Callable[[], bool], optional
+            Stop watching once this returns True, by default when every task
+            of the job has completed, see AzureBatchContainers.tasks_complete
+        stats_file : str, optional
+            Where preemption statistics are recorded, by default PREEMPTION_STATS_FILE
+        """
+
+        super().__init__(name="preemption-watcher")
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self.reactivate = reactivate
+        self.max_reactivations = int(max_reactivations)
+        self.max_fallback_dedicated = int(max_fallback_dedicated)
+        self.grace_period = grace_period
+        self.is_done = is_done or batch.tasks_complete
+        self.stats_file = stats_file
+        self.preempted_nodes = set()
+        self.preemption_events = 0
+        self.requeued_tasks = 0
+        self.reactivated_tasks = 0
+        self.node_samples = 0
+        self.preempted_samples = 0
+        self.fallback_dedicated = 0
+        self._requeue_counts = {}
+        self._reactivation_counts = {}
+        self._preempted_since = None
+        self._autoscaled = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """Stop watching after the current poll."""
+
+        self._stop_event.set()
+
+    def _poll_nodes(self):
+
+        nodes = self.batch.batch_client.compute_node.list(
+            self.batch.pool_id,
+            compute_node_list_options=batchmodels.ComputeNodeListOptions(
+                select="id,state,isDedicated"
+            ),
+        )
+        preempted = set()
+        for node in nodes:
+            if node.is_dedicated:
+                continue
+            self.node_samples += 1
+            if node.state == batchmodels.ComputeNodeState.preempted:
+                preempted.add(node.id)
+
+        for node_id in preempted - self.preempted_nodes:
+            self.preemption_events += 1
+            logger.warning(f"Node {node_id} was preempted")
+        for node_id in self.preempted_nodes - preempted:
+            logger.info(f"Node {node_id} is back from preemption")
+        self.preempted_nodes = preempted
+        self.preempted_samples += len(preempted)
+
+        if preempted and self._preempted_since is None:
+            self._preempted_since = time.monotonic()
+        elif not preempted:
+            self._preempted_since = None
+
+    def _poll_tasks(self):
+
+        # tasks interrupted by preemption go back to active with a higher requeue count
+        tasks = self.batch.list_tasks(
+            self.batch.job_id,
+            state_filter="state ne 'completed'",
+            select="id,executionInfo",
+        )
+        for task in tasks:
+            info = task.execution_info
+            requeues = info.requeue_count if info else 0
+            if requeues and requeues > self._requeue_counts.get(task.id, 0):
+                self.requeued_tasks += requeues - self._requeue_counts.get(task.id, 0)
+                logger.warning(f"Task {task.id} was requeued ({requeues} times so far)")
+                self._requeue_counts[task.id] = requeues
+
+        if not self.reactivate:
+            return
+        failed = self.batch.list_tasks(
+            self.batch.job_id,
+            state_filter="executionInfo/result eq 'failure'",
+            select="id,executionInfo",
+        )
+        for task in failed:
+            failure = task.execution_info.failure_info if task.execution_info else None
+            if (
+                failure is None
+                or failure.category != batchmodels.ErrorCategory.server_error
+            ):
+                continue
+            reactivations = self._reactivation_counts.get(task.id, 0)
+            if reactivations >= self.max_reactivations:
+                if reactivations == self.max_reactivations:
+                    logger.error(
+                        f"Task {task.id} failed with {failure.code} after {reactivations} reactivations, leaving it failed"
+                    )
+                    # only report it once
+                    self._reactivation_counts[task.id] = reactivations + 1
+                continue
+            try:
+                self.batch.batch_client.task.reactivate(self.batch.job_id, task.id)
+            except batchmodels.BatchErrorException as e:
+                logger.error(f"Could not reactivate task {task.id}: {e}")
+                continue
+            self._reactivation_counts[task.id] = reactivations + 1
+            self.reactivated_tasks += 1
+            logger.warning(
+                f"Reactivated task {task.id} after {failure.code} ({reactivations + 1}/{self.max_reactivations})"
+            )
+
+    def _pool_autoscaled(self) -> bool:
+        """Whether the pool is sized by an autoscale formula, which resize_pool can't override."""
+
+        if self._autoscaled is None:
+            pool = self.batch.batch_client.pool.get(
+                self.batch.pool_id,
+                pool_get_options=batchmodels.PoolGetOptions(select="enableAutoScale"),
+            )
+            self._autoscaled = bool(pool.enable_auto_scale)
+            if self._autoscaled:
+                logger.warning(
+                    f"Pool {self.batch.pool_id} is autoscaled, its formula and not "
+                    "the preemption watcher decides how many dedicated nodes it gets"
+                )
+        return self._autoscaled
+
+    def _fall_back(self):
+        """Cover preempted capacity with dedicated nodes, and remove them again once it is back."""
+
+        if not self.max_fallback_dedicated:
+            return
+        waited = (
+            time.monotonic() - self._preempted_since
+            if self._preempted_since is not None
+            else 0
+        )
+        wanted = (
+            min(len(self.preempted_nodes), self.max_fallback_dedicated)
+            if waited >= self.grace_period
+            else 0
+        )
+        if wanted == self.fallback_dedicated or (
+            wanted and wanted < self.fallback_dedicated
+        ):
+            return
+        if self._pool_autoscaled():
+            return
+        config = self.batch.config["POOL"]
+        if wanted:
+            logger.warning(
+                f"Adding {wanted - self.fallback_dedicated} dedicated nodes to cover preempted capacity"
+            )
+        else:
+            logger.info(
+                f"Removing the {self.fallback_dedicated} dedicated nodes added for preempted capacity"
+            )
+        self.batch.resize_pool(
+            pool_id=self.batch.pool_id,
+            dedicated_nodes=int(config["DEDICATED_NODES"]) + wanted,
+            low_pri_nodes=int(config["LOW_PRI_NODES"]),
+        )
+        self.fallback_dedicated = wanted
+
+    def summary(self) -> dict:
+
+        return {
+            "preemption_events": self.preemption_events,
+            "requeued_tasks": self.requeued_tasks,
+            "reactivated_tasks": self.reactivated_tasks,
+            "preempted_share": self.preempted_samples / max(self.node_samples, 1),
+        }
+
+    def run(self):
+
+        while not self._stop_event.is_set():
+            try:
+                self._poll_nodes()
+                self._poll_tasks()
+                self._fall_back()
+                if self.is_done():
+                    break
+            # keep watching through transient failures, the thread is the only one doing so
+            except Exception as e:
+                logger.error(f"Preemption watcher poll failed: {e}")
+            self._stop_event.wait(self.poll_interval)
+
+        if self.fallback_dedicated:
+            self.preempted_nodes, self._preempted_since = set(), None
+            try:
+                self._fall_back()
+            except Exception as e:
+                logger.error(
+                    f"Could not remove the {self.fallback_dedicated} fallback dedicated nodes: {e}"
+                )
+        logger.info(
+            "Preemption watcher finished: {preemption_events} preemptions, {requeued_tasks} "
+            "tasks requeued, {reactivated_tasks} reactivated".format(**self.summary())
+        )
+        if self.node_samples:
+            record_preemptions(
+                self.batch.config["BATCH"]["LOCATION"],
+                self.batch.config["POOL"]["VM_SIZE"].strip("'"),
+                self.node_samples,
+                self.preempted_samples,
+                self.preemption_events,
+                stats_file=self.stats_file,
+            )
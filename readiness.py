@@ -0,0 +1,352 @@
+#! /usr/bin/env python
+"""Profile how long a pool takes to get its nodes ready, and where the time goes.
+
+After pool.add or pool.resize, a ReadinessProfiler samples the pool's nodes
+until the allocation is steady and every new node is ready (idle or
+running) or has given up (unusable, start task failed). Each node gets a
+timeline of its states and the phases of its way to ready, measured from the
+service timestamps from the moment the pool started resizing:
+
+- allocation: until the node was allocated
+- boot: from allocation until the VM booted
+- image_pull: from boot until the start task started (or the node became
+  ready without one), which is when Batch pulls the pool's container images
+- start_task: the start task itself
+- ready: until the node could take tasks
+
+Pool percentiles (p50/p95) of every phase are recorded in the StateStore
+together with the region, VM size and images, so profiles can be compared:
+
+    python batch_containers.py run_tasks --profile_readiness ...
+    python readiness.py profile
+    python readiness.py history --vm_size Standard_E2s_v3
+    python readiness.py compare
+"""
+
+import datetime
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+import azure.batch.models as batchmodels
+import fire
+
+from metrics import percentile
+
+logger = logging.getLogger("readiness")
+
+PHASES = ("allocation", "boot", "image_pull", "start_task", "ready")
+READY_STATES = (
+    batchmodels.ComputeNodeState.idle,
+    batchmodels.ComputeNodeState.running,
+)
+# nodes in these states will not become ready without intervention
+GIVEN_UP_STATES = (
+    batchmodels.ComputeNodeState.unusable,
+    batchmodels.ComputeNodeState.start_task_failed,
+    batchmodels.ComputeNodeState.preempted,
+)
+# seconds a command waits for a profile in progress before recording what it has
+FINISH_TIMEOUT = 300.0
+
+
+def _state_name(state) -> str:
+
+    return getattr(state, "value", state)
+
+
+def _seconds(moment, since) -> Optional[float]:
+
+    if moment is None or since is None:
+        return None
+    return round((moment - since).total_seconds(), 1)
+
+
+def node_sample(node: batchmodels.ComputeNode) -> dict:
+    """Timestamps of a compute node which node_phases measures, ready_time only once it is ready."""
+
+    info = node.start_task_info
+    sample = {
+        "allocation_time": node.allocation_time,
+        "last_boot_time": node.last_boot_time,
+        "start_task_start": info.start_time if info else None,
+        "start_task_end": info.end_time if info else None,
+    }
+    if node.state in READY_STATES:
+        # a node may already run a task when sampled, it was ready when its start task ended
+        ended = info.end_time if info else None
+        sample["ready_time"] = ended or node.state_transition_time
+    return sample
+
+
+def node_phases(node: dict, started: datetime.datetime = None) -> dict:
+    """Seconds spent in each phase of PHASES by a node_sample, None for phases not reached.
+
+    allocation and ready are measured from started, when the pool began
+    resizing, and are None without it.
+    """
+
+    allocated = node.get("allocation_time")
+    booted = node.get("last_boot_time")
+    start_task_started = node.get("start_task_start")
+    start_task_ended = node.get("start_task_end")
+    ready = node.get("ready_time")
+    pulled = start_task_started or ready
+    return {
+        "allocation": _seconds(allocated, started),
+        "boot": _seconds(booted, allocated),
+        "image_pull": _seconds(pulled, booted),
+        "start_task": _seconds(start_task_ended, start_task_started),
+        "ready": _seconds(ready, started),
+    }
+
+
+def summarize(nodes: dict, started: datetime.datetime) -> dict:
+    """Per phase p50, p95 and max seconds across nodes."""
+
+    phases = [node_phases(node, started) for node in nodes.values()]
+    return {
+        phase: {
+            "p50": percentile([p[phase] for p in phases], 50),
+            "p95": percentile([p[phase] for p in phases], 95),
+            "max": percentile([p[phase] for p in phases], 100),
+        }
+        for phase in PHASES
+    }
+
+
+class ReadinessProfiler(threading.Thread):
+    def __init__(
+        self,
+        batch,
+        pool_id: str = None,
+        poll_interval: float = 10.0,
+        timeout: float = 3600.0,
+        on_finished: Callable[[dict], None] = None,
+    ):
+        """Sample the nodes of a pool which is being created or resized until they are ready.
+
+        Parameters
+        ----------
+        batch : AzureBatchContainers
+            Client of the pool, whose state_store (or a new StateStore) keeps the profile
+        pool_id : str, optional
+            Pool to profile, by default batch.pool_id
+        poll_interval : float, optional
+            Seconds between samples of the pool's nodes, by default 10.0
+        timeout : float, optional
+            Give up on nodes which are not ready after this many seconds, by default 3600.0
+        on_finished : Callable[[dict], None], optional
+            Called with the profile once it is recorded, by default None
+        """
+
+        # a daemon, so it never keeps the process alive: commands call finish
+        super().__init__(name="readiness-profiler", daemon=True)
+        self.batch = batch
+        self.pool_id = pool_id or batch.pool_id
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.on_finished = on_finished
+        self.started = None
+        self.nodes = {}
+        self.profile = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """Stop sampling after the current poll and record what was seen so far."""
+
+        self._stop_event.set()
+
+    def finish(self, timeout: float = FINISH_TIMEOUT):
+        """Wait up to timeout seconds for the nodes to be ready, then stop and record the profile."""
+
+        self.join(timeout)
+        if self.is_alive():
+            logger.warning(
+                f"Pool {self.pool_id} nodes were not all ready after waiting {timeout:.0f} "
+                "seconds, recording the profile so far"
+            )
+            self.stop()
+            self.join()
+
+    def _poll_pool(self) -> batchmodels.CloudPool:
+
+        return self.batch.batch_client.pool.get(
+            self.pool_id,
+            pool_get_options=batchmodels.PoolGetOptions(
+                select="id,allocationState,allocationStateTransitionTime,creationTime"
+            ),
+        )
+
+    def _poll_nodes(self) -> bool:
+        """Sample the nodes, returning True once every new node is ready or has given up."""
+
+        nodes = self.batch.batch_client.compute_node.list(
+            self.pool_id,
+            compute_node_list_options=batchmodels.ComputeNodeListOptions(
+                select="id,state,stateTransitionTime,allocationTime,lastBootTime,isDedicated,startTaskInfo"
+            ),
+        )
+        settled = True
+        for node in nodes:
+            # nodes allocated before the resize were already warm
+            if node.allocation_time and node.allocation_time < self.started:
+                continue
+            sample = self.nodes.setdefault(
+                node.id, {"dedicated": node.is_dedicated, "timeline": []}
+            )
+            timeline = sample["timeline"]
+            if not timeline or timeline[-1][0] != _state_name(node.state):
+                timeline.append(
+                    (
+                        _state_name(node.state),
+                        _seconds(node.state_transition_time, self.started),
+                    )
+                )
+            times = node_sample(node)
+            ready_time = times.pop("ready_time", None)
+            sample.update(times)
+            if ready_time is not None:
+                # the first time it was seen ready
+                sample.setdefault("ready_time", ready_time)
+            elif node.state not in GIVEN_UP_STATES:
+                settled = False
+        return settled
+
+    def build_profile(self) -> dict:
+        """Pool and per-node results of the samples so far."""
+
+        summary = summarize(self.nodes, self.started)
+        config = self.batch.config
+        return {
+            "pool_id": self.pool_id,
+            "account": config["BATCH"]["ACCOUNT_NAME"],
+            "region": config["BATCH"]["LOCATION"],
+            "vm_size": config["POOL"]["VM_SIZE"].strip("'"),
+            "images": self.batch.pulled_images
+            or [self.batch.image_name + ":" + self.batch.image_version],
+            "started": self.started.isoformat(),
+            "nodes": len(self.nodes),
+            "ready_nodes": sum(1 for n in self.nodes.values() if "ready_time" in n),
+            "phases": summary,
+            "node_timelines": {
+                node_id: {
+                    "dedicated": node["dedicated"],
+                    "timeline": node["timeline"],
+                    "phases": node_phases(node, self.started),
+                }
+                for node_id, node in self.nodes.items()
+            },
+        }
+
+    def run(self):
+
+        from state_store import StateStore
+
+        deadline = time.monotonic() + self.timeout
+        while not self._stop_event.is_set():
+            try:
+                pool = self._poll_pool()
+                if self.started is None:
+                    self.started = (
+                        pool.allocation_state_transition_time or pool.creation_time
+                    )
+                steady = pool.allocation_state == batchmodels.AllocationState.steady
+                if self._poll_nodes() and steady:
+                    break
+            # keep sampling through transient failures, a profile is only recorded at the end
+            except Exception as e:
+                logger.error(f"Readiness profiler poll failed: {e}")
+            if time.monotonic() > deadline:
+                logger.warning(
+                    f"Pool {self.pool_id} nodes were not all ready after {self.timeout:.0f} seconds"
+                )
+                break
+            self._stop_event.wait(self.poll_interval)
+
+        if not self.nodes:
+            logger.info(
+                f"No nodes were allocated to pool {self.pool_id}, nothing to profile"
+            )
+            return
+        self.profile = self.build_profile()
+        ready = self.profile["phases"]["ready"]
+        logger.info(
+            "Pool {0}: {1}/{2} nodes ready, time to ready p50 {3}s, p95 {4}s, max {5}s".format(
+                self.pool_id,
+                self.profile["ready_nodes"],
+                self.profile["nodes"],
+                ready["p50"],
+                ready["p95"],
+                ready["max"],
+            )
+        )
+        for phase in PHASES[:-1]:
+            logger.info(
+                "  {0}: p50 {1}s, p95 {2}s".format(
+                    phase,
+                    self.profile["phases"][phase]["p50"],
+                    self.profile["phases"][phase]["p95"],
+                )
+            )
+        (self.batch.state_store or StateStore()).record_readiness(self.profile)
+        if self.on_finished is not None:
+            self.on_finished(self.profile)
+
+
+def profile(config_file: str = None, poll_interval: float = 10.0):
+    """Profile the configured pool until its nodes are ready, e.g. right after a resize."""
+
+    from batch_containers import get_batch_containers, user_config
+
+    batch_pool = get_batch_containers(config_file=config_file or user_config)
+    profiler = ReadinessProfiler(
+        batch_pool,
+        pool_id=batch_pool.config["POOL"]["POOL_ID"].strip("'"),
+        poll_interval=poll_interval,
+    )
+    profiler.start()
+    profiler.join()
+    return profiler.profile
+
+
+def history(vm_size: str = None, region: str = None, limit: int = 20, path: str = None):
+    """Recorded readiness profiles, newest first, optionally for one VM size or region."""
+
+    from state_store import StateStore
+
+    return StateStore(path).readiness(vm_size=vm_size, region=region, limit=limit)
+
+
+def _mean(values) -> Optional[float]:
+
+    values = [v for v in values if v is not None]
+    return round(sum(values) / len(values), 1) if values else None
+
+
+def compare(path: str = None):
+    """Average p50/p95 time to ready per region, VM size and images across recorded profiles."""
+
+    from state_store import StateStore
+
+    groups = {}
+    for row in StateStore(path).readiness(limit=None):
+        key = (row["region"], row["vm_size"], tuple(row["images"]))
+        groups.setdefault(key, []).append(row)
+    return [
+        {
+            "region": region,
+            "vm_size": vm_size,
+            "images": list(images),
+            "profiles": len(rows),
+            "ready_p50": _mean(r["ready_p50"] for r in rows),
+            "ready_p95": _mean(r["ready_p95"] for r in rows),
+        }
+        for (region, vm_size, images), rows in sorted(groups.items())
+    ]
+
+
+if __name__ == "__main__":
+
+    fire.Fire({"profile": profile, "history": history, "compare": compare})
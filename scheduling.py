@@ -0,0 +1,397 @@
+"""Background schedulers releasing tasks to the Batch service over time."""
+
+import logging
+import threading
+import time
+from typing import Callable, Iterable, List, Optional
+
+logger = logging.getLogger("scheduling")
+
+# longest wait between retries of a failing progress or capacity poll
+MAX_POLL_BACKOFF = 300.0
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, burst: int = 1):
+        """Token bucket refilled at rate tokens per second, holding at most burst tokens.
+
+        Parameters
+        ----------
+        rate : float
+            Tokens added per second
+        burst : int, optional
+            Bucket capacity, i.e. how many tokens can be taken at once, by default 1
+        """
+
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        self.rate = float(rate)
+        self.burst = max(int(burst), 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, max_tokens: int) -> int:
+        """Take up to max_tokens whole tokens without waiting, returning how many were taken."""
+
+        with self._lock:
+            self._refill()
+            taken = min(int(self._tokens), max_tokens)
+            self._tokens -= taken
+            return taken
+
+    def wait_time(self) -> float:
+        """Seconds until the next whole token is available."""
+
+        with self._lock:
+            self._refill()
+            return max(1.0 - self._tokens, 0.0) / self.rate
+
+
+class SubmissionScheduler(threading.Thread):
+    def __init__(
+        self,
+        submit: Callable[[List], dict],
+        tasks: Iterable,
+        rate: float = None,
+        burst: int = 1,
+        schedule: Iterable[float] = None,
+        max_batch: int = 100,
+        on_finished: Callable[[dict], None] = None,
+        submitted: int = 0,
+    ):
+        """Release tasks to submit from a background thread, paced by a rate or a schedule.
+
+        With a rate, tasks are released by a TokenBucket so that on average
+        rate tasks per second are submitted, with at most burst at once. With
+        a schedule, each task carries a not-before offset in seconds from the
+        start of the scheduler; offsets are honoured in order, so a task never
+        overtakes the one before it. Tasks released together are submitted as
+        a single batch of at most max_batch.
+
+        Parameters
+        ----------
+        submit : Callable[[List], dict]
+            Called with each batch of released tasks, returning a mapping of
+            task id to error for the tasks which could not be submitted
+        tasks : Iterable
+            Tasks to submit, consumed lazily
+        rate : float, optional
+            Tasks released per second, by default None (no limit)
+        burst : int, optional
+            Tasks which may be released at once under a rate, by default 1
+        schedule : Iterable[float], optional
+            Not-before offset in seconds for each task, by default None
+        max_batch : int, optional
+            Largest batch passed to submit, by default 100
+        on_finished : Callable[[dict], None], optional
+            Called with the failures once every task was released, not when
+            the scheduler is stopped early or reading tasks failed, by default None
+        submitted : int, optional
+            Tasks submitted before, e.g. by a run which is being resumed, by default 0
+        """
+
+        super().__init__(name="submission-scheduler")
+        self.submit = submit
+        self.tasks = iter(tasks)
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.schedule = iter(schedule) if schedule is not None else None
+        self.max_batch = max(int(max_batch), 1)
+        self.on_finished = on_finished
+        self.submitted = int(submitted)
+        self.failures = {}
+        # the exception which stopped the scheduler early, if any
+        self.error = None
+        self._stop_event = threading.Event()
+        self._pending = None
+
+    def stop(self):
+        """Stop releasing tasks, the batch being submitted is finished first."""
+
+        self._stop_event.set()
+
+    def _next_task(self):
+
+        return next(self.tasks, None)
+
+    def _next_scheduled(self):
+
+        if self._pending is not None:
+            scheduled, self._pending = self._pending, None
+            return scheduled
+        task = next(self.tasks, None)
+        if task is None:
+            return None
+        return task, next(self.schedule, 0.0)
+
+    def _release_scheduled(self, start: float) -> List:
+
+        scheduled = self._next_scheduled()
+        if scheduled is None:
+            return []
+        task, not_before = scheduled
+        if self._stop_event.wait(max(start + not_before - time.monotonic(), 0)):
+            return []
+        released = [task]
+        # tasks which are already due go out in the same batch
+        while len(released) < self.max_batch:
+            scheduled = self._next_scheduled()
+            if scheduled is None:
+                break
+            if start + scheduled[1] > time.monotonic():
+                self._pending = scheduled
+                break
+            released.append(scheduled[0])
+        return released
+
+    def _release_rated(self) -> List:
+
+        released = []
+        while not released and not self._stop_event.is_set():
+            tokens = self.bucket.take(self.max_batch)
+            if not tokens:
+                self._stop_event.wait(self.bucket.wait_time())
+                continue
+            while len(released) < tokens:
+                task = self._next_task()
+                if task is None:
+                    return released
+                released.append(task)
+        return released
+
+    def _release_all(self) -> List:
+
+        released = []
+        while len(released) < self.max_batch:
+            task = self._next_task()
+            if task is None:
+                break
+            released.append(task)
+        return released
+
+    def run(self):
+
+        start = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                if self.schedule is not None:
+                    released = self._release_scheduled(start)
+                elif self.bucket is not None:
+                    released = self._release_rated()
+                else:
+                    released = self._release_all()
+            except Exception as e:
+                # a task source which raised is finished, there is nothing to retry
+                logger.error(
+                    f"Reading the next tasks failed, stopping the scheduler: {e}"
+                )
+                self.error = e
+                break
+            if not released:
+                break
+            try:
+                self.failures.update(self.submit(released) or {})
+            except Exception as e:
+                logger.error(f"Submitting {len(released)} tasks failed: {e}")
+                self.failures.update({task.id: str(e) for task in released})
+            self.submitted += len(released)
+            logger.debug(f"Released {len(released)} tasks, {self.submitted} so far")
+
+        logger.info(
+            "Scheduler {0}: {1} tasks released in {2:.0f}s, {3} failed".format(
+                "stopped" if self.error is not None else "finished",
+                self.submitted,
+                time.monotonic() - start,
+                len(self.failures),
+            )
+        )
+        if (
+            self.on_finished is not None
+            and not self._stop_event.is_set()
+            and self.error is None
+        ):
+            self.on_finished(self.failures)
+
+
+class SlotAwareScheduler(threading.Thread):
+    def __init__(
+        self,
+        submit: Callable[[List], dict],
+        tasks: Iterable,
+        progress: Callable[[], tuple],
+        capacity: Callable[[], int],
+        poll_interval: float = 5.0,
+        max_batch: int = 100,
+        total: int = None,
+        on_finished: Callable[[dict], None] = None,
+        submitted: int = 0,
+        max_poll_errors: int = 10,
+    ):
+        """Keep the job filled up to the pool's free task slots, pulling more tasks as others complete.
+
+        Instead of queueing every task up front, only enough tasks are
+        submitted to occupy the capacity reported by the pool, so the service
+        side backlog stays bounded however long the task source is.
+
+        Parameters
+        ----------
+        submit : Callable[[List], dict]
+            Called with each batch of tasks, returning a mapping of task id to
+            error for the tasks which could not be submitted
+        tasks : Iterable
+            Tasks to submit, consumed lazily
+        progress : Callable[[], tuple]
+            Returns (in_flight, completed) task counts of the job, where in
+            flight are tasks which are active or running
+        capacity : Callable[[], int]
+            Returns the number of tasks which should be in flight, e.g. the
+            pool's task slots plus a small queued backlog
+        poll_interval : float, optional
+            Seconds between polls of progress and capacity, by default 5.0
+        max_batch : int, optional
+            Largest batch passed to submit, by default 100
+        total : int, optional
+            Number of tasks in the source, used for reporting only, by default None
+        on_finished : Callable[[dict], None], optional
+            Called with the failures once the source is exhausted, by default None
+        submitted : int, optional
+            Tasks submitted before, e.g. by a run which is being resumed, by default 0
+        max_poll_errors : int, optional
+            Consecutive failed polls of progress or capacity, retried with an
+            exponential backoff, before the scheduler gives up, by default 10
+        """
+
+        super().__init__(name="slot-aware-scheduler")
+        self.submit = submit
+        self.tasks = iter(tasks)
+        self.progress = progress
+        self.capacity = capacity
+        self.poll_interval = poll_interval
+        self.max_batch = max(int(max_batch), 1)
+        self.total = total
+        self.on_finished = on_finished
+        self.submitted = int(submitted)
+        self.max_poll_errors = int(max_poll_errors)
+        self.failures = {}
+        self.exhausted = False
+        # the exception which stopped the scheduler early, if any
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """Stop pulling tasks, the batch being submitted is finished first."""
+
+        self._stop_event.set()
+
+    def _next_task(self):
+
+        try:
+            return next(self.tasks, None)
+        except Exception as e:
+            # a task source which raised is finished, there is nothing to retry
+            logger.error(f"Reading the next task failed, stopping the scheduler: {e}")
+            self.error = e
+            return None
+
+    def _poll(self) -> Optional[tuple]:
+        """(in_flight, completed, target), retrying failed polls with a backoff.
+
+        Returns None when stopped or once max_poll_errors polls in a row failed,
+        the last error is kept in self.error.
+        """
+
+        failed = 0
+        while not self._stop_event.is_set():
+            try:
+                in_flight, completed = self.progress()
+                return in_flight, completed, self.capacity()
+            except Exception as e:
+                failed += 1
+                if failed >= self.max_poll_errors:
+                    logger.error(
+                        f"Polling the job's progress failed {failed} times, stopping the scheduler: {e}"
+                    )
+                    self.error = e
+                    return None
+                backoff = min(self.poll_interval * 2**failed, MAX_POLL_BACKOFF)
+                logger.warning(
+                    f"Polling the job's progress failed ({e}), retrying in {backoff:.0f}s"
+                )
+                self._stop_event.wait(backoff)
+        return None
+
+    def _report(self, in_flight: int, completed: int, target: int):
+
+        queued = (
+            "{} queued locally".format(self.total - self.submitted)
+            if self.total is not None
+            else "source exhausted"
+            if self.exhausted
+            else "more queued locally"
+        )
+        logger.info(
+            "Submitted {0}{1}, in flight {2}/{3}, completed {4}, {5}".format(
+                self.submitted,
+                f"/{self.total}" if self.total is not None else "",
+                in_flight,
+                target,
+                completed,
+                queued,
+            )
+        )
+
+    def run(self):
+
+        last_report = None
+        while not self._stop_event.is_set() and not self.exhausted:
+            polled = self._poll()
+            if polled is None:
+                break
+            in_flight, completed, target = polled
+            # task counts lag behind submissions, never trust them below what we know
+            accepted = self.submitted - len(self.failures)
+            in_flight = max(in_flight, accepted - completed)
+
+            free = target - in_flight
+            while free > 0 and not self.exhausted and self.error is None:
+                released = []
+                while len(released) < min(free, self.max_batch):
+                    task = self._next_task()
+                    if task is None:
+                        self.exhausted = self.error is None
+                        break
+                    released.append(task)
+                if not released:
+                    break
+                try:
+                    self.failures.update(self.submit(released) or {})
+                except Exception as e:
+                    logger.error(f"Submitting {len(released)} tasks failed: {e}")
+                    self.failures.update({task.id: str(e) for task in released})
+                self.submitted += len(released)
+                in_flight += len(released)
+                free -= len(released)
+
+            if (self.submitted, in_flight, completed, target) != last_report:
+                self._report(in_flight, completed, target)
+                last_report = (self.submitted, in_flight, completed, target)
+            if self.error is not None:
+                break
+            if not self.exhausted:
+                self._stop_event.wait(self.poll_interval)
+
+        logger.info(
+            "Slot-aware scheduler {0}: {1} tasks submitted, {2} failed".format(
+                "stopped" if self.error is not None else "finished",
+                self.submitted,
+                len(self.failures),
+            )
+        )
+        if self.on_finished is not None and self.exhausted:
+            self.on_finished(self.failures)
@@ -0,0 +1,334 @@
+#! /usr/bin/env python
+"""Local record of runs, submitted tasks and warm pools.
+
+Every batch_main run is recorded in a sqlite database together with the
+pool and job it uses and each task the service accepted. When the
+submitting process dies before all tasks were submitted, running the same
+command again finds the unfinished run and only submits the missing tasks
+into the existing job.
+
+Readiness profiles of pools (see readiness.py) are kept with their region,
+VM size and images to compare how quickly pools become usable.
+
+Pools are registered with the fingerprint of their configuration, so
+create_pool can find an idle pool with the same image, VM size, mounts and
+start task and re-use it instead of allocating new nodes:
+
+    python state_store.py runs
+    python state_store.py tasks --job_id Job-cartpole-2021-01-01-00-00-00
+    python state_store.py pools
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+from typing import Iterable, List, Optional
+
+import fire
+
+logger = logging.getLogger("state_store")
+
+STATE_DB = os.environ.get(
+    "BONSAI_BATCH_STATE_DB",
+    os.path.join(str(pathlib.Path.home()), ".bonsai-batch", "state.db"),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_key TEXT NOT NULL,
+    job_id TEXT PRIMARY KEY,
+    pool_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_key ON runs (run_key, status);
+CREATE TABLE IF NOT EXISTS tasks (
+    job_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    updated TEXT NOT NULL,
+    PRIMARY KEY (job_id, task_id)
+);
+CREATE TABLE IF NOT EXISTS pools (
+    account TEXT NOT NULL,
+    pool_id TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    vm_size TEXT,
+    created TEXT NOT NULL,
+    last_used TEXT NOT NULL,
+    PRIMARY KEY (account, pool_id)
+);
+CREATE TABLE IF NOT EXISTS readiness (
+    account TEXT NOT NULL,
+    pool_id TEXT NOT NULL,
+    region TEXT,
+    vm_size TEXT,
+    images TEXT,
+    started TEXT NOT NULL,
+    nodes INTEGER NOT NULL,
+    ready_nodes INTEGER NOT NULL,
+    ready_p50 REAL,
+    ready_p95 REAL,
+    profile TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS readiness_by_size ON readiness (vm_size, region);
+"""
+
+# a run is unfinished until every one of its tasks was accepted by the service
+SUBMITTING = "submitting"
+SUBMITTED = "submitted"
+# an unfinished run whose job is gone or no longer active, never resumed
+ABANDONED = "abandoned"
+# unfinished runs older than this are not resumed
+RESUME_MAX_AGE_HOURS = 24
+
+
+def _now() -> str:
+
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def run_key(*parts) -> str:
+    """Stable digest identifying a run from the parts describing it."""
+
+    return hashlib.sha1(
+        json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class StateStore(object):
+    def __init__(self, path: str = None):
+        """sqlite store of runs, their submitted tasks and warm pools, safe to share between threads.
+
+        Parameters
+        ----------
+        path : str, optional
+            Database file, by default STATE_DB (~/.bonsai-batch/state.db)
+        """
+
+        self.path = path or STATE_DB
+        pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+
+        self._conn.close()
+
+    def _execute(self, sql: str, parameters=()) -> List[sqlite3.Row]:
+
+        with self._lock, self._conn:
+            return self._conn.execute(sql, parameters).fetchall()
+
+    def unfinished_run(
+        self, key: str, max_age_hours: float = RESUME_MAX_AGE_HOURS
+    ) -> Optional[dict]:
+        """Latest run with this key which did not get all of its tasks submitted, updated within max_age_hours."""
+
+        cutoff = (
+            datetime.datetime.now() - datetime.timedelta(hours=max_age_hours)
+        ).isoformat(timespec="seconds")
+        rows = self._execute(
+            "SELECT * FROM runs WHERE run_key = ? AND status = ? AND updated >= ? ORDER BY created DESC LIMIT 1",
+            (key, SUBMITTING, cutoff),
+        )
+        return dict(rows[0]) if rows else None
+
+    def start_run(self, key: str, pool_id: str, job_id: str):
+
+        now = _now()
+        self._execute(
+            "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)",
+            (key, job_id, pool_id, SUBMITTING, now, now),
+        )
+
+    def move_run(self, job_id: str, key: str, pool_id: str):
+        """Point a run at the pool it really uses, e.g. a warm pool reused by create_pool."""
+
+        self._execute(
+            "UPDATE runs SET run_key = ?, pool_id = ?, updated = ? WHERE job_id = ?",
+            (key, pool_id, _now(), job_id),
+        )
+
+    def finish_run(self, job_id: str, status: str = SUBMITTED):
+
+        self._execute(
+            "UPDATE runs SET status = ?, updated = ? WHERE job_id = ?",
+            (status, _now(), job_id),
+        )
+
+    def record_tasks(self, job_id: str, task_ids: Iterable[str], failures: dict = None):
+        """Record tasks accepted by the service, and the error of those which were not."""
+
+        now = _now()
+        rows = [(job_id, task_id, SUBMITTED, None, now) for task_id in task_ids]
+        rows += [
+            (job_id, task_id, "failed", str(error), now)
+            for task_id, error in (failures or {}).items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?)", rows
+            )
+            # a run is only resumed while it is recent, see unfinished_run
+            self._conn.execute(
+                "UPDATE runs SET updated = ? WHERE job_id = ?", (now, job_id)
+            )
+
+    def submitted_task_ids(self, job_id: str) -> set:
+
+        rows = self._execute(
+            "SELECT task_id FROM tasks WHERE job_id = ? AND status = ?",
+            (job_id, SUBMITTED),
+        )
+        return {row["task_id"] for row in rows}
+
+    def register_pool(
+        self, account: str, pool_id: str, fingerprint: str, vm_size: str = None
+    ):
+        """Record a pool and its fingerprint, or mark a known pool as just used."""
+
+        now = _now()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO pools VALUES (?, ?, ?, ?, ?, ?)",
+                (account, pool_id, fingerprint, vm_size, now, now),
+            )
+            self._conn.execute(
+                "UPDATE pools SET fingerprint = ?, vm_size = ?, last_used = ? WHERE account = ? AND pool_id = ?",
+                (fingerprint, vm_size, now, account, pool_id),
+            )
+
+    def forget_pool(self, account: str, pool_id: str):
+
+        self._execute(
+            "DELETE FROM pools WHERE account = ? AND pool_id = ?", (account, pool_id)
+        )
+
+    def pool_fingerprint(self, account: str, pool_id: str) -> Optional[str]:
+
+        rows = self._execute(
+            "SELECT fingerprint FROM pools WHERE account = ? AND pool_id = ?",
+            (account, pool_id),
+        )
+        return rows[0]["fingerprint"] if rows else None
+
+    def compatible_pools(self, account: str, fingerprint: str) -> List[str]:
+        """Registered pools with this fingerprint, most recently used first."""
+
+        rows = self._execute(
+            "SELECT pool_id FROM pools WHERE account = ? AND fingerprint = ? ORDER BY last_used DESC",
+            (account, fingerprint),
+        )
+        return [row["pool_id"] for row in rows]
+
+    def pools(self) -> List[dict]:
+
+        return [
+            dict(row)
+            for row in self._execute("SELECT * FROM pools ORDER BY last_used DESC")
+        ]
+
+    def record_readiness(self, profile: dict):
+        """Keep a ReadinessProfiler profile, summarized for comparisons and in full as JSON."""
+
+        ready = profile["phases"]["ready"]
+        self._execute(
+            "INSERT INTO readiness VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                profile["account"],
+                profile["pool_id"],
+                profile["region"],
+                profile["vm_size"],
+                json.dumps(profile["images"]),
+                profile["started"],
+                profile["nodes"],
+                profile["ready_nodes"],
+                ready["p50"],
+                ready["p95"],
+                json.dumps(profile, default=str),
+            ),
+        )
+
+    def readiness(
+        self, vm_size: str = None, region: str = None, limit: Optional[int] = 20
+    ) -> List[dict]:
+        """Readiness profiles, newest first, with their phase percentiles."""
+
+        where, parameters = [], []
+        if vm_size:
+            where.append("vm_size = ?")
+            parameters.append(vm_size)
+        if region:
+            where.append("region = ?")
+            parameters.append(region)
+        sql = "SELECT * FROM readiness"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY started DESC"
+        if limit:
+            sql += " LIMIT ?"
+            parameters.append(int(limit))
+        rows = []
+        for row in self._execute(sql, parameters):
+            row = dict(row)
+            row["images"] = json.loads(row["images"])
+            row["phases"] = json.loads(row.pop("profile"))["phases"]
+            rows.append(row)
+        return rows
+
+    def runs(self, limit: int = 20) -> List[dict]:
+
+        rows = self._execute(
+            """
+            SELECT runs.*, COUNT(tasks.task_id) AS submitted_tasks
+            FROM runs LEFT JOIN tasks
+                ON tasks.job_id = runs.job_id AND tasks.status = 'submitted'
+            GROUP BY runs.job_id ORDER BY runs.created DESC LIMIT ?
+            """,
+            (int(limit),),
+        )
+        return [dict(row) for row in rows]
+
+    def tasks(self, job_id: str, status: str = None) -> List[dict]:
+
+        if status:
+            rows = self._execute(
+                "SELECT * FROM tasks WHERE job_id = ? AND status = ?", (job_id, status)
+            )
+        else:
+            rows = self._execute("SELECT * FROM tasks WHERE job_id = ?", (job_id,))
+        return [dict(row) for row in rows]
+
+
+def runs(limit: int = 20, path: str = None):
+    """Most recent runs with their job, pool, status and number of submitted tasks."""
+
+    return StateStore(path).runs(limit)
+
+
+def tasks(job_id: str, status: str = None, path: str = None):
+    """Recorded tasks of a job, optionally only those with status submitted or failed."""
+
+    return StateStore(path).tasks(job_id, status)
+
+
+def pools(path: str = None):
+    """Registered warm pools with their fingerprint and when they were last used."""
+
+    return StateStore(path).pools()
+
+
+if __name__ == "__main__":
+
+    fire.Fire({"runs": runs, "tasks": tasks, "pools": pools})
@@ -0,0 +1,323 @@
+#! /usr/bin/env python
+"""Parameter sweeps over a command template, submitted with run_tasks.
+
+A sweep combines a command template such as
+``python main.py --lr {lr} --layers {layers}`` with a parameter space:
+
+- a list of values is searched exhaustively by grid, sampled uniformly by
+  random and stratified by latin_hypercube
+- a (low, high) tuple is a continuous range (integers when both ends are int)
+
+Points are written lazily to a JSON lines manifest, one task per line with a
+deterministic id, its command and its parameters, which run_tasks then reads
+back lazily. Each task gets its parameters as SWEEP_* environment variables,
+and results_table joins task outputs back onto the parameter rows:
+
+    python sweep.py run --template "python main.py --lr {lr}" --space "{'lr': (0.0001, 0.1)}" --method latin_hypercube --num_samples 10000
+    python batch_containers.py copy_logs --file_path stdout.txt
+    python sweep.py results --manifest sweep-manifest.jsonl
+"""
+
+import hashlib
+import itertools
+import json
+import logging
+import pathlib
+import re
+from typing import Iterable, Iterator
+
+import fire
+import numpy as np
+
+logger = logging.getLogger("sweep")
+
+SWEEP_METHODS = ("grid", "random", "latin_hypercube")
+# task ids may only hold letters, digits, hyphens and underscores, up to 64 characters
+MAX_TASK_ID_LENGTH = 64
+
+
+def _is_range(values) -> bool:
+
+    return isinstance(values, tuple) and len(values) == 2
+
+
+def _is_int_range(values) -> bool:
+
+    return all(isinstance(v, (int, np.integer)) for v in values)
+
+
+def _from_unit(values, u: float):
+    """Map u in [0, 1) onto a list of choices or a (low, high) range."""
+
+    if _is_range(values):
+        low, high = values
+        if _is_int_range(values):
+            return int(low + min(int(u * (high - low + 1)), high - low))
+        return float(low + u * (high - low))
+    return values[min(int(u * len(values)), len(values) - 1)]
+
+
+def sweep_size(space: dict, method: str = "grid", num_samples: int = None) -> int:
+    """Number of points a sweep produces."""
+
+    if method == "grid":
+        if any(_is_range(values) for values in space.values()):
+            raise ValueError("grid sweeps need a list of values for every parameter")
+        return int(np.prod([len(values) for values in space.values()]))
+    if not num_samples:
+        raise ValueError(f"{method} sweeps need num_samples")
+    return int(num_samples)
+
+
+def grid(space: dict) -> Iterator[dict]:
+    """Every combination of the listed values, last parameter varying fastest."""
+
+    names = list(space)
+    for values in itertools.product(*(space[name] for name in names)):
+        yield dict(zip(names, values))
+
+
+def random_search(space: dict, num_samples: int, seed: int = 0) -> Iterator[dict]:
+    """num_samples independent uniform draws from space."""
+
+    rng = np.random.default_rng(seed)
+    for _ in range(int(num_samples)):
+        yield {name: _from_unit(values, rng.random()) for name, values in space.items()}
+
+
+def latin_hypercube(space: dict, num_samples: int, seed: int = 0) -> Iterator[dict]:
+    """num_samples points with exactly one sample in each of num_samples strata per parameter.
+
+    Strata are shuffled independently per parameter, so the points cover
+    every range evenly with far fewer samples than a grid.
+    """
+
+    rng = np.random.default_rng(seed)
+    num_samples = int(num_samples)
+    units = {
+        name: (rng.permutation(num_samples) + rng.random(num_samples)) / num_samples
+        for name in space
+    }
+    for i in range(num_samples):
+        yield {
+            name: _from_unit(values, units[name][i]) for name, values in space.items()
+        }
+
+
+def sweep_points(
+    space: dict, method: str = "grid", num_samples: int = None, seed: int = 0
+) -> Iterator[dict]:
+    """Lazily generate the parameter points of a sweep."""
+
+    if method == "grid":
+        return grid(space)
+    if method == "random":
+        return random_search(space, sweep_size(space, method, num_samples), seed=seed)
+    if method == "latin_hypercube":
+        return latin_hypercube(space, sweep_size(space, method, num_samples), seed=seed)
+    raise ValueError(f"Unknown sweep method {method}, expected one of {SWEEP_METHODS}")
+
+
+def task_id(prefix: str, index: int, params: dict) -> str:
+    """Deterministic task id from the point's index and a digest of its parameters."""
+
+    digest = hashlib.sha1(
+        json.dumps(params, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()[:8]
+    suffix = f"-{index:06d}-{digest}"
+    prefix = re.sub(r"[^A-Za-z0-9_-]", "-", prefix)[: MAX_TASK_ID_LENGTH - len(suffix)]
+    return prefix + suffix
+
+
+def _env_name(name: str) -> str:
+
+    return "SWEEP_" + re.sub(r"[^A-Za-z0-9_]", "_", name).upper()
+
+
+def sweep_tasks(
+    template: str, points: Iterable[dict], prefix: str = "sweep"
+) -> Iterator[dict]:
+    """Turn parameter points into command_source items tagged with their parameters.
+
+    Parameters
+    ----------
+    template : str
+        Command with str.format fields named after the parameters
+    points : Iterable[dict]
+        Parameter points, e.g. from sweep_points
+    prefix : str, optional
+        Start of every task id, by default "sweep"
+    """
+
+    for index, params in enumerate(points):
+        env = {_env_name(name): value for name, value in params.items()}
+        env["SWEEP_PARAMS"] = json.dumps(params, default=str)
+        yield {
+            "id": task_id(prefix, index, params),
+            "command": template.format(**params),
+            "env": env,
+            "params": params,
+        }
+
+
+def write_manifest(
+    template: str,
+    space: dict,
+    manifest: str = "sweep-manifest.jsonl",
+    method: str = "grid",
+    num_samples: int = None,
+    seed: int = 0,
+    prefix: str = "sweep",
+) -> int:
+    """Stream a sweep into a JSON lines manifest, returning the number of tasks written.
+
+    The manifest doubles as the task source for run_tasks and as the index
+    results_table joins outputs back to.
+    """
+
+    count = 0
+    with open(manifest, "w") as out:
+        points = sweep_points(space, method=method, num_samples=num_samples, seed=seed)
+        for item in sweep_tasks(template, points, prefix=prefix):
+            out.write(json.dumps(item, default=str) + "\n")
+            count += 1
+    logger.info(f"Wrote {count} {method} sweep tasks to {manifest}")
+    return count
+
+
+def run(
+    template: str,
+    space: dict,
+    method: str = "grid",
+    num_samples: int = None,
+    seed: int = 0,
+    prefix: str = None,
+    manifest: str = "sweep-manifest.jsonl",
+    **run_tasks_kwargs,
+):
+    """Write the sweep manifest and submit it with batch_containers.run_tasks.
+
+    Parameters
+    ----------
+    template : str
+        Command with str.format fields named after the parameters
+    space : dict
+        Parameter name to a list of values or a (low, high) range
+    method : str, optional
+        One of grid, random or latin_hypercube, by default "grid"
+    num_samples : int, optional
+        Number of points for random and latin_hypercube sweeps, by default None
+    seed : int, optional
+        Seed for sampled sweeps, the same seed gives the same tasks, by default 0
+    prefix : str, optional
+        Start of every task id, by default the job name or "sweep"
+    manifest : str, optional
+        JSON lines file the sweep is written to, by default "sweep-manifest.jsonl"
+    run_tasks_kwargs
+        Passed on to run_tasks, e.g. pool_name, job_name or low_pri_nodes
+    """
+
+    from batch_containers import run_tasks
+
+    prefix = prefix or run_tasks_kwargs.get("job_name") or "sweep"
+    num_tasks = write_manifest(
+        template,
+        space,
+        manifest=manifest,
+        method=method,
+        num_samples=num_samples,
+        seed=seed,
+        prefix=prefix,
+    )
+    run_tasks_kwargs.setdefault("num_tasks", num_tasks)
+    return run_tasks(task_to_run=manifest, **run_tasks_kwargs)
+
+
+def _parse_output(text: str) -> dict:
+    """Last line of a task's output, merged in as columns when it is a JSON object."""
+
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return {}
+    try:
+        parsed = json.loads(lines[-1])
+    except ValueError:
+        parsed = None
+    if isinstance(parsed, dict):
+        return parsed
+    return {"result": lines[-1]}
+
+
+def results_table(
+    manifest: str = "sweep-manifest.jsonl",
+    output_dir: str = "logs",
+    job_id: str = None,
+    file_path: str = "stdout.txt",
+    parse=_parse_output,
+):
+    """Join task outputs copied by copy_logs back onto the sweep's parameter rows.
+
+    Parameters
+    ----------
+    manifest : str, optional
+        Manifest written by write_manifest, by default "sweep-manifest.jsonl"
+    output_dir : str, optional
+        Directory copy_logs wrote into, by default "logs"
+    job_id : str, optional
+        Job the tasks ran in, by default the only job under output_dir
+    file_path : str, optional
+        Task file holding the result, by default "stdout.txt"
+    parse : Callable[[str], dict], optional
+        Turns a task's file into result columns, by default the last line,
+        expanded when it is a JSON object
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per task with its id, parameters and result columns; tasks
+        without output have missing results.
+    """
+
+    import pandas as pd
+
+    output_dir = pathlib.Path(output_dir)
+    if job_id is None:
+        jobs = [path for path in output_dir.iterdir() if path.is_dir()]
+        if len(jobs) != 1:
+            raise ValueError(f"Found {len(jobs)} jobs in {output_dir}, pass job_id")
+        job_dir = jobs[0]
+    else:
+        job_dir = output_dir / job_id
+
+    rows = []
+    with open(manifest) as tasks:
+        for line in tasks:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            row = {"task_id": item["id"], **item["params"]}
+            output = job_dir / item["id"] / file_path
+            if output.exists():
+                row.update(parse(output.read_text(errors="replace")))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def results(
+    manifest: str = "sweep-manifest.jsonl",
+    output_dir: str = "logs",
+    job_id: str = None,
+    file_path: str = "stdout.txt",
+    output_file: str = "sweep-results.csv",
+):
+    """Write results_table to a CSV file."""
+
+    table = results_table(manifest, output_dir, job_id=job_id, file_path=file_path)
+    table.to_csv(output_file, index=False)
+    logger.info(f"Wrote {len(table)} sweep results to {output_file}")
+    return output_file
+
+
+if __name__ == "__main__":
+
+    fire.Fire({"run": run, "manifest": write_manifest, "results": results})
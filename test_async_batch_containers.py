@@ -0,0 +1,269 @@
+"""Tests of AsyncAzureBatchContainers against an in-memory fake Batch service.
+
+    python -m pytest test_async_batch_containers.py
+"""
+
+import asyncio
+import datetime
+import shutil
+import threading
+
+import azure.batch.models as batchmodels
+import pytest
+
+import batch_containers
+from async_batch_containers import AsyncAzureBatchContainers
+from state_store import StateStore
+
+
+def batch_error(code: str) -> batchmodels.BatchErrorException:
+
+    error = batchmodels.BatchErrorException.__new__(batchmodels.BatchErrorException)
+    error.error = batchmodels.BatchError(
+        code=code, message=batchmodels.ErrorMessage(value=f"{code} error")
+    )
+    return error
+
+
+class FakeBatchService(object):
+    """Keeps the pools and jobs added, and completes a job's tasks when told to.
+
+    Like the real service, task counts lag behind: they only reflect tasks
+    which were added before the last call to refresh_counts.
+    """
+
+    def __init__(self):
+        self.pools = {}
+        self.tasks = {}
+        self.counted = {}
+        # largest add_collection request accepted, as if bigger ones exceeded 1 MB
+        self.max_collection_size = None
+        self.config = type("Config", (), {"hooks": []})()
+        self.pool = self
+        self.job = self
+        self.task = self
+        self.compute_node = self
+
+    # pool and job operations
+    def add(self, resource):
+        if isinstance(resource, batchmodels.PoolAddParameter):
+            self.pools[resource.id] = batchmodels.CloudPool(
+                id=resource.id,
+                state="active",
+                vm_size=resource.vm_size,
+                task_slots_per_node=resource.task_slots_per_node,
+                target_dedicated_nodes=resource.target_dedicated_nodes,
+                target_low_priority_nodes=resource.target_low_priority_nodes,
+                metadata=resource.metadata,
+            )
+        else:
+            self.tasks.setdefault(resource.id, {})
+
+    def get(self, id, pool_get_options=None, job_get_options=None):
+        if job_get_options is not None:
+            if id not in self.tasks:
+                raise batch_error("JobNotFound")
+            return batchmodels.CloudJob(id=id, state="active")
+        if id not in self.pools:
+            raise batch_error("PoolNotFound")
+        return self.pools[id]
+
+    def resize(self, pool_id, pool_resize_parameter):
+        pool = self.pools[pool_id]
+        pool.target_dedicated_nodes = pool_resize_parameter.target_dedicated_nodes
+        pool.target_low_priority_nodes = pool_resize_parameter.target_low_priority_nodes
+
+    def get_task_counts(self, job_id):
+        tasks = self.counted.get(job_id, {})
+        completed = sum(1 for state in tasks.values() if state == "completed")
+        return batchmodels.TaskCounts(
+            active=sum(1 for state in tasks.values() if state == "active"),
+            running=0,
+            completed=completed,
+            succeeded=completed,
+            failed=0,
+        )
+
+    # task operations
+    def add_collection(self, job_id, tasks):
+        if (
+            self.max_collection_size is not None
+            and len(tasks) > self.max_collection_size
+        ):
+            raise batch_error("RequestBodyTooLarge")
+        for task in tasks:
+            self.tasks[job_id][task.id] = "active"
+        return batchmodels.TaskAddCollectionResult(
+            value=[
+                batchmodels.TaskAddResult(status="success", task_id=task.id)
+                for task in tasks
+            ]
+        )
+
+    def list(self, job_id, task_list_options=None, compute_node_list_options=None):
+        if compute_node_list_options is not None:
+            return []
+        return [
+            batchmodels.CloudTask(id=task_id)
+            for task_id, state in self.tasks[job_id].items()
+            if state != "completed"
+        ]
+
+    def complete(self, job_id):
+        for task_id in self.tasks[job_id]:
+            self.tasks[job_id][task_id] = "completed"
+
+    def refresh_counts(self):
+        self.counted = {job_id: dict(tasks) for job_id, tasks in self.tasks.items()}
+
+
+@pytest.fixture
+def service():
+    return FakeBatchService()
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    # commands such as create_pool save the pool they use to the config
+    path = tmp_path / "config.ini"
+    shutil.copy("configs/config.ini", path)
+    return str(path)
+
+
+@pytest.fixture
+def async_batch(service, config_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        batch_containers.batch, "BatchServiceClient", lambda *args: service
+    )
+    async_batch = AsyncAzureBatchContainers(
+        config_file, workspace="workspace", access_key="access-key", max_workers=2
+    )
+    async_batch.batch.state_store = StateStore(str(tmp_path / "state.db"))
+    asyncio.run(
+        async_batch.create_pool(
+            use_fileshare=False, app_insights=False, reuse_warm=False
+        )
+    )
+    yield async_batch
+    async_batch.close()
+
+
+def test_wait_does_not_return_while_task_counts_lag(async_batch, service):
+    async def scenario():
+        await async_batch.add_job("job-1")
+        await async_batch.add_tasks(
+            async_batch.batch.iter_tasks(["python main.py"] * 3, workdir="/src")
+        )
+        async_batch.batch.submitted_tasks = 3
+        waiting = asyncio.ensure_future(
+            async_batch.wait_for_tasks_to_complete(
+                datetime.timedelta(seconds=5), min_interval=0.01, max_interval=0.01
+            )
+        )
+        # no task is counted yet, the job still has three incomplete tasks
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        service.complete("job-1")
+        service.refresh_counts()
+        return await waiting
+
+    assert asyncio.run(scenario()) is True
+
+
+def test_wait_times_out(async_batch, service):
+    async def scenario():
+        await async_batch.add_job("job-1")
+        await async_batch.add_tasks(
+            async_batch.batch.iter_tasks(["python main.py"], workdir="/src")
+        )
+        service.refresh_counts()
+        await async_batch.wait_for_tasks_to_complete(
+            datetime.timedelta(seconds=0.1), min_interval=0.01, max_interval=0.01
+        )
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(scenario())
+
+
+def test_batch_main_reads_commands_off_the_event_loop(async_batch, service, tmp_path):
+    threads = set()
+
+    def commands():
+        for i in range(3):
+            threads.add(threading.get_ident())
+            yield f"python main.py --seed {i}"
+
+    async def scenario():
+        loop_thread = threading.get_ident()
+        completer = asyncio.get_running_loop().call_later(
+            0.2,
+            lambda: (service.complete(async_batch.job_id), service.refresh_counts()),
+        )
+        await async_batch.batch_main(
+            command=commands(),
+            wait_for_tasks=True,
+            show_price=False,
+            app_insights=False,
+            state_db=str(tmp_path / "state.db"),
+        )
+        completer.cancel()
+        return loop_thread
+
+    loop_thread = asyncio.run(scenario())
+    assert len(service.tasks[async_batch.job_id]) == 3
+    assert threads and loop_thread not in threads
+    assert "wait_for_tasks" in async_batch.batch.metrics.summary()
+
+
+def test_wait_without_submitting_lists_incomplete_tasks(async_batch, service):
+    async def scenario():
+        await async_batch.add_job("job-1")
+        await async_batch.add_tasks(
+            async_batch.batch.iter_tasks(["python main.py"] * 2, workdir="/src")
+        )
+        # another process added the tasks, and their counts have not caught up
+        async_batch.batch.submitted_tasks = 0
+        return await async_batch._run(async_batch.batch.tasks_complete)
+
+    assert asyncio.run(scenario()) is False
+
+
+def test_rerun_with_other_tasks_per_node_reuses_the_pool(async_batch, service):
+    # run_tasks sets TASKS_PER_NODE from num_tasks before creating the pool
+    pool_id = async_batch.pool_id
+    tasks_per_node = int(async_batch.config["POOL"]["TASKS_PER_NODE"])
+    async_batch.config["POOL"]["TASKS_PER_NODE"] = str(tasks_per_node + 3)
+    asyncio.run(
+        async_batch.create_pool(
+            use_fileshare=False, app_insights=False, reuse_warm=False
+        )
+    )
+    assert list(service.pools) == [pool_id]
+    assert service.pools[pool_id].task_slots_per_node == tasks_per_node
+
+
+def test_add_tasks_splits_requests_which_are_too_large(async_batch, service):
+    async def scenario():
+        await async_batch.add_job("job-1")
+        service.max_collection_size = 30
+        return await async_batch.add_tasks(
+            async_batch.batch.build_task("python main.py", f"task-{i}")
+            for i in range(100)
+        )
+
+    assert asyncio.run(scenario()) == {}
+    assert len(service.tasks["job-1"]) == 100
+    assert async_batch.batch.submitted_tasks == 100
+
+
+def test_add_tasks_fails_tasks_too_large_on_their_own(async_batch, service):
+    async def scenario():
+        await async_batch.add_job("job-1")
+        service.max_collection_size = 0
+        return await async_batch.add_tasks(
+            async_batch.batch.iter_tasks(["python main.py"] * 3, workdir="/src")
+        )
+
+    failures = asyncio.run(scenario())
+    assert len(failures) == 3
+    assert all("RequestBodyTooLarge" in message for message in failures.values())
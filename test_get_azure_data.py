@@ -0,0 +1,87 @@
+"""Tests of the azureprice.net price cache, with the page served from memory.
+
+    python -m pytest test_get_azure_data.py
+"""
+
+import io
+
+import pytest
+
+import get_azure_data
+
+
+def price_page(num_rows: int = 50) -> bytes:
+    """Price page with the same table layout as azureprice.net."""
+
+    header = "".join(
+        f"<th>{name}</th>"
+        for name in [
+            "VM Name",
+            "vCPUs",
+            "Memory (GiB)",
+            "Linux price",
+            "Windows price",
+            "Best region",
+            "Alternatives",
+        ]
+    )
+    rows = "".join(
+        f"<tr><td>Standard_S{i}_v1</td><td>{1 + i % 64}</td><td>{2 + i % 256}</td>"
+        f"<td>{0.01 * (i + 1):.4f}</td><td>{0.02 * (i + 1):.4f}</td>"
+        f"<td>eastus</td><td>...</td></tr>"
+        for i in range(num_rows)
+    )
+    return (
+        f"<html><body><table><thead><tr>{header}</tr></thead>"
+        f"<tbody>{rows}</tbody></table></body></html>"
+    ).encode("utf-8")
+
+
+@pytest.fixture
+def opened_pages(monkeypatch, tmp_path):
+    opened = []
+
+    def open_price_page(region, low_pri):
+        opened.append((region, low_pri))
+        return io.BytesIO(price_page())
+
+    monkeypatch.setattr(get_azure_data, "PRICE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(get_azure_data, "_open_price_page", open_price_page)
+    return opened
+
+
+def test_show_hourly_price_is_served_from_the_cache(opened_pages):
+    price = get_azure_data.show_hourly_price(
+        machine_sku="Standard_S3_v1", low_pri_nodes=2, dedicated_nodes=1
+    )
+    assert price == round(0.04 * 2 + 0.04, 2)
+    assert len(opened_pages) == 2
+
+    assert (
+        get_azure_data.show_hourly_price(
+            machine_sku="Standard_S3_v1", low_pri_nodes=2, dedicated_nodes=1
+        )
+        == price
+    )
+    assert len(opened_pages) == 2
+
+
+def test_targeted_rows_expire_after_ttl(opened_pages):
+    get_azure_data.get_sku_prices(vm_names=["Standard_S3_v1"])
+    get_azure_data.get_sku_prices(vm_names=["Standard_S3_v1"], ttl=0)
+    assert len(opened_pages) == 2
+
+
+def test_other_skus_are_still_fetched(opened_pages):
+    get_azure_data.get_sku_prices(vm_names=["Standard_S3_v1"])
+    prices = get_azure_data.get_sku_prices(
+        vm_names=["Standard_S3_v1", "Standard_S4_v1"]
+    )
+    assert len(opened_pages) == 2
+    assert sorted(prices["VM Name"]) == ["Standard_S3_v1", "Standard_S4_v1"]
+    assert get_azure_data.FETCHED_COLUMN not in prices
+
+
+def test_show_hourly_price_rejects_unknown_sku(opened_pages):
+    with pytest.raises(ValueError, match="Standard_Missing"):
+        get_azure_data.show_hourly_price(machine_sku="Standard_Missing")
@@ -9,13 +9,11 @@ JOB_NAME = "distinct-tasks-job"
 args1 = ["output_dir"] * 3
 args2 = ["scenario1", "scenario2", "scenario3"]
 
-# Map them together as needed to make a single list of tasks
-tasks_list = list(
-    map(
-        lambda x, y: f"python main.py --log-iterations --log-path {x} --sim-name {y}",
-        args1,
-        args2,
-    )
+# Map them together as needed, tasks are generated lazily as they are submitted
+tasks = map(
+    lambda x, y: f"python main.py --log-iterations --log-path {x} --sim-name {y}",
+    args1,
+    args2,
 )
 
 # Run the tasks
@@ -23,8 +21,8 @@ run_tasks(
     config_file=user_config,
     pool_name=POOL_NAME,
     job_name=JOB_NAME,
-    task_to_run=tasks_list,
-    num_tasks=len(tasks_list),
+    task_to_run=tasks,
+    num_tasks=len(args2),
     low_pri_nodes=3,
     dedicated_nodes=0,
     vm_sku="Standard_a2_v2",